@@ -2,10 +2,17 @@ import sqlite3 as lite
 import os
 import shutil
 import logging
+import time
+import contextlib
+import itertools
 import numpy as np
-import cv2
-import re
-from PyQt5 import QtCore, QtGui, QtWidgets
+
+# project imports (FrameCache, FrameSource and Thumbnails, with opencv, are imported when a video is opened, so that
+# headless tools that don't need frames start fast)
+
+
+# contour storage type (schema version 2)
+CONTOUR_DTYPE = np.dtype('<i4')
 
 
 class VideoLoadError(Exception):
@@ -22,6 +29,25 @@ class AnnotationFileError(Exception):
     pass
 
 
+def encode_contour(contour):
+    """
+    :param contour: sequence of integers in format (x, y, x, y, ...)
+    :return: contour as stored in the database: packed little-endian int32 (BLOB)
+    """
+    return np.asarray(contour, dtype=CONTOUR_DTYPE).tobytes()
+
+
+def decode_contour(value):
+    """ single decoder for contours read from the database
+    :param value: contour column of a frames table record
+    :return: read-only int32 array (x, y, x, y, ...); a view of value, no copy is made
+    """
+    # text contours (schema version < 2)
+    if isinstance(value, str):
+        return np.array(value.split(), dtype=CONTOUR_DTYPE)
+    return np.frombuffer(value, dtype=CONTOUR_DTYPE)
+
+
 class Annotation(object):
     """ contains a database of the annotations and transient data pertaining to the annotation session
     """
@@ -29,10 +55,33 @@ class Annotation(object):
     SUFFIX = '.atc'
     TEMP_WORKING_FILENAME = '.working' + SUFFIX
 
-    def __init__(self, filename):
+    # version of the database schema (sqlite user_version); files with an older version are migrated on load
+    # 0: original schema
+    # 1: indexes on frames (frame, object) and (object, frame)
+    # 2: contours stored as packed int32 BLOBs instead of space separated text
+    SCHEMA_VERSION = 2
+
+    # default maximal time (seconds) changes are kept uncommitted (write-behind); 0 commits every change
+    COMMIT_INTERVAL = 1.0
+
+    # default sqlite synchronous mode. with WAL journaling NORMAL never corrupts the file, but a power loss may
+    # lose the last commits
+    SYNCHRONOUS = 'NORMAL'
+
+    # indexes of the frames table (schema version 1): name -> indexed columns
+    INDEXES = {'frames_frame_object': 'frames (frame, object)', 'frames_object_frame': 'frames (object, frame)'}
+
+    def __init__(self, filename, commit_interval=COMMIT_INTERVAL, synchronous=SYNCHRONOUS, background_readers=True,
+                 video=True):
         """
         Creates a new annotation or loads an existing one from file
         :param filename: video / annotation filename
+        :param commit_interval: maximal time (seconds) to keep changes uncommitted; 0 to commit every change
+        :param synchronous: sqlite synchronous mode ('OFF', 'NORMAL', 'FULL' or 'EXTRA')
+        :param background_readers: start read-ahead and keyframe indexing threads (for interactive browsing;
+        not needed by batch tools)
+        :param video: open the annotated video; False to work on an existing annotation's objects only (e.g. without
+        its video): frames can't be read, and num_frames and frame_shape are None
         :return:
         """
 
@@ -42,14 +91,44 @@ class Annotation(object):
         # annotated video filename
         self.video_filename = None
 
-        # initialize video capture
-        self.cap = None
+        # frame source of the video (see FrameSource.open_source)
+        self.source = None
         self.num_frames = 0
         self.current_frame = 0
 
+        # (height, width) of video frames
+        self.frame_shape = None
+
+        # decoded frames cache, filled by a read-ahead worker in the direction of travel (made with the frame source)
+        self.frame_cache = None
+        self.read_ahead = None
+
+        # keyframe index of video for exact random access (built in background)
+        self.keyframe_index = None
+        self.background_readers = background_readers
+
+        # downscaled frames for previews while the frame slider is dragged (built in background)
+        self.thumbnails = None
+
+        # last frame returned by get_frame_image (to know the direction of travel)
+        self._last_read_frame = None
+
         # initialize database handlers
         self.cursor = self.connection = None
 
+        # durability settings
+        if synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError('illegal synchronous mode ' + str(synchronous))
+        self.commit_interval = commit_interval
+        self.synchronous = synchronous
+
+        # write-behind state: uncommitted changes, time of last commit and depth of open transaction() blocks
+        self._dirty = False
+        self._last_commit = time.monotonic()
+        self._transaction_depth = 0
+
+        self.video = video
+
         # if no such file exists don't create annotation
         if not os.path.exists(filename):
             logging.error('failed to open annotation file ' + filename)
@@ -66,9 +145,13 @@ class Annotation(object):
         else:
             #   TODO find out exe path.
             #   check if for some reason the annotation tool workspace file already exists; if so delete
+            import Thumbnails
+
             temp_filename = os.path.join(os.getcwd(), Annotation.TEMP_WORKING_FILENAME)
-            if os.path.exists(temp_filename):
-                os.remove(temp_filename)
+            for f in [temp_filename, temp_filename + '-wal', temp_filename + '-shm',
+                      temp_filename + Thumbnails.ThumbnailStore.SUFFIX]:
+                if os.path.exists(f):
+                    os.remove(f)
 
             # create new annotation (using workspace temporary file)
             self.create(filename, temp_filename)
@@ -111,7 +194,11 @@ class Annotation(object):
     def exit(self):
 
         # commit changes
-        self.connection.commit()
+        if self.connection:
+            self.commit()
+
+        # stop background readers
+        self.stop_workers()
 
     def create(self, video_filename, annotation_filename):
         """ create new annotation for video in video_filename
@@ -122,7 +209,7 @@ class Annotation(object):
 
         logging.info('Trying to create new annotation for video ' + str(video_filename))
         # check for non-existent file
-        if not os.path.isfile(video_filename):
+        if not os.path.isfile(video_filename) and not os.path.isdir(video_filename):
             logging.error('Annotation.create(): no such file ' + video_filename)
             raise VideoLoadError('Video Read Error: no such file ' + video_filename)
 
@@ -143,9 +230,12 @@ class Annotation(object):
         # sqlite cursor
         self.cursor = self.connection.cursor()
 
+        # journaling and durability
+        self.configure_connection()
+
         # annotation database
         self.cursor.execute('''CREATE TABLE frames
-                  (frame integer, object integer, class text, contour text, final integer)''')
+                  (frame integer, object integer, class text, contour blob, final integer)''')
 
         # classes
         self.cursor.execute('''CREATE TABLE classes (class_name text unique)''')
@@ -154,6 +244,9 @@ class Annotation(object):
         self.cursor.execute('''CREATE TABLE session (video_file text, current_frame integer)''')
         self.cursor.execute('INSERT INTO session VALUES(?, ?)', (video_filename, 1))
 
+        # indexes and schema version
+        self.migrate()
+
         logging.info('Annotation ' + str(annotation_filename) + ' created successfully.')
 
     def load(self, filename):
@@ -173,6 +266,9 @@ class Annotation(object):
             # get cursor
             self.cursor = self.connection.cursor()
 
+            # journaling and durability
+            self.configure_connection()
+
             # get session parameters
             self.cursor.execute('SELECT * FROM session')
             params = self.cursor.fetchone()
@@ -184,16 +280,142 @@ class Annotation(object):
             # save filename
             self._filename = filename
 
-            # attempt to open
-            self.open_video(video_filename)
+            # bring older files up to date
+            self.migrate()
+
+            if self.video:
+                # attempt to open
+                self.open_video(video_filename)
 
-            # session parameters
-            self.set_frame(params[1])
+                # session parameters
+                self.set_frame(params[1])
+            else:
+                # number of frames and their size are unknown
+                self.video_filename = video_filename
+                self.num_frames = None
+                self.current_frame = params[1]
 
         except lite.DatabaseError:
             logging.error('error reading annotation ' + filename + '. file might be corrupted')
             raise AnnotationFileError('error reading annotation ' + filename + '. file might be corrupted')
 
+    def configure_connection(self):
+        """ WAL journaling: commits append to the log instead of rewriting the database, and readers never block
+        :return:
+        """
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+
+        # note: pragma does not accept parameters
+        self.cursor.execute('PRAGMA synchronous=' + self.synchronous)
+
+    def commit(self):
+        """ commit all pending changes now
+        :return:
+        """
+        self.connection.commit()
+        self._dirty = False
+        self._last_commit = time.monotonic()
+
+    def flush(self):
+        """ commit pending changes, if any, unless inside a transaction() block. call periodically to bound the
+        changes lost on a crash to commit_interval
+        :return:
+        """
+        if self._dirty and self._transaction_depth == 0:
+            self.commit()
+
+    def _changed(self):
+        """ called by mutators: commit now, or leave it to a later change / flush() if committed recently
+        :return:
+        """
+        self._dirty = True
+        if self._transaction_depth == 0 and time.monotonic() - self._last_commit >= self.commit_interval:
+            self.commit()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ group changes (e.g. of a single user action) so that they are applied all together or not at all.
+        may be nested. usage:
+            with annotation.transaction():
+                annotation.remove(...)
+                annotation.add(...)
+        """
+        # savepoints (unlike BEGIN) can be nested; open a transaction first so RELEASE doesn't commit
+        if not self.connection.in_transaction:
+            self.cursor.execute('BEGIN')
+
+        self._transaction_depth += 1
+        savepoint = 'annotation_transaction_{0:d}'.format(self._transaction_depth)
+        self.cursor.execute('SAVEPOINT ' + savepoint)
+        try:
+            yield self
+        except BaseException:
+            self.cursor.execute('ROLLBACK TO ' + savepoint)
+            self.cursor.execute('RELEASE ' + savepoint)
+            self._transaction_depth -= 1
+            raise
+        else:
+            self.cursor.execute('RELEASE ' + savepoint)
+            self._transaction_depth -= 1
+            self._changed()
+
+    def migrate(self):
+        """ upgrade database schema to SCHEMA_VERSION
+        :return:
+        """
+        self.cursor.execute('PRAGMA user_version')
+        version = self.cursor.fetchone()[0]
+
+        if version > Annotation.SCHEMA_VERSION:
+            raise AnnotationFileError('annotation {0} was created by a newer version of the tool (schema {1})'
+                                      .format(self._filename, version))
+        if version == Annotation.SCHEMA_VERSION:
+            return
+
+        logging.info('Migrating annotation from schema {0} to {1}'.format(version, Annotation.SCHEMA_VERSION))
+
+        # 0 -> 1: index frames table for per-frame and per-object queries
+        if version < 1:
+            self.create_indexes()
+
+        # 1 -> 2: text contours to binary (BLOBs are stored as-is regardless of the column's declared type)
+        if version < 2:
+            self.connection.create_function('encode_contour', 1, lambda c: encode_contour(c.split()))
+            self.cursor.execute("UPDATE frames SET contour=encode_contour(contour) WHERE typeof(contour)='text'")
+
+        # note: pragma does not accept parameters
+        self.cursor.execute('PRAGMA user_version = {0:d}'.format(Annotation.SCHEMA_VERSION))
+
+        # commit changes
+        self.commit()
+
+    def create_indexes(self):
+        for name, columns in Annotation.INDEXES.items():
+            self.cursor.execute('CREATE INDEX IF NOT EXISTS {0} ON {1}'.format(name, columns))
+
+    @contextlib.contextmanager
+    def deferred_indexes(self):
+        """ drop the frames table indexes for a bulk insert and build them once after it (a single sort instead of
+        an index update per row). meanwhile the file is marked as schema version 0, so if the insert is interrupted
+        the indexes are rebuilt by migrate() on next load. usage:
+            with annotation.deferred_indexes():
+                annotation.add_many(...)
+        """
+        self.commit()
+        for name in Annotation.INDEXES:
+            self.cursor.execute('DROP INDEX IF EXISTS ' + name)
+        self.cursor.execute('PRAGMA user_version = 0')
+        self.commit()
+        try:
+            yield self
+        finally:
+            self.commit()
+            self.create_indexes()
+
+            # note: pragma does not accept parameters
+            self.cursor.execute('PRAGMA user_version = {0:d}'.format(Annotation.SCHEMA_VERSION))
+            self.commit()
+
     def save(self, filename):
         """ save annotation to filename
         :param filename: new filename for annotation
@@ -207,13 +429,17 @@ class Annotation(object):
                 raise ValueError('Illegal filename')
 
             # commit any changes to be on the safe side
-            self.connection.commit()
+            self.commit()
 
             # close old file
             self.close()
 
-            # copy file
+            # copy file (and the thumbnails of its video, so they are not decoded again)
+            import Thumbnails
             shutil.copy(self._filename, filename)
+            thumbnails = self._filename + Thumbnails.ThumbnailStore.SUFFIX
+            if os.path.exists(thumbnails):
+                shutil.copy(thumbnails, filename + Thumbnails.ThumbnailStore.SUFFIX)
 
             # delete temporary file in case we were working on it till now
             if self._filename == Annotation.TEMP_WORKING_FILENAME:
@@ -225,10 +451,32 @@ class Annotation(object):
             # delete temporary file
             if os.path.exists(Annotation.TEMP_WORKING_FILENAME):
                 os.remove(Annotation.TEMP_WORKING_FILENAME)
+            if os.path.exists(Annotation.TEMP_WORKING_FILENAME + Thumbnails.ThumbnailStore.SUFFIX):
+                os.remove(Annotation.TEMP_WORKING_FILENAME + Thumbnails.ThumbnailStore.SUFFIX)
+
+    def stop_workers(self):
+        """ stop background video readers and wait for them to release their video captures """
+        if self.read_ahead:
+            self.read_ahead.stop()
+            self.read_ahead.join()
+            self.read_ahead = None
+
+        if self.keyframe_index:
+            self.keyframe_index.stop()
+
+        if self.thumbnails:
+            self.thumbnails.stop()
+            self.thumbnails = None
 
     def close(self):
+        # stop background readers
+        self.stop_workers()
+
         if self.connection:
+            # write pending changes
+            self.commit()
             self.connection.close()
+            self.connection = self.cursor = None
 
     def set_frame(self, frame_number):
         """
@@ -244,7 +492,7 @@ class Annotation(object):
 
         # save session
         self.cursor.execute('UPDATE session SET current_frame=(?)', (self.current_frame,))
-        self.connection.commit()
+        self._changed()
 
     def get_frame_image(self):
         """
@@ -252,64 +500,85 @@ class Annotation(object):
         1-based user requests
         """
 
-        if self.cap is None:
+        if self.source is None:
             return
 
-        # read frame (annoying opencv version difference)
-        if int(cv2.__version__[0]) < 3:
-            self.cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, self.current_frame - 1)
-        else:
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.current_frame - 1)
+        # direction of travel (for reading ahead)
+        direction = -1 if self._last_read_frame and self.current_frame < self._last_read_frame else 1
+        self._last_read_frame = self.current_frame
 
-        # get from video capture
-        ret, frame = self.cap.read()
+        frame = self.read_frame(self.current_frame)
 
         # check for failure
-        if not ret:
+        if frame is None:
             error_message = 'error reading frame ' + str(self.current_frame)
             logging.error(error_message)
             raise VideoLoadError(error_message)
+
+        # prepare the next frames in the background
+        if self.read_ahead:
+            self.read_ahead.request(self.current_frame, direction)
+
         return frame
 
-    def open_video(self, video_filename):
-        """ open video capture
-        :param video_filename: to open
-        :return: set video capture, video filename and number of frames
+    def read_frame(self, frame_number):
+        """ read any frame (e.g. for tracking) without changing the current frame
+        :param frame_number: frame to read (1-based)
+        :return: read-only image or None if it can't be read
         """
-        logging.info('Attempt to open video ' + str(video_filename))
+        if self.source is None or frame_number < 1 or frame_number > self.num_frames:
+            return None
 
-        # split filename
-        basename, extension = os.path.splitext(video_filename)
+        # cheap to read at random (no decoding): neither cached nor read ahead
+        if not self.source.READ_AHEAD:
+            return self.source.read(frame_number)
 
-        # handle image names
-        if extension in ['.jpg', '.bmp', '.tiff', '.tif', '.png']:
+        # look in cache first; if the read-ahead worker is about to decode the frame wait for it
+        frame = self.frame_cache.get(frame_number)
+        if frame is None and self.read_ahead:
+            frame = self.read_ahead.wait_for(frame_number)
 
-            # find how many consecutive 0's in filename
-            *_, b = basename.split('/')
+        if frame is None:
+            # get from video capture (seeks only if not sequential)
+            frame = self.source.read(frame_number)
+            if frame is None:
+                return None
 
-            try:
+            self.frame_cache.put(frame_number, frame)
 
-                # look for 0,,,0 or 0,,,01 and replace with regex
-                zeros = max(re.findall('0+1?', b))
-                pat = '%' + str(len(zeros)) + 'd'
+        return frame
 
-                # python magic to replace last appearance of 'zeros' with 'pat'
-                video_filename = video_filename[::-1].replace(zeros[::-1], pat[::-1], 1)[::-1]
+    def get_thumbnail(self, frame_number):
+        """
+        :param frame_number: frame to preview (1-based)
+        :return: downscaled BGR image of the frame (or of a frame shortly before it), or None if not available yet
+        """
+        if self.thumbnails is None:
+            return None
+        return self.thumbnails.get(frame_number)
 
-            # If a number does no exists, keep filename as is
-            except ValueError:
-                pass
+    def open_video(self, video_filename):
+        """ open frame source
+        :param video_filename: to open: video, raw video container or image (read as a sequence: the files named like
+        the image); see FrameSource.open_source
+        :return: set frame source, video filename and number of frames
+        """
+        import FrameCache
+        import FrameSource
+        import Thumbnails
+
+        logging.info('Attempt to open video ' + str(video_filename))
 
         # attempt to open
-        self.cap = cv2.VideoCapture(video_filename)
+        self.source = FrameSource.open_source(video_filename)
 
         # check for success
-        if not self.cap.isOpened():
+        if not self.source.is_opened():
             # log
             logging.error('Annotation.open_video(): failed to open video ' + video_filename)
 
-            # reset capture
-            self.cap = None
+            # reset source
+            self.source = None
 
             # raise exception
             e = VideoLoadVideoNotFound('failed to open video ' + video_filename + '. file might have been moved or corrupted')
@@ -317,15 +586,45 @@ class Annotation(object):
             raise e
 
         # get number of frames
-        if int(cv2.__version__[0]) < 3:
-            self.num_frames = int(np.round(self.cap.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)))
-        else:
-            self.num_frames = int(np.round(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+        self.num_frames = self.source.num_frames()
+
+        # get frame size
+        self.frame_shape = self.source.frame_shape()
 
         # update video filename
         self.video_filename = video_filename
         logging.info('Opened video ' + str(video_filename) + ' successfully.')
 
+        # (re)start background readers on the new video
+        self.stop_workers()
+        self.frame_cache = FrameCache.FrameCache()
+        self._last_read_frame = None
+        self.keyframe_index = None
+        if not self.background_readers:
+            return
+
+        # index keyframes of videos (other sources read any frame directly)
+        if isinstance(self.source, FrameSource.VideoSource):
+            self.keyframe_index = FrameSource.KeyframeIndex(video_filename)
+            self.keyframe_index.start()
+            self.source.index = self.keyframe_index
+
+        if self.source.READ_AHEAD:
+            self.read_ahead = FrameCache.ReadAhead(video_filename, self.num_frames, self.frame_cache,
+                                                   index=self.keyframe_index)
+            self.read_ahead.start()
+
+        # slider preview thumbnails, kept next to the annotation (none if the source can't tell the frames' size,
+        # e.g. an unreadable first image)
+        if 0 in self.frame_shape:
+            logging.warning('Annotation.open_video(): unknown frame size of ' + str(video_filename) +
+                            ', no slider previews')
+            return
+        self.thumbnails = Thumbnails.ThumbnailStore(self._filename + Thumbnails.ThumbnailStore.SUFFIX,
+                                                    video_filename, self.num_frames, self.frame_shape,
+                                                    index=self.keyframe_index)
+        self.thumbnails.start()
+
     def add_class(self, class_name):
         """
         :param class_name: new class to be added
@@ -339,26 +638,46 @@ class Annotation(object):
         # insert to table
         self.cursor.execute('INSERT INTO classes VALUES (?)', (class_name,))
 
-        # commit changes
-        self.connection.commit()
+        # commit changes (write-behind)
+        self._changed()
 
     def add(self, frame_number, object_id, class_name, contour, final):
         """
         :param frame_number: video frame to which to add object (int)
         :param object_id: integer
         :param class_name: classification (int)
-        :param contour: list of integers in format (y, x, y, x)
+        :param contour: sequence of integers in format (x, y, x, y)
         :param final: predicted/final boolean
         :return:
         """
 
         # insert to table
         self.cursor.execute('INSERT INTO frames VALUES(?, ?, ?, ?, ?)',
-                            (frame_number, object_id, class_name,
-                             ' '.join([str(x) for x in contour]), final))
+                            (frame_number, object_id, class_name, encode_contour(contour), final))
 
-        # commit changes
-        self.connection.commit()
+        # commit changes (write-behind)
+        self._changed()
+
+    def add_many(self, records):
+        """ insert many objects with a single statement
+        :param records: sequence of (frame_number, object_id, class_name, contour, final) as in add()
+        :return:
+        """
+        self.cursor.executemany('INSERT INTO frames VALUES(?, ?, ?, ?, ?)',
+                                ((f, o, c, encode_contour(contour), final) for f, o, c, contour, final in records))
+
+        # commit changes (write-behind)
+        self._changed()
+
+    def remove_predictions(self, keys):
+        """ remove non-final objects (final ones are kept) with a single statement
+        :param keys: sequence of (frame_number, object_id)
+        :return:
+        """
+        self.cursor.executemany('DELETE FROM frames WHERE frame=(?) AND object=(?) AND final=0', keys)
+
+        # commit changes (write-behind)
+        self._changed()
 
     def remove(self, object_id, frame=None):
         """
@@ -372,8 +691,8 @@ class Annotation(object):
         else:
             self.cursor.execute('DELETE from frames where object=(?) and frame=(?)', (object_id, frame))
 
-        # commit changes
-        self.connection.commit()
+        # commit changes (write-behind)
+        self._changed()
 
     def get(self, frame_number, obj_id=None, class_name=None):
         """
@@ -392,6 +711,113 @@ class Annotation(object):
 
         return self.cursor.fetchall()
 
+    def _range_query(self, columns, first, last, classes, ids, frame_index=True):
+        """
+        :param frame_index: let the frame range use the (frame, object) index. False for queries ordered by object:
+        they then read the (object, frame) index in order instead of sorting all records
+        :return: (query, parameters) selecting columns of frames records in range, optionally filtered
+        """
+        # unary + keeps sqlite from using an index for the term
+        frame = 'frame' if frame_index else '+frame'
+        query = 'SELECT ' + columns + ' FROM frames WHERE ' + frame + ' >= (?)'
+        params = [first]
+
+        if last is not None:
+            query += ' AND ' + frame + ' <= (?)'
+            params.append(last)
+
+        if classes is not None:
+            classes = list(classes)
+            query += ' AND class IN (' + ', '.join('?' * len(classes)) + ')'
+            params += classes
+        if ids is not None:
+            ids = list(ids)
+            query += ' AND object IN (' + ', '.join('?' * len(ids)) + ')'
+            params += ids
+
+        return query, params
+
+    def object_ids(self, frame_number):
+        """
+        :param frame_number: frame
+        :return: set of ID's of the objects in frame
+        """
+        self.cursor.execute('SELECT object FROM frames WHERE frame=(?)', (frame_number,))
+        return {r[0] for r in self.cursor.fetchall()}
+
+    def count_frames(self, first=1, last=None, classes=None, ids=None):
+        """
+        :param first: first frame
+        :param last: last frame (None for no limit)
+        :param classes: count only objects of these classes (None for all)
+        :param ids: count only these objects (None for all)
+        :return: number of frames in range that have objects
+        """
+        self.cursor.execute(*self._range_query('COUNT(DISTINCT frame)', first, last, classes, ids))
+        return self.cursor.fetchone()[0]
+
+    def iter_records(self, first=1, last=None, classes=None, ids=None, by_object=False):
+        """ stream records with a single ordered query (constant memory)
+        :param first: first frame
+        :param last: last frame (None for no limit)
+        :param classes: return only objects of these classes (None for all)
+        :param ids: return only these objects (None for all)
+        :param by_object: order by object, then frame (tracks, as get_annotations_of_id) instead of frame, then
+        object
+        :return: generator of records
+        """
+        query, params = self._range_query('*', first, last, classes, ids, frame_index=not by_object)
+
+        # own cursor, so that other queries don't interrupt the stream
+        cursor = self.connection.cursor()
+        cursor.execute(query + (' ORDER BY object, frame' if by_object else ' ORDER BY frame, object'), params)
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    def iter_frames(self, first=1, last=None, classes=None, ids=None):
+        """ stream records in frame order with a single query (constant memory)
+        :param first: first frame
+        :param last: last frame (None for no limit)
+        :param classes: return only objects of these classes (None for all)
+        :param ids: return only these objects (None for all)
+        :return: generator of (frame_number, records) for frames with objects; records ordered by object
+        """
+        records = self.iter_records(first, last, classes, ids)
+        try:
+            for frame_number, frame_records in itertools.groupby(records, key=lambda r: r[0]):
+                yield frame_number, list(frame_records)
+        finally:
+            records.close()
+
+    def final_objects(self, first=1, last=None, ids=None):
+        """
+        :param first: first frame
+        :param last: last frame (None for no limit)
+        :param ids: only these objects (None for all)
+        :return: set of (frame_number, object_id) of final objects in range
+        """
+        query, params = self._range_query('frame, object', first, last, None, ids)
+        self.cursor.execute(query + ' AND final=1', params)
+        return set(self.cursor.fetchall())
+
+    def count_records(self):
+        """
+        :return: number of object instances (records) in all frames
+        """
+        self.cursor.execute('SELECT COUNT(*) FROM frames')
+        return self.cursor.fetchone()[0]
+
+    def class_counts(self):
+        """
+        :return: list of (class, objects, instances, final instances) per class, ordered by class; instances
+        are object occurrences in frames
+        """
+        self.cursor.execute('SELECT class, COUNT(DISTINCT object), COUNT(*), SUM(final) FROM frames '
+                            'GROUP BY class ORDER BY class')
+        return self.cursor.fetchall()
+
     def change_class(self, obj_id, class_name):
         """
         :param obj_id: object to change class for
@@ -401,8 +827,8 @@ class Annotation(object):
         # update class
         self.cursor.execute('UPDATE frames SET class=(?) WHERE object=(?)', (class_name, obj_id))
 
-        # commit changes
-        self.connection.commit()
+        # commit changes (write-behind)
+        self._changed()
 
     def finalize_object(self, obj_id, frame_number):
         """
@@ -413,8 +839,8 @@ class Annotation(object):
         # update
         self.cursor.execute('UPDATE frames SET final=1 WHERE object=(?) AND frame=(?)', (obj_id, frame_number))
 
-        # commit changes
-        self.connection.commit()
+        # commit changes (write-behind)
+        self._changed()
 
     def finalize_frame(self, frame_number):
         """ finalize all objects in frame
@@ -424,8 +850,8 @@ class Annotation(object):
         # update
         self.cursor.execute('UPDATE frames SET final=1 WHERE frame=(?)', (frame_number,))
 
-        # commit changes
-        self.connection.commit()
+        # commit changes (write-behind)
+        self._changed()
 
     def combine_objects(self, from_id, to_id):
         """
@@ -464,8 +890,8 @@ class Annotation(object):
         # combine objects
         self.cursor.execute('UPDATE frames SET object=(?), class=(?) WHERE object=(?)', (to_id, class_to_id, from_id))
 
-        # commit changes
-        self.connection.commit()
+        # commit changes (write-behind)
+        self._changed()
 
     def get_frames_indexes_of_id(self, obj_id):
         """
@@ -473,15 +899,8 @@ class Annotation(object):
         :param obj_id: integer
         """
 
-        self.cursor.execute('SELECT * FROM frames where object=(?)', (obj_id,))
-        data = self.cursor.fetchall()
-        if not data:
-            data_frames = []
-        else:
-            data_mat = np.array(data)
-            data_frames = [int(x) for x in data_mat[:, 0]]
-
-        return data_frames
+        self.cursor.execute('SELECT frame FROM frames where object=(?) ORDER BY frame', (obj_id,))
+        return [r[0] for r in self.cursor.fetchall()]
 
     def get_annotations_of_id(self, obj_id):
         """
@@ -0,0 +1,204 @@
+""" headless command line interface: export annotations, import detections and print statistics without the GUI
+(no Qt).
+usage:
+    python -m AnnotationCLI stats annotation.atc
+    python -m AnnotationCLI export annotation.atc out_dir --format tiff --first 100 --last 200 --classes car
+    python -m AnnotationCLI labels annotation.atc labels.json --classes car person
+    python -m AnnotationCLI import annotation.atc detections.jsonl --map vehicle=car
+    python -m AnnotationCLI transcode video.mp4 --annotation annotation.atc
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+
+# project imports (Export, with its process pool, and Import are imported by their commands only to keep startup
+# fast)
+import Annotation
+
+# output formats by name (--format)
+FORMATS = {'png': '.png', 'tiff': '.tiff', 'npy': '.npy'}
+
+
+def open_annotation(filename, video=False):
+    """
+    :param filename: .atc annotation file
+    :param video: open the annotated video too (only for commands that need its frames or their size, so that the
+    others work on an annotation copied without its video)
+    :return: Annotation (without background video readers)
+    """
+    return Annotation.Annotation(filename, background_readers=False, video=video)
+
+
+def stats(args):
+    annotation = open_annotation(args.annotation)
+    try:
+        counts = annotation.class_counts()
+        num_frames = annotation.count_frames()
+    finally:
+        annotation.close()
+
+    print('{0:<20} {1:>10} {2:>12} {3:>12}'.format('class', 'objects', 'instances', 'final'))
+    for class_name, objects, instances, final in counts:
+        print('{0:<20} {1:>10d} {2:>12d} {3:>12d}'.format(str(class_name), objects, instances, final or 0))
+    print('{0:<20} {1:>10d} {2:>12d} {3:>12d}'.format('total', sum(c[1] for c in counts),
+                                                      sum(c[2] for c in counts), sum(c[3] or 0 for c in counts)))
+    print('annotated frames: {0:d}'.format(num_frames))
+    return 0
+
+
+def export(args):
+    import Export
+
+    annotation = open_annotation(args.annotation, video=True)
+    try:
+        job = Export.ExportJob(annotation, args.out_dir, args.prefix, FORMATS[args.format], first=args.first,
+                               last=args.last, workers=args.workers, classes=args.classes, ids=args.ids)
+        count = 0
+        for _ in job:
+            count += 1
+    finally:
+        annotation.close()
+
+    print('exported {0:d} frames to {1}'.format(count, args.out_dir))
+    return 0
+
+
+def labels(args):
+    import Export
+
+    # COCO lists the frames' size; MOT boxes need nothing of the video
+    annotation = open_annotation(args.annotation, video=Export.label_format(args.output) == 'coco')
+    try:
+        start = time.perf_counter()
+        count = Export.export_labels(annotation, args.output, first=args.first, last=args.last, classes=args.classes,
+                                     ids=args.ids)
+        elapsed = time.perf_counter() - start
+    finally:
+        annotation.close()
+
+    print('wrote {0:d} objects to {1} in {2:.1f} s'.format(count, args.output, elapsed))
+    return 0
+
+
+def import_(args):
+    import Import
+
+    class_map = {}
+    for mapping in args.map or []:
+        source, sep, target = mapping.partition('=')
+        if not sep or not source or not target:
+            raise ValueError('class mapping must be SOURCE=TARGET, got ' + mapping)
+        class_map[source] = target
+
+    annotation = open_annotation(args.annotation)
+    try:
+        start = time.perf_counter()
+        inserted, objects, skipped = Import.import_detections(
+            annotation, Import.read_detections(args.detections), class_map=class_map,
+            add_classes=not args.skip_unknown, final=args.final)
+        elapsed = time.perf_counter() - start
+    finally:
+        annotation.close()
+
+    print('imported {0:d} detections of {1:d} objects in {2:.1f} s ({3:.0f} rows/s); skipped {4:d}'.format(
+        inserted, objects, elapsed, inserted / elapsed if elapsed > 0 else 0, skipped))
+    return 0
+
+
+def transcode(args):
+    import FrameSource
+
+    output = args.output or os.path.splitext(args.video)[0] + FrameSource.RawVideoSource.SUFFIX
+    for annotation in args.annotation or []:
+        if not os.path.isfile(annotation):
+            raise Annotation.AnnotationFileError('no such annotation ' + annotation)
+
+    def progress(done, total):
+        if done % 100 == 0 or done == total:
+            print('\r{0:d} / {1:d} frames'.format(done, total), end='', file=sys.stderr, flush=True)
+
+    start = time.perf_counter()
+    count = FrameSource.transcode(args.video, output, progress=progress)
+    elapsed = time.perf_counter() - start
+    print(file=sys.stderr)
+
+    # read the annotations' frames from the container from now on
+    for annotation in args.annotation or []:
+        Annotation.Annotation.update_video_filename_in_annotation(annotation, os.path.abspath(output))
+
+    print('transcoded {0:d} frames to {1} ({2:.1f} GB) in {3:.1f} s'.format(
+        count, output, os.path.getsize(output) / 2 ** 30, elapsed))
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m AnnotationCLI', description='Headless annotation tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_stats = subparsers.add_parser('stats', help='print object counts per class')
+    parser_stats.add_argument('annotation', help='annotation file (.atc)')
+    parser_stats.set_defaults(func=stats)
+
+    parser_export = subparsers.add_parser('export', help='export frames to ID / color images')
+    parser_export.add_argument('annotation', help='annotation file (.atc)')
+    parser_export.add_argument('out_dir', help='output directory (must exist)')
+    parser_export.add_argument('--format', choices=sorted(FORMATS), default='tiff',
+                               help='png: color image, tiff: 16-bit ID image, npy: NumPy 32-bit ID array (default tiff)')
+    parser_export.add_argument('--prefix', default='', help='output filename prefix (frame number is appended)')
+    parser_export.add_argument('--first', type=int, default=1, help='first frame to export')
+    parser_export.add_argument('--last', type=int, default=None, help='last frame to export (default: last)')
+    parser_export.add_argument('--classes', nargs='+', default=None, help='export only these classes')
+    parser_export.add_argument('--ids', nargs='+', type=int, default=None, help='export only these object IDs')
+    parser_export.add_argument('--workers', type=int, default=None,
+                               help='number of worker processes (default: number of CPUs)')
+    parser_export.set_defaults(func=export)
+
+    parser_labels = subparsers.add_parser('labels', help='write objects to a COCO JSON (.json) or MOT CSV '
+                                                         '(.txt / .csv) label file')
+    parser_labels.add_argument('annotation', help='annotation file (.atc)')
+    parser_labels.add_argument('output', help='label file (.json: COCO polygons, .txt / .csv: MOT boxes by track)')
+    parser_labels.add_argument('--first', type=int, default=1, help='first frame to export')
+    parser_labels.add_argument('--last', type=int, default=None, help='last frame to export (default: last)')
+    parser_labels.add_argument('--classes', nargs='+', default=None, help='export only these classes')
+    parser_labels.add_argument('--ids', nargs='+', type=int, default=None, help='export only these object IDs')
+    parser_labels.set_defaults(func=labels)
+
+    parser_import = subparsers.add_parser('import', help='add detections (e.g. of an offline detector) as '
+                                                         'predictions')
+    parser_import.add_argument('annotation', help='annotation file (.atc)')
+    parser_import.add_argument('detections', help='detections file (.jsonl, .csv, .npy or .npz)')
+    parser_import.add_argument('--map', nargs='+', metavar='SOURCE=TARGET', default=None,
+                               help='rename detection classes to annotation classes')
+    parser_import.add_argument('--skip-unknown', action='store_true',
+                               help='skip detections of classes the annotation doesn\'t have (default: add them)')
+    parser_import.add_argument('--final', action='store_true', help='import as final objects, not predictions')
+    parser_import.set_defaults(func=import_)
+
+    parser_transcode = subparsers.add_parser('transcode', help='decode a video once into a raw (uncompressed, '
+                                                               'memory mapped) video container for fast browsing')
+    parser_transcode.add_argument('video', help='video or image sequence')
+    parser_transcode.add_argument('output', nargs='?', default=None,
+                                  help='container file (default: the video\'s name with suffix .frames)')
+    parser_transcode.add_argument('--annotation', nargs='+', default=None,
+                                  help='annotation files (.atc) of the video to switch to the container')
+    parser_transcode.set_defaults(func=transcode)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    try:
+        return args.func(args)
+    except (Annotation.AnnotationFileError, Annotation.VideoLoadError, Annotation.VideoLoadVideoNotFound,
+            ValueError, IOError) as e:
+        print('error: ' + str(e), file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,13 +3,17 @@ import sys
 import os
 import logging
 import pickle
+import operator
+import multiprocessing
 from PyQt5 import QtCore, QtGui, uic, QtWidgets
-import numpy as np
-import cv2
 
 # project imports
 import Annotation
 import AnnotationToolGS
+import Export
+import Colormap
+import Tracker
+import FrameTimer
 
 # remember last annotation tool was used for
 CURRENT_ANNOTATION_FILENAME = '.current.p'
@@ -20,6 +24,9 @@ LOG_FILENAME = 'annotation.log'
 # annotation tool version
 VERSION = '1.4.4'
 
+# time after the last zoom step before the background is redrawn at the new zoom's resolution
+REFINE_DELAY_MS = 150
+
 
 class FrameReadError(Exception):
     """ Exception class for video loading problems """
@@ -45,6 +52,24 @@ class AnnotationTool(QtWidgets.QMainWindow):
         # initialize scene
         self.scene = AnnotationToolGS.AnnotationScene(self)
 
+        #   display scene on graphicsView (canvas); its contents are updated in place on frame change
+        self.graphicsView.setScene(self.scene)
+
+        # frame shown in the background and the number of times it was halved for display (proxy, see
+        # AnnotationToolGS.proxy_level); refined to the view's zoom shortly after zooming in
+        self.background_frame = None
+        self.background_level = 0
+        self.refine_timer = QtCore.QTimer(self)
+        self.refine_timer.setSingleShot(True)
+        self.refine_timer.setInterval(REFINE_DELAY_MS)
+        self.refine_timer.timeout.connect(self.refine_background)
+
+        # per-stage timing of frame steps (shown in the status bar if enabled)
+        self.frame_timer = FrameTimer.FrameTimer()
+        self.timing_label = QtWidgets.QLabel()
+        self.timing_label.setVisible(False)
+        self.statusbar.addPermanentWidget(self.timing_label)
+
         # connect GUI parts
         self.connect_actions()
 
@@ -57,12 +82,17 @@ class AnnotationTool(QtWidgets.QMainWindow):
         # no annotation yet
         self.annotation = None
 
-        # which classes are hidden from gui
-        self.hidden_classes = set()
+        # which classes are hidden from gui (shared with scene)
+        self.hidden_classes = self.scene.hidden_classes
 
         # set slider minimum
         self.frameSlider.setMinimum(1)
 
+        # periodically commit changes kept by the annotation's write-behind
+        self.commit_timer = QtCore.QTimer(self)
+        self.commit_timer.timeout.connect(self.flush_annotation)
+        self.commit_timer.start(int(Annotation.Annotation.COMMIT_INTERVAL * 1000))
+
         # check if there is a previous annotation
         try:
             # attempt to read annotation currently in progress
@@ -82,6 +112,11 @@ class AnnotationTool(QtWidgets.QMainWindow):
         # update
         self.update()
 
+    def flush_annotation(self):
+        """ commit pending annotation changes (bounds what is lost on a crash) """
+        if self.annotation:
+            self.annotation.flush()
+
     def enable_gui(self, value):
         """ gray out GUI elements if no video loaded """
         self.classSelectionComboBox.setEnabled(value)
@@ -93,6 +128,7 @@ class AnnotationTool(QtWidgets.QMainWindow):
         self.actionUndo.setEnabled(value)
         self.actionRedo.setEnabled(value)
         self.actionSaveAs.setEnabled(value)
+        self.actionPropagate.setEnabled(value)
 
     def populate_class_combobox(self, classes_list):
         """ populate comboBox with classes
@@ -146,6 +182,10 @@ class AnnotationTool(QtWidgets.QMainWindow):
         # slider moved
         self.frameSlider.valueChanged.connect(self.frame_slider_update)
 
+        # while dragging the slider show thumbnails; the frame is read on release
+        self.frameSlider.sliderMoved.connect(self.frame_slider_preview)
+        self.frameSlider.sliderReleased.connect(self.scene.hide_preview)
+
         # 'User Guide' menu action
         self.actionAbout.triggered.connect(self.user_guide_event)
 
@@ -170,6 +210,36 @@ class AnnotationTool(QtWidgets.QMainWindow):
         # hide class
         self.checkBoxHide.stateChanged.connect(self.hide_checkbox_value)
 
+        # propagate objects forward
+        self.actionPropagate = self.menuTools.addAction('Propagate Forward...')
+        self.actionPropagate.setShortcut(QtGui.QKeySequence('Ctrl+P'))
+        self.actionPropagate.triggered.connect(self.propagate)
+
+        # tracker backend selection (one checkable action per backend)
+        tracker_menu = self.menuTools.addMenu('Tracker')
+        tracker_group = QtWidgets.QActionGroup(self)
+        for backend in sorted(Tracker.BACKENDS):
+            action = tracker_menu.addAction(backend.replace('_', ' ').capitalize())
+            action.setCheckable(True)
+            action.setChecked(backend == self.scene.tracker_backend)
+            action.setActionGroup(tracker_group)
+            action.triggered.connect(lambda checked, b=backend: self.scene.set_tracker_backend(b))
+
+        # show frames downscaled to the view's zoom (full resolution from 1:1 zoom)
+        self.menuTools.addSeparator()
+        self.actionProxy = self.menuTools.addAction('Downscale Display to Zoom')
+        self.actionProxy.setCheckable(True)
+        self.actionProxy.setChecked(True)
+        self.actionProxy.toggled.connect(lambda checked: self.refine_background(force=True))
+
+        # frame step timing: status bar overlay and dump
+        self.menuTools.addSeparator()
+        self.actionShowTiming = self.menuTools.addAction('Show Frame Timing')
+        self.actionShowTiming.setCheckable(True)
+        self.actionShowTiming.toggled.connect(self.timing_label.setVisible)
+        self.actionSaveTiming = self.menuTools.addAction('Save Frame Timing...')
+        self.actionSaveTiming.triggered.connect(self.save_timing)
+
     def hide_checkbox_value(self, val):
 
         # get the selected class from class list combo box
@@ -231,7 +301,7 @@ class AnnotationTool(QtWidgets.QMainWindow):
     def open_file(self, file_type, filename=None):
 
         title = 'Open Video / Images' if file_type == 'video' else 'Open Annotation'
-        file_types = "Video Files (*.avi *.mp4);; Images Files (*.jpg *.bmp *.tif *.tiff *.png)" \
+        file_types = "Video Files (*.avi *.mp4 *.frames);; Images Files (*.jpg *.jpeg *.bmp *.tif *.tiff *.png *.npy)" \
                      if file_type == 'video' else 'Annotation File (*.atc)'
 
         # if working on unsaved annotation
@@ -261,7 +331,13 @@ class AnnotationTool(QtWidgets.QMainWindow):
                 return
         try:
             # open annotation
-            self.annotation = Annotation.Annotation(filename)
+            annotation = Annotation.Annotation(filename)
+
+            # release previous annotation (writes its pending changes)
+            if self.annotation:
+                self.scene.stop_jobs()
+                self.annotation.close()
+            self.annotation = annotation
 
             # Connect scene to annotation
             self.scene.set_annotation(self.annotation)
@@ -316,7 +392,7 @@ class AnnotationTool(QtWidgets.QMainWindow):
 
     def provide_video_location(self):
         title = 'Open Video / Images'
-        file_types = "Video Files (*.avi *.mp4);; Images Files (*.jpg *.bmp *.tif *.tiff *.png)"
+        file_types = "Video Files (*.avi *.mp4 *.frames);; Images Files (*.jpg *.jpeg *.bmp *.tif *.tiff *.png *.npy)"
 
         # open file (the 'str' - some versions of pyqt return a QString instead of a normal string)
         filename = str(QtWidgets.QFileDialog.getOpenFileName(QtWidgets.QFileDialog(),
@@ -359,6 +435,19 @@ class AnnotationTool(QtWidgets.QMainWindow):
         # update
         self.update()
 
+    def frame_slider_preview(self, frame_number):
+        """ slider dragged: show the frame's thumbnail (if already decoded) instead of reading the frame
+        :param frame_number: frame the slider is at
+        :return:
+        """
+        self.frameEdit.setText(str(frame_number))
+
+        thumbnail = self.annotation.get_thumbnail(frame_number)
+        if thumbnail is not None:
+            self.scene.show_preview(thumbnail)
+        else:
+            self.scene.hide_preview()
+
     def frame_edit_update(self):
         """ update based on frame edit-box change """
 
@@ -396,6 +485,9 @@ class AnnotationTool(QtWidgets.QMainWindow):
         # change zoom
         self.graphicsView.scale(factor, factor)
 
+        # show the frame in more detail once zooming stops
+        self.refine_timer.start()
+
     def keyPressEvent(self, event):
 
         # do nothing if not active yet
@@ -409,6 +501,10 @@ class AnnotationTool(QtWidgets.QMainWindow):
 
         # move forward one frame
         elif event.key() == QtCore.Qt.Key_Right and self.annotation.current_frame < self.annotation.num_frames:
+            # carry objects not touched in this frame forward (in the background)
+            with self.frame_timer.stage('track'):
+                self.scene.track()
+
             self.annotation.set_frame(self.annotation.current_frame + 1)
             self.update()
 
@@ -431,8 +527,12 @@ class AnnotationTool(QtWidgets.QMainWindow):
         if self.annotation is None:
             return
 
+        timer = self.frame_timer
+        timer.begin()
+
         try:
-            frame = self.annotation.get_frame_image()
+            with timer.stage('read'):
+                frame = self.annotation.get_frame_image()
         except Annotation.VideoLoadError as e:
             # message box
             msgBox = QtWidgets.QMessageBox()
@@ -454,30 +554,61 @@ class AnnotationTool(QtWidgets.QMainWindow):
             self.frameSlider.blockSignals(False)
             self.frameEdit.blockSignals(False)
 
-            # deal with opencv's BGR abomination; create Qt image (width, height)
-            image = QtGui.QImage(frame.tostring(), frame.shape[1], frame.shape[0],
-                                 QtGui.QImage.Format_RGB888).rgbSwapped()
-
-            # clear scene from previous drawn elements
-            self.scene.clear()
+            if max(frame.shape[:2]) > AnnotationToolGS.TILED_FRAME_SIZE:
+                # very large frame: only the tiles in view are made, each at the view's zoom, when painted
+                with timer.stage('background'):
+                    self.scene.set_tiled_background(frame)
+                self.background_frame = None
+                self.background_level = 0
+            else:
+                # frame downscaled to the view's zoom
+                with timer.stage('convert'):
+                    level = self.display_level()
+                    shown = AnnotationToolGS.downscale(frame, level)
 
-            # load image to scene (set as background)
-            self.scene.set_background(image)
+                # replace background image in place (scaled to the frame's size)
+                with timer.stage('background'):
+                    self.scene.set_background(shown, (frame.shape[1], frame.shape[0]))
+                self.background_frame = frame
+                self.background_level = level
 
             # all annotations in frame
-            frame_annotations = self.annotation.get(self.annotation.current_frame)
+            with timer.stage('query'):
+                frame_annotations = self.annotation.get(self.annotation.current_frame)
 
             # 'discard' the annotation of hidden classes
             filtered_annotations = [a for a in frame_annotations if a[2] not in self.hidden_classes]
 
-            # load objects for current frame
-            self.scene.load(self.annotation.current_frame, filtered_annotations)
+            # load objects for current frame (items of objects that persist are reused)
+            with timer.stage('load'):
+                self.scene.load(self.annotation.current_frame, filtered_annotations)
 
-            #   display image on graphicsView (canvas)
-            self.graphicsView.setScene(self.scene)
+        timer.end(self.annotation.current_frame)
+        if self.actionShowTiming.isChecked():
+            self.timing_label.setText(timer.status())
 
-            #   set graphics view to scene
-            self.graphicsView.show()
+    def display_level(self):
+        """
+        :return: number of times to halve frames for display at the view's zoom (0: full resolution)
+        """
+        if not self.actionProxy.isChecked():
+            return 0
+        return AnnotationToolGS.proxy_level(self.graphicsView.transform().m11())
+
+    def refine_background(self, force=False):
+        """ redraw the background at the view's zoom if it needs more detail than shown (zooming out keeps the more
+        detailed background until the next frame)
+        :param force: redraw whenever the zoom's level differs from the shown one
+        :return:
+        """
+        if self.background_frame is None:
+            return
+
+        level = self.display_level()
+        if level < self.background_level or (force and level != self.background_level):
+            frame = self.background_frame
+            self.scene.set_background(AnnotationToolGS.downscale(frame, level), (frame.shape[1], frame.shape[0]))
+            self.background_level = level
 
     def closeEvent(self, event=None):
         """ overloaded closeEvent to allow quitting by closing window.
@@ -495,7 +626,13 @@ class AnnotationTool(QtWidgets.QMainWindow):
                 event.ignore()
                 return
 
-            # save session details
+        # keep frame step timing in the log
+        if self.frame_timer.steps:
+            self.frame_timer.log()
+
+        # save session details
+        if self.annotation:
+            self.scene.stop_jobs()
             self.annotation.exit()
 
         # Qt quit
@@ -513,11 +650,10 @@ class AnnotationTool(QtWidgets.QMainWindow):
 
     def export(self):
         # TODO: frames selection...
-        frames = list(range(1, self.annotation.num_frames + 1))
-
         filename = str(QtWidgets.QFileDialog.getSaveFileName(QtWidgets.QFileDialog(), "Save as...",
                                                              QtCore.QDir.currentPath(),
-                                                             "color png (*.png);;16-bit ID image(*.tiff)")[0])
+                                                             "color png (*.png);;16-bit ID image(*.tiff);;"
+                                                             "COCO JSON (*.json);;MOT CSV (*.txt)")[0])
         if not filename:
             return
 
@@ -525,84 +661,77 @@ class AnnotationTool(QtWidgets.QMainWindow):
         dirname = os.path.dirname(filename)
         split_filename = os.path.splitext(os.path.basename(str(filename)))
         filename = split_filename[0]
-
-        colormap = self.scene.colormap
-        inverse_colormap = self.scene.inverse_colormap
         suffix = split_filename[1]
 
-        # draw all requested frames
-        for f in progress(frames, 'Export Progress', 'Abort'):
-            # current frame number
-            # f = frames[i]
-
-            #   initialize image
-            qt_image = QtGui.QImage(self.scene.width(), self.scene.height(), QtGui.QImage.Format_RGB888)
-            qt_image.fill(0)
-
-            #   fetch all objects for current frame
-            records = self.annotation.get(f)
-
-            #   list holding colors in current frame
-            frame_colors = []
-
-            #   draw all objects
-            for r in records:
-                #   initialize image
-                #   Note: 24-bit RGB is extremely wasteful. we actually have 1-channel binary
-                #   This is due to the difficulty in converting qt to opencv images
-
-                #   painter
-                painter = QtGui.QPainter(qt_image)
-
-                #   current contour "points"
-                points = [int(s) for s in r[3].split()]
-
-                #   extract (x, y) couples from list of points
-                points = list(zip(points[::2], points[1::2]))
-
-                #   create list of Qt.QPointF from (x, y) lists
-                points = [QtCore.QPoint(*p) for p in points]
-
-                #   create contour
-                contour = QtGui.QPolygon(points)
+        try:
+            # label files: a single pass over the database
+            if suffix in Export.LABEL_SUFFIXES:
+                QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+                try:
+                    Export.export_labels(self.annotation, os.path.join(dirname, filename + suffix))
+                finally:
+                    QtWidgets.QApplication.restoreOverrideCursor()
+                return
 
-                #   paint
-                rgb = colormap[:, r[1]]
+            # frames are rendered by worker processes and written in order (frames without objects are skipped)
+            job = Export.ExportJob(self.annotation, dirname, filename, suffix)
 
-                #   record color
-                frame_colors.append(rgb)
+            # report progress as frames are written; 'Abort' stops the job
+            for _ in progress(job, 'Export Progress', 'Abort'):
+                pass
 
-                # set pen
-                color = QtGui.QColor(int(rgb[0]), int(rgb[1]), int(rgb[2]))
-                painter.setPen(QtGui.QPen(color, 2, QtCore.Qt.SolidLine))
-                painter.setBrush(color)
-                painter.drawPolygon(contour)
+        except (ValueError, IOError) as e:
+            msg_box = QtWidgets.QMessageBox()
+            msg_box.setText('Export failed: ' + str(e))
+            msg_box.exec_()
 
-                del painter
+    def save_timing(self):
+        """ write per-stage times of the recent frame steps to a CSV file (and their summary to the log) """
+        filename = str(QtWidgets.QFileDialog.getSaveFileName(self, 'Save Frame Timing', QtCore.QDir.currentPath(),
+                                                             'CSV files (*.csv)')[0])
+        if not filename:
+            return
 
-            #   if no objects in frame, don't save it
-            if len(frame_colors) == 0:
-                continue
+        self.frame_timer.log()
+        try:
+            self.frame_timer.write_csv(filename)
+        except IOError as e:
+            msg_box = QtWidgets.QMessageBox()
+            msg_box.setText('Saving frame timing failed: ' + str(e))
+            msg_box.exec_()
 
-            if '.tiff' == suffix:
-                #   convert qimage to opencv
-                cv_image = qimage2cv(qt_image)
+    def propagate(self):
+        """ track selected objects (all objects of frame if none selected) forward over a number of frames in the
+        background """
+        if self.scene.propagate_job is not None:
+            msg_box = QtWidgets.QMessageBox()
+            msg_box.setText('Propagation is already running')
+            msg_box.exec_()
+            return
 
-                #   initialize 16-bit result
-                result = np.zeros((self.scene.height(), self.scene.width()), dtype=np.uint16)
+        first = self.annotation.current_frame
+        remaining = self.annotation.num_frames - first
+        if remaining < 1:
+            return
 
-                #   iterate over all colors
-                for c in frame_colors:
-                    #   find all places with current color
-                    mask = cv2.inRange(cv_image, c, c) / 255
+        num_frames, ok = QtWidgets.QInputDialog.getInt(self, 'Propagate Forward', 'Number of frames:',
+                                                       min(100, remaining), 1, remaining)
+        if not ok:
+            return
 
-                    #   set pixels in ID image
-                    result += inverse_colormap[tuple(c)] * mask
+        selected = [self.scene.contour2obj[c][0] for c in self.scene.selectedItems() if c in self.scene.contour2obj]
+        job = self.scene.propagate(num_frames, selected or None)
+        if job is None:
+            return
 
-                    #   write to disk
-                    cv2.imwrite(dirname + '/' + filename + str(f) + '.tiff', result)
-            else:
-                qt_image.save(dirname + '/' + filename + str(f) + '.png')
+        # non-modal progress (annotating can go on meanwhile); 'Cancel' stops the propagation
+        self.propagate_dialog = QtWidgets.QProgressDialog('Propagating objects...', 'Cancel', first,
+                                                          first + num_frames, self)
+        self.propagate_dialog.setWindowModality(QtCore.Qt.NonModal)
+        self.propagate_dialog.canceled.connect(job.cancel)
+        job.progressed.connect(self.propagate_dialog.setValue)
+        job.finished.connect(self.propagate_dialog.reset)
+        self.propagate_dialog.show()
 
     def combine_objects(self):
 
@@ -629,13 +758,13 @@ class AnnotationTool(QtWidgets.QMainWindow):
                     record = record[0]
 
                     # the 'To ID' color in scene
-                    color = self.scene.get_color(self.scene.colormap[:, dialog_text_browser.target_id])
+                    color = self.scene.get_color(Colormap.color(dialog_text_browser.target_id))
 
                     # remove old contour
                     self.scene.remove_contour(record[1])
 
                     # add new contour
-                    self.scene.add_contour([int(s) for s in record[3].split()], record[1], record[2], record[4], color)
+                    self.scene.add_contour(Annotation.decode_contour(record[3]), record[1], record[2], record[4], color)
 
     def load_classes(self):
         """
@@ -685,6 +814,7 @@ class AnnotationTool(QtWidgets.QMainWindow):
 
         # zoom out very little
         self.graphicsView.scale(0.5, 0.5)
+        self.refine_timer.start()
 
     def find_annotations(self):
 
@@ -933,32 +1063,28 @@ class CombineObjectsDialog(QtWidgets.QDialog):
         self.close()
 
 
-def qimage2cv(qt_image):
-    """  Converts a QImage into an opencv MAT format  """
-
-    width = qt_image.width()
-    height = qt_image.height()
-
-    ptr = qt_image.bits()
-    ptr.setsize(qt_image.byteCount())
-    arr = np.array(ptr).reshape(height, width, 3)
-    return arr
-
-
 def progress(data, *args):
+    widget = QtWidgets.QProgressDialog(*args + (0, operator.length_hint(data)))
     it = iter(data)
-    widget = QtWidgets.QProgressDialog(*args + (0, it.__length_hint__()))
     c = 0
-    for v in it:
-        QtCore.QCoreApplication.instance().processEvents()
-        if widget.wasCanceled():
-            raise StopIteration
-        c += 1
-        widget.setValue(c)
-        yield (v)
+    try:
+        for v in it:
+            QtCore.QCoreApplication.instance().processEvents()
+            if widget.wasCanceled():
+                return
+            c += 1
+            widget.setValue(c)
+            yield (v)
+    finally:
+        # stop the underlying job (if it is a generator) on cancel
+        if hasattr(it, 'close'):
+            it.close()
 
 
 if __name__ == "__main__":
+    # export worker processes of a frozen executable
+    multiprocessing.freeze_support()
+
     # initialize logger
     logging.basicConfig(filename=LOG_FILENAME, level=logging.INFO, filemode='w')
     logging.info('start application.')
@@ -1,6 +1,13 @@
+import Annotation
+import Colormap
 import Tracker
+import FrameSource
+import sys
 import numpy as np
+import cv2
 import weakref
+import threading
+import collections
 
 from itertools import chain
 from PyQt5 import QtCore, QtGui, QtWidgets
@@ -10,6 +17,161 @@ TRANSPARENCY = 150
 MODIFY_TRANSPARENCY = 0.3  # visual cure for modification
 UNDO_LIMIT = 20
 
+# Qt's native 32-bit pixel (0xffRRGGBB) is stored as bytes B, G, R, 255 on little-endian machines: opencv's BGRA
+NATIVE_BGRA = sys.byteorder == 'little'
+
+# frames are shown downscaled by at most 2 ** MAX_PROXY_LEVEL (see proxy_level)
+MAX_PROXY_LEVEL = 4
+
+# frames larger than this (width or height) are drawn in tiles (see TiledBackground)
+TILED_FRAME_SIZE = 8192
+
+# tiled background: tile size (pixels of its pyramid level), coarsest level and tile cache size (megabytes)
+TILE_SIZE = 512
+MAX_TILE_LEVEL = 10
+TILE_CACHE_MB = 128
+
+
+def frame_to_qimage(frame, out=None):
+    """ convert a video frame to a QImage with a single cv2.cvtColor into Qt's native 32-bit layout, so that
+    QPixmap.fromImage shares the pixels instead of converting them (wrapping the BGR frame as Format_BGR888 would
+    leave the conversion to QPixmap.fromImage, which is slower). QImage doesn't own (or reference) the buffer it
+    wraps: the array is attached to the image (image.ndarray) and must be kept as long as the image, or a pixmap
+    made from it, is in use
+    :param frame: BGR or grayscale image (numpy array)
+    :param out: array to convert into, e.g. the previous frame's image.ndarray, so that frames of the same size
+    don't allocate a buffer each. images and pixmaps made from out show the new pixels at once: only reuse the array
+    of a shown pixmap to replace that pixmap right away, on the GUI thread (see AnnotationScene.shown_image). None,
+    or of another size: a new one
+    :return: QImage
+    """
+    height, width = frame.shape[:2]
+
+    if NATIVE_BGRA:
+        data = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGRA if frame.ndim == 2 else cv2.COLOR_BGR2BGRA, dst=out)
+        image_format = QtGui.QImage.Format_RGB32
+    else:
+        data = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB if frame.ndim == 2 else cv2.COLOR_BGR2RGB, dst=out)
+        image_format = QtGui.QImage.Format_RGB888
+
+    image = QtGui.QImage(data.data, width, height, data.strides[0], image_format)
+    image.ndarray = data
+    return image
+
+
+def proxy_level(scale, max_level=MAX_PROXY_LEVEL):
+    """
+    :param scale: view scale (screen pixels per frame pixel)
+    :param max_level: maximal number of halvings
+    :return: number of times a frame can be halved for display at scale without losing displayed detail (the
+    halved frame still has at least one pixel per screen pixel)
+    """
+    level = 0
+    while level < max_level and scale * 2 ** (level + 1) <= 1:
+        level += 1
+    return level
+
+
+def downscale(frame, level):
+    """ halve a frame level times, averaging 2 x 2 pixels (repeated halving is several times faster than a single
+    cv2.INTER_AREA resize by 2 ** level)
+    :param frame: image (numpy array)
+    :param level: number of halvings
+    :return: downscaled image (frame itself if level is 0)
+    """
+    for _ in range(level):
+        height, width = frame.shape[:2]
+        if height < 2 or width < 2:
+            break
+        frame = cv2.resize(frame, ((width + 1) // 2, (height + 1) // 2), interpolation=cv2.INTER_AREA)
+    return frame
+
+
+class TiledBackground(QtWidgets.QGraphicsItem):
+    """ background of very large frames (e.g. gigapixel stills), drawn in tiles: only the tiles in view are made, at
+    the pyramid level the view's zoom needs (level L is the frame halved L times, see proxy_level), and kept in a
+    cache of bounded size. a tile never reads more than (2 x TILE_SIZE) ** 2 pixels of the frame, so with a memory
+    mapped frame (e.g. of a raw video container, see FrameSource) the memory used does not depend on the frame's
+    size """
+
+    def __init__(self, frame, cache_mb=TILE_CACHE_MB, parent=None):
+        """
+        :param frame: BGR or grayscale image (numpy array, possibly memory mapped)
+        :param cache_mb: maximal size of cached tiles in megabytes
+        :param parent:
+        :return:
+        """
+        super(TiledBackground, self).__init__(parent)
+        self.frame = None
+        self.max_bytes = int(cache_mb * 2 ** 20)
+
+        # (level, column, row) -> (pixmap, its pixels), least recently used first
+        self.tiles = collections.OrderedDict()
+        self.tile_bytes = 0
+
+        # paint only the exposed part of the item
+        self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption, True)
+        self.set_frame(frame)
+
+    def set_frame(self, frame):
+        """
+        :param frame: new frame to show (cached tiles are dropped)
+        :return:
+        """
+        if self.frame is None or self.frame.shape[:2] != frame.shape[:2]:
+            self.prepareGeometryChange()
+        self.frame = frame
+        self.tiles.clear()
+        self.tile_bytes = 0
+        self.update()
+
+    def boundingRect(self):
+        height, width = self.frame.shape[:2]
+        return QtCore.QRectF(0, 0, width, height)
+
+    def tile(self, level, column, row):
+        """
+        :return: (pixmap of tile of level, its rectangle in frame pixels)
+        """
+        size = TILE_SIZE << level
+        height, width = self.frame.shape[:2]
+        x0, y0 = column * size, row * size
+        x1, y1 = min(x0 + size, width), min(y0 + size, height)
+        rect = QtCore.QRectF(x0, y0, x1 - x0, y1 - y0)
+
+        key = (level, column, row)
+        cached = self.tiles.get(key)
+        if cached is not None:
+            self.tiles.move_to_end(key)
+            return cached[0], rect
+
+        # every 2 ** (level - 1)-th pixel, averaged 2 x 2: reads at most (2 x TILE_SIZE) ** 2 pixels at any level
+        step = 2 ** max(level - 1, 0)
+        pixels = downscale(np.ascontiguousarray(self.frame[y0:y1:step, x0:x1:step]), min(level, 1))
+        image = frame_to_qimage(pixels)
+        pixmap = QtGui.QPixmap.fromImage(image)
+        self.tiles[key] = (pixmap, image.ndarray)
+        self.tile_bytes += image.ndarray.nbytes
+        while self.tile_bytes > self.max_bytes and len(self.tiles) > 1:
+            _, (_, evicted) = self.tiles.popitem(last=False)
+            self.tile_bytes -= evicted.nbytes
+        return pixmap, rect
+
+    def paint(self, painter, option, widget=None):
+        scale = QtWidgets.QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        level = proxy_level(scale, MAX_TILE_LEVEL)
+        size = TILE_SIZE << level
+
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        if exposed.isEmpty():
+            return
+        columns = range(int(exposed.left()) // size, int(np.ceil(exposed.right() / size)))
+        rows = range(int(exposed.top()) // size, int(np.ceil(exposed.bottom() / size)))
+        for row in rows:
+            for column in columns:
+                pixmap, rect = self.tile(level, column, row)
+                painter.drawPixmap(rect, pixmap, QtCore.QRectF(pixmap.rect()))
+
 
 class AddCommand(QtWidgets.QUndoCommand):
     """ add new object to scene and DB """
@@ -28,27 +190,29 @@ class AddCommand(QtWidgets.QUndoCommand):
         self.contour = None
 
     def redo(self):
-        # add to database
-        self.annotation.add(self.frame_number, self.obj_id, self.class_name, self.points, True)
+        with self.annotation.transaction():
+            # add to database
+            self.annotation.add(self.frame_number, self.obj_id, self.class_name, self.points, True)
 
-        # prediction for next frame will be identical since this is first frame for object
-        self.annotation.add(self.frame_number + 1, self.obj_id, self.class_name,
-                            self.annotation_scene.tracker.track(self.points, self.frame_number, self.obj_id),
-                            False)
+            # predict object in next frame
+            self.annotation.add(self.frame_number + 1, self.obj_id, self.class_name,
+                                self.annotation_scene.tracker.track(self.points, self.frame_number, self.obj_id),
+                                False)
 
-        # draw contour
-        self.contour = self.annotation_scene.add_contour(self.points, self.obj_id, self.class_name, True)
+            # draw contour
+            self.contour = self.annotation_scene.add_contour(self.points, self.obj_id, self.class_name, True)
 
     def undo(self):
-        # remove graphics item (notice this is not necessarily the same 'physical'
-        # graphics item as the 'redo' one since MoveCommands might have been made)
-        self.annotation_scene.removeItem(self.annotation_scene.obj2contour[self.obj_id])
+        with self.annotation.transaction():
+            # remove graphics item (notice this is not necessarily the same 'physical'
+            # graphics item as the 'redo' one since MoveCommands might have been made)
+            self.annotation_scene.remove_contour(self.obj_id)
 
-        # remove from DB
-        self.annotation.remove(self.obj_id, self.frame_number)
+            # remove from DB
+            self.annotation.remove(self.obj_id, self.frame_number)
 
-        # remove prediction from DB
-        self.annotation.remove(self.obj_id, self.frame_number + 1)
+            # remove prediction from DB
+            self.annotation.remove(self.obj_id, self.frame_number + 1)
 
 
 class DeleteCommand(QtWidgets.QUndoCommand):
@@ -64,12 +228,12 @@ class DeleteCommand(QtWidgets.QUndoCommand):
 
         # save position for undo
         record = self.annotation.get(self.frame_number, self.obj_id)
-        self.points = [int(s) for s in record[0][3].split()]
+        self.points = Annotation.decode_contour(record[0][3])
 
         # save old prediction for undo
         old_pred = self.annotation.get(self.frame_number + 1, self.obj_id)
         if old_pred:
-            self.old_pred_points = [int(s) for s in old_pred[0][3].split()]
+            self.old_pred_points = Annotation.decode_contour(old_pred[0][3])
 
             # has the user actively confirmed the object in next frame
             self.final_in_next_frame = old_pred[0][4]
@@ -78,43 +242,46 @@ class DeleteCommand(QtWidgets.QUndoCommand):
             self.final_in_next_frame = None
 
     def redo(self):
-        # remove contour
-        self.annotation_scene.remove_contour(self.obj_id)
+        with self.annotation.transaction():
+            # remove contour
+            self.annotation_scene.remove_contour(self.obj_id)
 
-        # remove from DB
-        self.annotation.remove(self.obj_id, self.frame_number)
+            # remove from DB
+            self.annotation.remove(self.obj_id, self.frame_number)
 
-        # remove prediction from DB if not finalized by user
-        if not self.final_in_next_frame:
-            self.annotation.remove(self.obj_id, self.frame_number + 1)
+            # remove prediction from DB if not finalized by user
+            if not self.final_in_next_frame:
+                self.annotation.remove(self.obj_id, self.frame_number + 1)
 
     def undo(self):
-        # redraw contour
-        self.annotation_scene.add_contour(self.points, self.obj_id, self.class_name, True)
-
-        # restore data
-        self.annotation.add(self.frame_number, self.obj_id, self.class_name, self.points, True)
+        with self.annotation.transaction():
+            # redraw contour
+            self.annotation_scene.add_contour(self.points, self.obj_id, self.class_name, True)
+
+            # restore data
+            self.annotation.add(self.frame_number, self.obj_id, self.class_name, self.points, True)
+
+            # if the object that was deleted and then returned doesn't exist in other frame, need to allocate ID
+            id_frames = self.annotation.get_frames_indexes_of_id(self.obj_id)
+            id_frames.remove(self.frame_number)
+
+            # attempt to track object in next frame
+            next_frame_record = self.annotation.get(self.frame_number + 1, self.obj_id)
+            if len(next_frame_record) > 0:
+                #   check if what we have in _annotation is a prediction or already a user-finalized object
+                finalized = next_frame_record[0][4]
+            else:
+                # if no prediction exists, object is trivially not finalized
+                finalized = False
 
-        # if the object that was deleted and then returned doesn't exist in other frame, need to allocate ID
-        id_frames = self.annotation.get_frames_indexes_of_id(self.obj_id)
-        id_frames.remove(self.frame_number)
+            if not finalized:
+                #   remove prediction (to be replaced with new moved object prediction)
+                self.annotation.remove(self.obj_id, self.frame_number + 1)
 
-        # attempt to track object in next frame
-        next_frame_record = self.annotation.get(self.frame_number + 1, self.obj_id)
-        if len(next_frame_record) > 0:
-            #   check if what we have in _annotation is a prediction or already a user-finalized object
-            finalized = next_frame_record[0][4]
-        else:
-            # if no prediction exists, object is trivially not finalized
-            finalized = False
-
-        if not finalized:
-            #   remove prediction (to be replaced with new moved object prediction)
-            self.annotation.remove(self.obj_id, self.frame_number + 1)
-
-            # add prediction in next frame at tracker generated location (non-final)
-            self.annotation.add(self.frame_number + 1, self.obj_id, self.class_name,
-                                self.annotation_scene.tracker.track(self.points, self.frame_number, self.obj_id), False)
+                # add prediction in next frame at tracker generated location (non-final)
+                self.annotation.add(self.frame_number + 1, self.obj_id, self.class_name,
+                                    self.annotation_scene.tracker.track(self.points, self.frame_number, self.obj_id),
+                                    False)
 
 
 class ModifyCommand(QtWidgets.QUndoCommand):
@@ -133,12 +300,12 @@ class ModifyCommand(QtWidgets.QUndoCommand):
 
         # save old position for undo
         old = self.annotation.get(self.frame_number, self.obj_id)
-        self.old_points = [int(s) for s in old[0][3].split()]
+        self.old_points = Annotation.decode_contour(old[0][3])
 
         # save old prediction for undo
         old_pred = self.annotation.get(self.frame_number + 1, self.obj_id)
         if old_pred:
-            self.old_pred_points = [int(s) for s in old_pred[0][3].split()]
+            self.old_pred_points = Annotation.decode_contour(old_pred[0][3])
 
             # has the user actively confirmed the object in next frame
             self.final_in_next_frame = old_pred[0][4]
@@ -147,57 +314,60 @@ class ModifyCommand(QtWidgets.QUndoCommand):
             self.final_in_next_frame = None
 
     def redo(self):
-        # remove contour
-        self.annotation_scene.removeItem(self.annotation_scene.obj2contour[self.obj_id])
+        with self.annotation.transaction():
+            # remove contour
+            self.annotation_scene.remove_contour(self.obj_id)
 
-        # remove from DB
-        self.annotation.remove(self.obj_id, self.frame_number)
+            # remove from DB
+            self.annotation.remove(self.obj_id, self.frame_number)
 
-        # add new contour
-        self.annotation_scene.add_contour(self.points, self.obj_id, self.class_name, True)
+            # add new contour
+            self.annotation_scene.add_contour(self.points, self.obj_id, self.class_name, True)
 
-        # add new data
-        self.annotation.add(self.frame_number, self.obj_id, self.class_name, self.points, True)
+            # add new data
+            self.annotation.add(self.frame_number, self.obj_id, self.class_name, self.points, True)
 
-        # attempt to track object in next frame
-        next_frame_record = self.annotation.get(self.frame_number + 1, self.obj_id)
-        if len(next_frame_record) > 0:
-            #   check if what we have in _annotation is a prediction or already a user-finalized object
-            finalized = next_frame_record[0][4]
-        else:
-            # if no prediction exists, object is trivially not finalized
-            finalized = False
+            # attempt to track object in next frame
+            next_frame_record = self.annotation.get(self.frame_number + 1, self.obj_id)
+            if len(next_frame_record) > 0:
+                #   check if what we have in _annotation is a prediction or already a user-finalized object
+                finalized = next_frame_record[0][4]
+            else:
+                # if no prediction exists, object is trivially not finalized
+                finalized = False
 
-        if not finalized:
-            #   remove prediction (to be replaced with new moved object prediction)
-            self.annotation.remove(self.obj_id, self.frame_number + 1)
+            if not finalized:
+                #   remove prediction (to be replaced with new moved object prediction)
+                self.annotation.remove(self.obj_id, self.frame_number + 1)
 
-            # add prediction in next frame at tracker generated location (non-final)
-            self.annotation.add(self.frame_number + 1, self.obj_id, self.class_name,
-                                self.annotation_scene.tracker.track(self.points, self.frame_number, self.obj_id), False)
+                # add prediction in next frame at tracker generated location (non-final)
+                self.annotation.add(self.frame_number + 1, self.obj_id, self.class_name,
+                                    self.annotation_scene.tracker.track(self.points, self.frame_number, self.obj_id),
+                                    False)
 
     def undo(self):
-        # remove from DB
-        self.annotation.remove(self.obj_id, self.frame_number)
+        with self.annotation.transaction():
+            # remove from DB
+            self.annotation.remove(self.obj_id, self.frame_number)
 
-        # remove contour
-        self.annotation_scene.removeItem(self.annotation_scene.obj2contour[self.obj_id])
+            # remove contour
+            self.annotation_scene.remove_contour(self.obj_id)
 
-        # move contour to old
-        self.annotation_scene.add_contour(self.old_points, self.obj_id, self.class_name, True)
+            # move contour to old
+            self.annotation_scene.add_contour(self.old_points, self.obj_id, self.class_name, True)
 
-        # restore data
-        self.annotation.add(self.frame_number, self.obj_id, self.class_name, self.old_points, True)
+            # restore data
+            self.annotation.add(self.frame_number, self.obj_id, self.class_name, self.old_points, True)
 
-        # undo prediction if user hasn't finalized object in next frame
-        if not self.final_in_next_frame:
-            # remove existing prediction if exists
-            self.annotation.remove(self.obj_id, self.frame_number + 1)
+            # undo prediction if user hasn't finalized object in next frame
+            if not self.final_in_next_frame:
+                # remove existing prediction if exists
+                self.annotation.remove(self.obj_id, self.frame_number + 1)
 
-            # if there is an "old" prediction, restore it
-            if self.old_pred_points:
-                self.annotation.add(self.frame_number + 1, self.obj_id, self.class_name,
-                                    self.old_pred_points, False)
+                # if there is an "old" prediction, restore it
+                if self.old_pred_points is not None:
+                    self.annotation.add(self.frame_number + 1, self.obj_id, self.class_name,
+                                        self.old_pred_points, False)
 
 
 class MoveCommand(QtWidgets.QUndoCommand):
@@ -224,12 +394,12 @@ class MoveCommand(QtWidgets.QUndoCommand):
 
         # save old position for undo
         old = self.annotation.get(self.frame_number, self.obj_id)
-        self.old_points = [int(s) for s in old[0][3].split()]
+        self.old_points = Annotation.decode_contour(old[0][3])
 
         # save old prediction for undo. check if object is "final" in next frame
         old_pred = self.annotation.get(self.frame_number + 1, self.obj_id)
         if old_pred:
-            self.old_pred_points = [int(s) for s in old_pred[0][3].split()]
+            self.old_pred_points = Annotation.decode_contour(old_pred[0][3])
 
             # has the user actively confirmed the object in next frame
             self.final_in_next_frame = old_pred[0][4]
@@ -238,53 +408,156 @@ class MoveCommand(QtWidgets.QUndoCommand):
             self.final_in_next_frame = None
 
     def redo(self):
-        # remove old object from DB
-        self.annotation.remove(self.obj_id, self.frame_number)
+        with self.annotation.transaction():
+            # remove old object from DB
+            self.annotation.remove(self.obj_id, self.frame_number)
 
-        # move contour from old to new
-        points = self.annotation_scene.move_contour(self.contour, self.obj_id, self.class_name)
+            # move contour from old to new
+            points = self.annotation_scene.move_contour(self.contour, self.obj_id, self.class_name)
 
-        # add new data
-        self.annotation.add(self.frame_number, self.obj_id, self.class_name, points, True)
+            # add new data
+            self.annotation.add(self.frame_number, self.obj_id, self.class_name, points, True)
 
-        # attempt to track object in next frame
-        next_frame_record = self.annotation.get(self.frame_number + 1, self.obj_id)
-        if len(next_frame_record) > 0:
-            # check if what we have in _annotation is a prediction or already a user-finalized object
-            finalized = next_frame_record[0][4]
-        else:
-            # if no prediction exists, object is trivially not finalized
-            finalized = False
+            # attempt to track object in next frame
+            next_frame_record = self.annotation.get(self.frame_number + 1, self.obj_id)
+            if len(next_frame_record) > 0:
+                # check if what we have in _annotation is a prediction or already a user-finalized object
+                finalized = next_frame_record[0][4]
+            else:
+                # if no prediction exists, object is trivially not finalized
+                finalized = False
 
-        if not finalized:
-            # remove prediction (to be replaced with new moved object prediction)
-            self.annotation.remove(self.obj_id, self.frame_number + 1)
+            if not finalized:
+                # remove prediction (to be replaced with new moved object prediction)
+                self.annotation.remove(self.obj_id, self.frame_number + 1)
 
-            # add prediction in next frame at tracker generated location (non-final)
-            self.annotation.add(self.frame_number + 1, self.obj_id, self.class_name,
-                                self.annotation_scene.tracker.track(points, self.frame_number, self.obj_id), False)
+                # add prediction in next frame at tracker generated location (non-final)
+                self.annotation.add(self.frame_number + 1, self.obj_id, self.class_name,
+                                    self.annotation_scene.tracker.track(points, self.frame_number, self.obj_id), False)
 
     def undo(self):
-        # remove from DB
-        self.annotation.remove(self.obj_id, self.frame_number)
+        with self.annotation.transaction():
+            # remove from DB
+            self.annotation.remove(self.obj_id, self.frame_number)
 
-        # remove contour
-        self.annotation_scene.removeItem(self.annotation_scene.obj2contour[self.obj_id])
+            # remove contour
+            self.annotation_scene.remove_contour(self.obj_id)
 
-        # move contour to old
-        self.annotation_scene.add_contour(self.old_points, self.obj_id, self.class_name, True)
+            # move contour to old
+            self.annotation_scene.add_contour(self.old_points, self.obj_id, self.class_name, True)
 
-        # restore data
-        self.annotation.add(self.frame_number, self.obj_id, self.class_name, self.old_points, True)
+            # restore data
+            self.annotation.add(self.frame_number, self.obj_id, self.class_name, self.old_points, True)
 
-        # undo move prediction if user hasn't finalized object in next frame
-        if not self.final_in_next_frame:
-            # remove old prediction
-            self.annotation.remove(self.obj_id, self.frame_number + 1)
+            # undo move prediction if user hasn't finalized object in next frame
+            if not self.final_in_next_frame:
+                # remove old prediction
+                self.annotation.remove(self.obj_id, self.frame_number + 1)
 
-            # if there is an "old" prediction, restore it
-            if self.old_pred_points:
-                self.annotation.add(self.frame_number + 1, self.obj_id, self.class_name, self.old_pred_points, False)
+                # if there is an "old" prediction, restore it
+                if self.old_pred_points is not None:
+                    self.annotation.add(self.frame_number + 1, self.obj_id, self.class_name, self.old_pred_points,
+                                        False)
+
+
+class TrackJob(QtCore.QThread):
+    """ predict objects of a frame in the next frame on a worker thread. the video and database are only
+    accessed by the GUI thread: frames are prepared before starting and predictions are written when done """
+
+    # emitted (with the job) when predictions are ready
+    tracked = QtCore.pyqtSignal(object)
+
+    def __init__(self, annotation, frame_number, objects, step):
+        """
+        :param annotation: annotation the objects belong to
+        :param frame_number: frame the objects are in
+        :param objects: list of (obj_id, class_name, contour)
+        :param step: prepared frames (see Tracker.step); None to predict objects in place
+        :return:
+        """
+        super(TrackJob, self).__init__()
+
+        self.annotation = annotation
+        self.frame_number = frame_number
+        self.objects = objects
+        self.step = step
+
+        # predictions as frames table records
+        self.records = []
+
+    def run(self):
+        try:
+            for obj_id, class_name, points in self.objects:
+                prediction = points if self.step is None else Tracker.Tracker.predict(self.step, points, obj_id)
+                self.records.append((self.frame_number + 1, obj_id, class_name, prediction, False))
+        finally:
+            self.tracked.emit(self)
+
+
+class PropagateJob(QtCore.QThread):
+    """ track objects forward over many frames on a worker thread (see Tracker.propagate), with its own video
+    capture. predictions are queued in chunks and written to the database by the GUI thread """
+
+    # emitted (with the job) when a chunk of predictions is queued, and when done
+    predicted = QtCore.pyqtSignal(object)
+    done = QtCore.pyqtSignal(object)
+
+    # emitted with the last frame predicted so far
+    progressed = QtCore.pyqtSignal(int)
+
+    # frames per chunk of predictions
+    CHUNK_FRAMES = 25
+
+    def __init__(self, annotation, frame_number, objects, last_frame, backend, stop_frames):
+        """
+        :param annotation: annotation the objects belong to
+        :param frame_number: frame the objects are in
+        :param objects: dict of obj_id -> (class_name, contour)
+        :param last_frame: last frame to predict objects in
+        :param backend: name of tracking backend (see Tracker.BACKENDS)
+        :param stop_frames: dict of obj_id -> frame in which the object is final
+        :return:
+        """
+        super(PropagateJob, self).__init__()
+
+        self.annotation = annotation
+        self.video_filename = annotation.video_filename
+        self.keyframe_index = annotation.keyframe_index
+        self.frame_number = frame_number
+        self.classes = {obj_id: class_name for obj_id, (class_name, _) in objects.items()}
+        self.contours = {obj_id: contour for obj_id, (_, contour) in objects.items()}
+        self.last_frame = last_frame
+        self.backend = backend
+        self.stop_frames = stop_frames
+
+        # chunks of frames table records, consumed by the GUI thread
+        self.chunks = collections.deque()
+
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def run(self):
+        source = FrameSource.open_source(self.video_filename, index=self.keyframe_index)
+        records = []
+        try:
+            for frame_number, predictions in Tracker.propagate(source, self.frame_number, self.contours,
+                                                               self.last_frame, self.backend, self.stop_frames,
+                                                               self._cancelled.is_set):
+                records += [(frame_number, obj_id, self.classes[obj_id], contour, False)
+                            for obj_id, contour in predictions]
+
+                if (frame_number - self.frame_number) % PropagateJob.CHUNK_FRAMES == 0:
+                    self.chunks.append(records)
+                    records = []
+                    self.predicted.emit(self)
+                    self.progressed.emit(frame_number)
+        finally:
+            source.release()
+            if records:
+                self.chunks.append(records)
+            self.done.emit(self)
 
 
 class AnnotationObject(QtWidgets.QGraphicsPolygonItem):
@@ -297,14 +570,11 @@ class AnnotationObject(QtWidgets.QGraphicsPolygonItem):
 
         # save color and final
         self.color = color
-        self.final = final
+        self.final = None
+        self.set_final(final)
 
-        # set different brush behaviour for final/predicted object
-        if not self.final:
-            brush = QtGui.QBrush(self.color, QtCore.Qt.Dense5Pattern)
-        else:
-            brush = QtGui.QBrush(self.color)
-        self.setBrush(brush)
+        # database contour the polygon was made from (to skip unchanged objects on frame change); None if unknown
+        self.contour_data = None
 
         # make movable and selectable
         self.setFlag(QtWidgets.QGraphicsItem.ItemIsMovable, True)
@@ -320,10 +590,15 @@ class AnnotationObject(QtWidgets.QGraphicsPolygonItem):
 
     def finalize(self):
         #   change final draw to True
-        self.final = True
+        self.set_final(True)
 
-        #   update brush
-        brush = QtGui.QBrush(self.color)
+    def set_final(self, final):
+        """ set different brush behaviour for final/predicted object """
+        self.final = final
+        if not self.final:
+            brush = QtGui.QBrush(self.color, QtCore.Qt.Dense5Pattern)
+        else:
+            brush = QtGui.QBrush(self.color)
         self.setBrush(brush)
 
     def mousePressEvent(self, event):
@@ -397,9 +672,11 @@ class AnnotationObject(QtWidgets.QGraphicsPolygonItem):
         # if finished modifying an object
         if self.state == 'modify':
 
-            # check if we've moved since right-mouse click; if not abort modify
+            # check if we've moved since right-mouse click; if not abort modify (undo visual cue)
             if len(self.modified_points) < 4:
                 self.state = None
+                self.set_final(self.final)
+                self.setOpacity(1)
             #   otherwise - perform modification
             else:
 
@@ -462,10 +739,6 @@ class AnnotationScene(QtWidgets.QGraphicsScene):
         # start with empty list of points in current marker
         self.points = []
 
-        # initialize colormap (calm PEP first by initializing in constructor)
-        self.colormap = self.inverse_colormap = None
-        self.set_colormap()
-
         # pen and color
         self.pen = []
         self.color = []
@@ -476,8 +749,13 @@ class AnnotationScene(QtWidgets.QGraphicsScene):
         # start at frame 1
         self.frame_number = 1
 
-        # background image
+        # background image and the array its pixmap wraps (see frame_to_qimage), which the next frame is converted into
         self.background = None
+        self.background_data = None
+
+        # preview of another frame shown over the scene (e.g. while dragging the frame slider) and its array
+        self.preview = None
+        self.preview_data = None
 
         #   lines for concurrent drawing
         self.lines = []
@@ -503,25 +781,104 @@ class AnnotationScene(QtWidgets.QGraphicsScene):
 
         #   initialize tracker
         self.tracker = None
+        self.tracker_backend = Tracker.BACKEND
 
         #   items changed in current frame
         self.changed_items = []
 
+        #   running track() jobs
+        self.jobs = []
+
+        #   running propagate() job
+        self.propagate_job = None
+
+        #   classes not shown on scene
+        self.hidden_classes = set()
+
         #   DB information for current frame at load time
         self.records = []
 
-    def set_background(self, image):
-        # add image; TODO: find a way to use self.backgroundBrush
-        self.background = self.addPixmap(QtGui.QPixmap.fromImage(image))
+    def shown_image(self, frame, data):
+        """ the frame converted into data, the array the shown background's or preview's pixmap wraps (see
+        frame_to_qimage): that pixmap shows the new pixels as soon as they are written, so it must be replaced right
+        after, before anything is painted. the scene's items are only painted on the GUI thread, so converting and
+        replacing there with nothing in between (set_background, show_preview) keeps the old frame from being drawn
+        half overwritten
+        :param frame: BGR or grayscale image (numpy array)
+        :param data: array of the shown pixmap (or None)
+        :return: QImage
+        """
+        assert QtCore.QThread.currentThread() == self.thread(), 'shown images are only replaced on the GUI thread'
+        return frame_to_qimage(frame, data)
 
-    def set_colormap(self):
-        # seed pseudo-random number generator for repeatable colormap
-        np.random.seed(1)
-        self.colormap = np.random.randint(low=0, high=255, size=(3, 2 ** 16))
+    def set_background(self, frame, size=None):
+        """
+        :param frame: BGR or grayscale image of the frame (numpy array), possibly downscaled (see downscale)
+        :param size: (width, height) of the frame: the background is scaled to it, so that scene coordinates (e.g. of
+        contours) are always the frame's pixels. None: the image's own size
+        :return:
+        """
+        image = self.shown_image(frame, self.background_data)
+
+        # add image once, then replace its pixmap in place; TODO: find a way to use self.backgroundBrush
+        if not isinstance(self.background, QtWidgets.QGraphicsPixmapItem):
+            if self.background is not None:
+                self.removeItem(self.background)
+            self.background = self.addPixmap(QtGui.QPixmap.fromImage(image))
+            self.background.setZValue(-1)
+        else:
+            self.background.setPixmap(QtGui.QPixmap.fromImage(image))
 
-        # calculate inverse colormap (drek follows)
-        d = {obj_id: row for (obj_id, row) in enumerate([r for r in self.colormap.T])}
-        self.inverse_colormap = {tuple(v): k for k, v in d.items()}
+        width, height = size or (image.width(), image.height())
+        self.background.setTransform(QtGui.QTransform.fromScale(width / image.width(), height / image.height()))
+        self.background_data = getattr(image, 'ndarray', None)
+
+    def set_tiled_background(self, frame):
+        """ show a very large frame as the background, drawn in tiles (see TiledBackground)
+        :param frame: BGR or grayscale image (numpy array, possibly memory mapped)
+        :return:
+        """
+        if not isinstance(self.background, TiledBackground):
+            if self.background is not None:
+                self.removeItem(self.background)
+            self.background = TiledBackground(frame)
+            self.background.setZValue(-1)
+            self.addItem(self.background)
+        else:
+            self.background.set_frame(frame)
+
+        # tiles keep their own memory
+        self.background_data = None
+
+    def show_preview(self, frame):
+        """ cover the scene with an image of another frame (e.g. a thumbnail), scaled to the background's size;
+        objects are hidden under it. the scene itself is not changed
+        :param frame: BGR or grayscale image (numpy array), of any size
+        :return:
+        """
+        if self.background is None:
+            return
+
+        image = self.shown_image(frame, self.preview_data)
+        pixmap = QtGui.QPixmap.fromImage(image)
+        if self.preview is None:
+            self.preview = self.addPixmap(pixmap)
+            self.preview.setTransformationMode(QtCore.Qt.SmoothTransformation)
+
+            # above all objects
+            self.preview.setZValue(1e6)
+        else:
+            self.preview.setPixmap(pixmap)
+
+        rect = self.background.sceneBoundingRect()
+        self.preview.setTransform(QtGui.QTransform.fromScale(rect.width() / image.width(),
+                                                            rect.height() / image.height()))
+        self.preview.setVisible(True)
+        self.preview_data = getattr(image, 'ndarray', None)
+
+    def hide_preview(self):
+        if self.preview is not None:
+            self.preview.setVisible(False)
 
     def set_annotation(self, annotation):
 
@@ -529,14 +886,27 @@ class AnnotationScene(QtWidgets.QGraphicsScene):
         self.annotation = weakref.ref(annotation)
 
         # assign tracker to this database
-        self.tracker = Tracker.Tracker(self.annotation())
+        self.tracker = Tracker.Tracker(self.annotation(), self.tracker_backend)
 
         # reset the selected class
         self.class_name = None
 
+    def set_tracker_backend(self, backend):
+        """
+        :param backend: name of tracking backend (see Tracker.BACKENDS)
+        :return:
+        """
+        self.tracker_backend = backend
+        if self.tracker:
+            self.tracker.set_backend(backend)
+
     def get_color(self, rgb):
+        """
+        :param rgb: (r, g, b) color, 0-255 each (objects' colors are given by Colormap.color)
+        :return: QColor with default transparency; also sets the scene's pen to it
+        """
         # sanity check
-        if (rgb < 0).any() or (rgb > 255).any():
+        if min(rgb) < 0 or max(rgb) > 255:
             return
 
         # set color with default transparency
@@ -549,7 +919,8 @@ class AnnotationScene(QtWidgets.QGraphicsScene):
         return color
 
     def load(self, frame_number, records):
-        """
+        """ show objects of frame. contour items of objects that are still in the frame are reused and only
+        updated where they changed; the rest are added / removed
         :param frame_number: load all objects from this frame and add their contours
         :param records:      the records to load
         :return:
@@ -561,10 +932,30 @@ class AnnotationScene(QtWidgets.QGraphicsScene):
         # get contours and data from database
         self.records = records  # self._annotation.get(frame_number)
 
-        # iterate over polygons and draw
+        # leftovers of interrupted drawing / modifying
+        pool = set(self.contour2obj)
+        for item in self.items():
+            if item is not self.background and item is not self.preview and item not in pool and \
+                    item.parentItem() is None:
+                self.removeItem(item)
+        self.lines = []
+
+        # objects no longer in frame
+        in_frame = {r[1] for r in self.records}
+        for obj_id in [o for o in self.obj2contour if o not in in_frame]:
+            self.remove_contour(obj_id)
+
+        self.clearSelection()
+
+        # iterate over polygons and draw / update
         for r in self.records:
-            # draw polygon
-            self.add_contour([int(s) for s in r[3].split()], r[1], r[2], r[4])
+            contour = self.obj2contour.get(r[1])
+            if contour is None:
+                contour = self.add_contour(Annotation.decode_contour(r[3]), r[1], r[2], r[4])
+                if contour is not None:
+                    contour.contour_data = r[3]
+            else:
+                self.update_contour(contour, r)
 
         # clear undo stack after frame change
         self.command_stack.clear()
@@ -572,32 +963,66 @@ class AnnotationScene(QtWidgets.QGraphicsScene):
         # clear changed items
         self.changed_items = []
 
+    def update_contour(self, contour, record):
+        """ update contour item of object to a (possibly changed) database record
+        :param contour: AnnotationObject of record's object
+        :param record: frames table record
+        :return:
+        """
+        (_, obj_id, class_name, data, final) = record
+
+        # shape (and position, in case the item was nudged by a click)
+        if contour.contour_data != data or not contour.pos().isNull():
+            contour.setPos(0, 0)
+            contour.setPolygon(self.polygon(Annotation.decode_contour(data)))
+            contour.contour_data = data
+
+        if bool(contour.final) != bool(final):
+            contour.set_final(final)
+
+        if self.contour2obj[contour][1] != class_name or contour.toolTip() != self.tooltip(obj_id, class_name, final):
+            contour.setToolTip(self.tooltip(obj_id, class_name, final))
+            self.contour2obj[contour] = (obj_id, class_name)
+
+    @staticmethod
+    def polygon(points):
+        """
+        :param points: sequence (or array) of integers in format (x, y, x, y, ...)
+        :return: QPolygonF
+        """
+        # extract (x, y) couples from list (or array) of points
+        points = np.asarray(points).reshape(-1, 2).tolist()
+
+        # create list of Qt.QPointF from (x, y) lists
+        return QtGui.QPolygonF([QtCore.QPointF(*p) for p in points])
+
+    @staticmethod
+    def tooltip(obj_id, class_name, final):
+        tooltip_text = 'Object ID: {0}, class: {1}'.format(obj_id, class_name)
+        if not final:
+            tooltip_text += ', prediction'
+        return tooltip_text
+
     def add_contour(self, points, obj_id, class_name, final, color=None):
-        """ draw contour for given object on scene """
-        if not points:
+        """ draw contour for given object on scene (replacing the object's current contour, if any) """
+        if len(points) == 0:
             return
 
+        if obj_id in self.obj2contour:
+            self.remove_contour(obj_id)
+
         # set appropriate color
         if not color:
-            color = self.get_color(self.colormap[:, obj_id])
-
-        # extract (x, y) couples from list of points
-        points = list(zip(points[::2], points[1::2]))
-
-        # create list of Qt.QPointF from (x, y) lists
-        points = [QtCore.QPointF(*p) for p in points]
+            color = self.get_color(Colormap.color(obj_id))
 
         # draw current polygon
-        contour = AnnotationObject(QtGui.QPolygonF(points), self.pen, color, final)
+        contour = AnnotationObject(self.polygon(points), self.pen, color, final)
 
         # insert the AnnotationObject to the scene
         self.addItem(contour)
 
         # set tool tip
-        tooltip_text = 'Object ID: {0}, class: {1}'.format(obj_id, class_name)
-        if not final:
-            tooltip_text += ', prediction'
-        contour.setToolTip(tooltip_text)
+        contour.setToolTip(self.tooltip(obj_id, class_name, final))
 
         # save object id and class of this contour
         self.contour2obj[contour] = (obj_id, class_name)
@@ -628,7 +1053,7 @@ class AnnotationScene(QtWidgets.QGraphicsScene):
         """
 
         # remove old contour
-        self.removeItem(self.obj2contour[obj_id])
+        self.remove_contour(obj_id)
 
         # get vertices of new contour
         vertices = [contour.mapToScene(p).toPoint() for p in contour.polygon().toPolygon()]
@@ -663,19 +1088,20 @@ class AnnotationScene(QtWidgets.QGraphicsScene):
         if reply == QtWidgets.QMessageBox.No:
             return
 
-        # iterate over selected items
-        for contour in self.selectedItems():
-            # get id
-            (obj_id, class_name) = self.contour2obj[contour]
+        # iterate over selected items (single transaction)
+        with self.annotation().transaction():
+            for contour in self.selectedItems():
+                # get id
+                (obj_id, class_name) = self.contour2obj[contour]
 
-            #   change class in DB
-            self.annotation().change_class(obj_id, to_class)
+                #   change class in DB
+                self.annotation().change_class(obj_id, to_class)
 
-            # update hashtable
-            self.contour2obj[contour] = (obj_id, to_class)
+                # update hashtable
+                self.contour2obj[contour] = (obj_id, to_class)
 
-            # update
-            contour.setToolTip('Object ID: ' + str(obj_id) + ', class ' + to_class)
+                # update
+                contour.setToolTip('Object ID: ' + str(obj_id) + ', class ' + to_class)
 
     def mousePressEvent(self, event):
 
@@ -716,7 +1142,7 @@ class AnnotationScene(QtWidgets.QGraphicsScene):
         self.changed_items.append(self.current_id)
 
         #   set color
-        self.get_color(self.colormap[:, self.current_id])
+        self.get_color(Colormap.color(self.current_id))
 
     def mouseMoveEvent(self, event):
 
@@ -779,7 +1205,7 @@ class AnnotationScene(QtWidgets.QGraphicsScene):
         :param py: y coordinate
         :return: clipped x and y
         """
-        bounding_rect = self.background.boundingRect()
+        bounding_rect = self.background.sceneBoundingRect()
         [x, y] = [max(0, i) for i in [px, py]]
         x = min(x, int(bounding_rect.right()))
         y = min(y, int(bounding_rect.bottom()))
@@ -787,7 +1213,7 @@ class AnnotationScene(QtWidgets.QGraphicsScene):
         return x, y
 
     def in_image(self, x, y):
-        bounding_rect = self.background.boundingRect()
+        bounding_rect = self.background.sceneBoundingRect()
         if x < 0 or y < 0 or x > bounding_rect.right() or y > bounding_rect.bottom():
             return False
         return True
@@ -809,27 +1235,161 @@ class AnnotationScene(QtWidgets.QGraphicsScene):
         self.annotation().finalize_frame(self.frame_number)
 
     def track(self):
-        """ track all objects that haven't been 'touched' this frame
+        """ track all objects that haven't been 'touched' this frame. predictions are made on a worker thread
+        and added to the database (and scene, if showing the next frame) when done
         :return:
         """
 
-        # iterate over object records (note: these are from load time; it doesn't matter since
-        # by definition this function only tracks objects that were untouched)
-
         if self.records is None:
             return
 
-        for r in self.records:
-            # don't do anything for moved items (that have already been tracked)
-            if r[1] not in self.changed_items:
+        annotation = self.annotation()
+        if self.frame_number >= annotation.num_frames:
+            return
+
+        # ensure object doesn't already exist in next frame (don't affect future if it already happened)
+        existing = annotation.object_ids(self.frame_number + 1)
+
+        # object records are from load time; it doesn't matter since by definition this function only tracks
+        # objects that were untouched
+        objects = [(r[1], r[2], Annotation.decode_contour(r[3])) for r in self.records
+                   if r[1] not in self.changed_items and r[1] not in existing]
+        if not objects:
+            return
+
+        # read frames here (video belongs to this thread); predict on worker thread
+        job = TrackJob(annotation, self.frame_number, objects, self.tracker.step(self.frame_number))
+        job.tracked.connect(self.add_predictions)
+        self.jobs.append(job)
+        job.start()
+
+    def add_predictions(self, job):
+        """ slot for finished track() job: insert predictions (single statement) and draw them
+        :param job: TrackJob
+        :return:
+        """
+
+        # already handled (see stop_jobs)
+        if job not in self.jobs:
+            return
+        self.jobs.remove(job)
+        job.wait()
+
+        # annotation was replaced meanwhile
+        annotation = self.annotation() if self.annotation else None
+        if annotation is not job.annotation or annotation.connection is None:
+            return
+
+        # objects might have been added to the frame since the job started (e.g. by a job of the same frame)
+        frame_number = job.frame_number + 1
+        existing = annotation.object_ids(frame_number)
+        records = [r for r in job.records if r[1] not in existing]
+        if not records:
+            return
+
+        with annotation.transaction():
+            annotation.add_many(records)
+
+        # user may already be on the predicted frame
+        self.show_predictions(records)
 
-                # ensure object doesn't already exist in next frame (don't affect future if it already happened)
-                if len(self.annotation().get(self.frame_number + 1, r[1])) == 0:
-                    #   draw polygon
-                    points = [int(s) for s in r[3].split()]
+    def show_predictions(self, records):
+        """ draw (or redraw) predictions made in the background that are in the current frame
+        :param records: frames table records of predictions (contours as arrays)
+        :return:
+        """
+        records = [r for r in records if r[0] == self.frame_number and r[2] not in self.hidden_classes]
+        if not records:
+            return
 
-                    #   track. NOTE: with current tracker is superfluous since objects haven't moved by definition
-                    prediction = self.tracker.track(points, self.frame_number, r[1])
+        # replace current contours and load-time records of the objects
+        ids = {r[1] for r in records}
+        self.records = [r for r in self.records if r[1] not in ids]
+        for r in records:
+            data = Annotation.encode_contour(r[3])
+            contour = self.add_contour(r[3], r[1], r[2], False)
+            if contour is not None:
+                contour.contour_data = data
+            self.records.append((r[0], r[1], r[2], data, 0))
+
+    def propagate(self, num_frames, obj_ids=None):
+        """ track objects forward over the next frames in the background, replacing their predictions. objects
+        are tracked up to the frame in which they are final
+        :param num_frames: number of frames to propagate over
+        :param obj_ids: objects (of current frame) to propagate; None for all
+        :return: PropagateJob (already started) or None if there is nothing to propagate
+        """
+        annotation = self.annotation()
+        last_frame = min(self.frame_number + num_frames, annotation.num_frames)
+        records = annotation.get(self.frame_number)
+        objects = {r[1]: (r[2], Annotation.decode_contour(r[3])) for r in records
+                   if obj_ids is None or r[1] in obj_ids}
+        if not objects or last_frame <= self.frame_number or self.propagate_job is not None:
+            return None
+
+        # first frame each object is final in
+        stop_frames = {}
+        for frame_number, obj_id in annotation.final_objects(self.frame_number + 1, last_frame, list(objects)):
+            stop_frames[obj_id] = min(frame_number, stop_frames.get(obj_id, frame_number))
+
+        # write pending changes, so the job's capture and the database agree with what the user sees
+        annotation.flush()
+
+        job = PropagateJob(annotation, self.frame_number, objects, last_frame, self.tracker.backend_name,
+                           stop_frames)
+        job.predicted.connect(self.add_propagated)
+        job.done.connect(self.propagation_done)
+        self.propagate_job = job
+        job.start()
+        return job
+
+    def propagation_done(self, job):
+        """ slot for finished propagate() job
+        :param job: PropagateJob
+        :return:
+        """
+        if job is not self.propagate_job:
+            return
+        job.wait()
+        self.add_propagated(job)
+        self.propagate_job = None
+
+    def add_propagated(self, job):
+        """ slot for propagate() job: write queued predictions (replacing non-final objects) and draw those of
+        the current frame
+        :param job: PropagateJob
+        :return:
+        """
+        if job is not self.propagate_job:
+            return
+
+        annotation = self.annotation() if self.annotation else None
+        valid = annotation is job.annotation and annotation.connection is not None
+
+        while job.chunks:
+            records = job.chunks.popleft()
+            if not valid or not records:
+                continue
+
+            # the user may have finalized objects meanwhile
+            finals = annotation.final_objects(records[0][0], records[-1][0], {r[1] for r in records})
+            records = [r for r in records if (r[0], r[1]) not in finals]
+
+            with annotation.transaction():
+                annotation.remove_predictions([(r[0], r[1]) for r in records])
+                annotation.add_many(records)
+
+            self.show_predictions(records)
+
+    def stop_jobs(self):
+        """ wait for running jobs and add their predictions (e.g. before closing the annotation); propagation
+        is cancelled
+        :return:
+        """
+        for job in list(self.jobs):
+            job.wait()
+            self.add_predictions(job)
 
-                    #   add to _annotation. TODO: add as a batch (more efficient)
-                    self.annotation().add(self.frame_number + 1, r[1], r[2], prediction, False)
+        if self.propagate_job is not None:
+            self.propagate_job.cancel()
+            self.propagation_done(self.propagate_job)
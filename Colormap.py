@@ -0,0 +1,47 @@
+import colorsys
+import numpy as np
+
+# golden ratio conjugate: hues of consecutive ID's are far apart, and never repeat
+GOLDEN_RATIO = (5 ** 0.5 - 1) / 2
+
+# saturation and value levels, cycled by ID (so that ID's with close hues differ in shade)
+SATURATIONS = (0.95, 0.65, 0.8)
+VALUES = (0.95, 0.75)
+
+
+def hsv(obj_id):
+    """
+    :return: (hue, saturation, value) of an object ID
+    """
+    return (obj_id * GOLDEN_RATIO) % 1.0, SATURATIONS[obj_id % len(SATURATIONS)], \
+        VALUES[(obj_id // len(SATURATIONS)) % len(VALUES)]
+
+
+def color(obj_id):
+    """ computed (no table): any non-negative ID, same color on every call and in every process
+    :param obj_id: object ID
+    :return: (r, g, b) color of object, 0-255 each
+    """
+    return tuple(int(round(c * 255)) for c in colorsys.hsv_to_rgb(*hsv(obj_id)))
+
+
+def colors(ids):
+    """ vectorized color(), same results
+    :param ids: array of object ID's
+    :return: N x 3 uint8 array of (r, g, b) colors
+    """
+    ids = np.asarray(ids, dtype=np.int64).ravel()
+    h = (ids * GOLDEN_RATIO) % 1.0
+    s = np.array(SATURATIONS)[ids % len(SATURATIONS)]
+    v = np.array(VALUES)[(ids // len(SATURATIONS)) % len(VALUES)]
+
+    # as colorsys.hsv_to_rgb
+    i = (h * 6.0).astype(np.int64)
+    f = h * 6.0 - i
+    p, q, t = v * (1.0 - s), v * (1.0 - s * f), v * (1.0 - s * (1.0 - f))
+    i %= 6
+    r = np.choose(i, [v, q, p, p, t, v])
+    g = np.choose(i, [t, v, v, q, p, p])
+    b = np.choose(i, [p, p, t, v, v, q])
+
+    return np.rint(np.stack([r, g, b], axis=1) * 255).astype(np.uint8)
@@ -0,0 +1,371 @@
+import os
+import io
+import json
+import itertools
+import collections
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import cv2
+
+# project imports
+import Annotation
+import Colormap
+
+# ID image type of each output format: tiff readers expect 16-bit single channel images; png (colors) and npy take
+# any object ID up to 32 bits
+ID_DTYPES = {'.png': np.uint32, '.tiff': np.uint16, '.tif': np.uint16, '.npy': np.uint32}
+
+# largest ID colored with a lookup table of all ID's up to the frame's largest (see encode); above it, only the
+# frame's ID's are colored
+MAX_LUT_ID = 2 ** 16
+
+# width of object outline (same as the pen used to draw objects in the GUI)
+OUTLINE_WIDTH = 2
+
+# supported output formats
+SUFFIXES = ['.png', '.tiff', '.tif', '.npy']
+
+# frames in flight per worker process (bounds memory while keeping workers busy)
+FRAMES_PER_WORKER = 4
+
+# exports of fewer frames are done in this process: starting (spawning) a worker process takes about a second, more
+# than rendering and encoding a few dozen frames
+MIN_POOL_FRAMES = 64
+
+# label file formats: COCO JSON (polygons) and MOT CSV (boxes, one track after the other)
+LABEL_SUFFIXES = {'.json': 'coco', '.txt': 'mot', '.csv': 'mot'}
+
+# records per batch of the label writers' (vectorized) geometry
+LABEL_BATCH = 10000
+
+
+def render(records, height, width, dtype=np.uint16):
+    """ rasterize all objects of a frame into an ID image (pixel value is object ID, 0 is background)
+    :param records: frames table records of a single frame (frame, object, class, contour, final)
+    :param height: image height
+    :param width: image width
+    :param dtype: image type: np.uint16 or np.uint32 (see ID_DTYPES)
+    :return: image of dtype
+    """
+    image = np.zeros((height, width), dtype=dtype)
+    max_id = np.iinfo(dtype).max
+
+    # opencv doesn't draw on uint32 images: draw their bits as int32 (ID's above 2 ** 31 - 1 as negative values)
+    canvas = image.view(np.int32) if image.dtype == np.uint32 else image
+
+    # later objects are drawn over earlier ones
+    for r in records:
+        obj_id = int(r[1])
+        if obj_id > max_id:
+            raise ValueError('object ID {0} does not fit in a {1}-bit ID image'.format(obj_id, image.itemsize * 8))
+        value = obj_id - 2 ** 32 if obj_id > np.iinfo(np.int32).max else obj_id
+
+        # (x, y) points straight from the database buffer
+        contour = Annotation.decode_contour(r[3]).reshape(-1, 1, 2)
+        if len(contour) == 0:
+            continue
+
+        cv2.fillPoly(canvas, [contour], value)
+        cv2.polylines(canvas, [contour], True, value, OUTLINE_WIDTH)
+
+    return image
+
+
+def color_lut(size):
+    """
+    :param size: number of object ID's (0 to size - 1)
+    :return: size x 3 BGR lookup table of object colors (see Colormap); background (0) is black
+    """
+    lut = np.ascontiguousarray(Colormap.colors(np.arange(size))[:, ::-1])
+    lut[0] = 0
+    return lut
+
+
+def encode(ids, suffix):
+    """
+    :param ids: ID image
+    :param suffix: output format: .png color image, .tif/.tiff 16-bit ID image, .npy NumPy (32-bit) ID array
+    :return: encoded image file contents (bytes)
+    """
+    if suffix == '.npy':
+        buffer = io.BytesIO()
+        np.save(buffer, ids)
+        return buffer.getvalue()
+
+    if suffix == '.png':
+        max_id = int(ids.max())
+        if max_id < MAX_LUT_ID:
+            # colors of the ID's up to the frame's largest only
+            image = color_lut(max_id + 1)[ids]
+        else:
+            # colors of the frame's ID's only
+            unique, inverse = np.unique(ids, return_inverse=True)
+            lut = np.ascontiguousarray(Colormap.colors(unique)[:, ::-1])
+            lut[unique == 0] = 0
+            image = lut[inverse].reshape(ids.shape + (3,))
+    elif suffix in ['.tiff', '.tif']:
+        image = ids
+    else:
+        raise ValueError('unsupported export format ' + suffix)
+
+    ret, buffer = cv2.imencode(suffix, image)
+    if not ret:
+        raise IOError('failed to encode ' + suffix + ' image')
+    return buffer.tobytes()
+
+
+def frame_filename(dirname, filename, frame_number, suffix):
+    """
+    :return: output filename of a frame: frame number appended to filename
+    """
+    return os.path.join(dirname, filename + str(frame_number) + suffix)
+
+
+# worker process state (set once by _init_worker instead of being sent with every frame)
+_worker = {}
+
+
+def _init_worker(shape, suffix):
+    # one opencv thread per process; parallelism comes from the processes
+    cv2.setNumThreads(1)
+    _worker.update(shape=shape, suffix=suffix)
+
+
+def _render_and_encode(frame_number, records):
+    ids = render(records, *_worker['shape'], dtype=ID_DTYPES[_worker['suffix']])
+    return frame_number, encode(ids, _worker['suffix'])
+
+
+class ExportJob(object):
+    """ export annotations of a frame range to image files. records are streamed from the database in frame
+    order, rendered and encoded in a pool of worker processes and written in order. iterating over the job runs
+    it, yielding the number of each written frame (frames without objects are skipped); stopping the iteration
+    cancels it """
+
+    def __init__(self, annotation, dirname, filename, suffix, first=1, last=None, workers=None, classes=None,
+                 ids=None):
+        """
+        :param annotation: Annotation to export
+        :param dirname: output directory
+        :param filename: output filename prefix (frame number is appended)
+        :param suffix: output format (see SUFFIXES)
+        :param first: first frame to export
+        :param last: last frame to export (None for end of video)
+        :param workers: number of worker processes (None for number of CPUs, 1 to work in this process). exports of
+        fewer than MIN_POOL_FRAMES frames always work in this process
+        :param classes: export only objects of these classes (None for all)
+        :param ids: export only these object ID's (None for all)
+        :return:
+        """
+        if suffix not in SUFFIXES:
+            raise ValueError('unsupported export format ' + suffix)
+
+        self.annotation = annotation
+        self.dirname = dirname
+        self.filename = filename
+        self.suffix = suffix
+        self.first = first
+        self.last = annotation.num_frames if last is None else last
+        self.workers = workers or os.cpu_count() or 1
+        self.classes = classes
+        self.ids = ids
+
+    def __len__(self):
+        """ number of frames that will be written """
+        return self.annotation.count_frames(self.first, self.last, self.classes, self.ids)
+
+    def _write(self, frame_number, data):
+        """
+        :return: frame_number
+        """
+        with open(frame_filename(self.dirname, self.filename, frame_number, self.suffix), 'wb') as f:
+            f.write(data)
+        return frame_number
+
+    def __iter__(self):
+        frames = self.annotation.iter_frames(self.first, self.last, self.classes, self.ids)
+        shape = self.annotation.frame_shape
+
+        # small exports / single worker: no processes
+        if self.workers == 1 or len(self) < MIN_POOL_FRAMES:
+            _init_worker(shape, self.suffix)
+            for frame_number, records in frames:
+                yield self._write(*_render_and_encode(frame_number, records))
+            return
+
+        # 'spawn' since the GUI process has threads (forking them is unsafe)
+        executor = concurrent.futures.ProcessPoolExecutor(self.workers, multiprocessing.get_context('spawn'),
+                                                          initializer=_init_worker,
+                                                          initargs=(shape, self.suffix))
+        pending = collections.deque()
+        try:
+            for frame_number, records in frames:
+                pending.append(executor.submit(_render_and_encode, frame_number, records))
+
+                # bounded number of frames in flight; write oldest first to keep order
+                if len(pending) >= self.workers * FRAMES_PER_WORKER:
+                    yield self._write(*pending.popleft().result())
+
+            while pending:
+                yield self._write(*pending.popleft().result())
+        finally:
+            # on cancel (generator closed) drop frames not started yet
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+
+def contour_geometry(points, lengths):
+    """ bounding boxes and areas of many contours at once
+    :param points: M x 2 array of the (x, y) points of all contours, one contour after the other
+    :param lengths: number of points of each of the N contours (at least one)
+    :return: (N x 4 array of (x, y, width, height) bounding boxes, N polygon areas (shoelace formula)). boxes are of
+    the contours' pixels, as cv2.boundingRect: a contour from x = 0 to x = 10 is 11 pixels wide
+    """
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+    low = np.minimum.reduceat(points, starts, axis=0)
+    high = np.maximum.reduceat(points, starts, axis=0)
+    boxes = np.concatenate([low, high - low + 1], axis=1)
+
+    # previous point of each point (the first point's is its polygon's last)
+    previous = np.arange(len(points)) - 1
+    previous[starts] = starts + lengths - 1
+    x, y = points[:, 0].astype(np.float64), points[:, 1].astype(np.float64)
+    areas = 0.5 * np.abs(np.add.reduceat(x * y[previous] - y * x[previous], starts))
+
+    return boxes, areas
+
+
+def iter_geometry(records, min_points=1, contours=False, batch_size=LABEL_BATCH):
+    """ records with their contour's geometry, computed in batches (see contour_geometry). the contours of a
+    batch are decoded at once (from schema version 2 BLOBs)
+    :param records: iterable of frames table records
+    :param min_points: skip records with fewer contour points
+    :param contours: also return each contour as a list
+    :return: generator of (record, contour list (or None), [x, y, width, height], area)
+    """
+    point_size = 2 * Annotation.CONTOUR_DTYPE.itemsize
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, batch_size))
+        if not chunk:
+            return
+        batch = [r for r in chunk if len(r[3]) >= min_points * point_size]
+        if not batch:
+            continue
+
+        values = np.frombuffer(b''.join(r[3] for r in batch), dtype=Annotation.CONTOUR_DTYPE)
+        lengths = np.array([len(r[3]) for r in batch]) // point_size
+        boxes, areas = contour_geometry(values.reshape(-1, 2), lengths)
+
+        if contours:
+            values = values.tolist()
+            ends = np.cumsum(2 * lengths).tolist()
+            lists = [values[start:end] for start, end in zip([0] + ends[:-1], ends)]
+        else:
+            lists = itertools.repeat(None)
+
+        yield from zip(batch, lists, boxes.tolist(), areas.tolist())
+
+
+class Categories(dict):
+    """ class name -> category ID (from 1): classes of the annotation in table order, then any other class met """
+
+    def __init__(self, annotation):
+        super(Categories, self).__init__((c, i) for i, c in enumerate(annotation.classes(), 1))
+
+    def __missing__(self, class_name):
+        self[class_name] = len(self) + 1
+        return self[class_name]
+
+
+def export_coco(annotation, filename, first=1, last=None, classes=None, ids=None, image_prefix='',
+                image_suffix='.png'):
+    """ write objects as COCO JSON polygons (one image per frame, image ID is frame number) with a single ordered
+    scan of the database, in constant memory. objects carry their track (object ID) and whether they are final
+    :param annotation: Annotation to export
+    :param filename: output .json file
+    :param first: first frame to export
+    :param last: last frame to export (None for end of video)
+    :param classes: export only objects of these classes (None for all)
+    :param ids: export only these object ID's (None for all)
+    :param image_prefix: image file names are image_prefix + frame number + image_suffix (as written by ExportJob)
+    :param image_suffix: see image_prefix
+    :return: number of objects written
+    """
+    last = annotation.num_frames if last is None else last
+    height, width = annotation.frame_shape
+    categories = Categories(annotation)
+    count = 0
+
+    with open(filename, 'w') as f:
+        f.write('{"info": ' + json.dumps({'video': annotation.video_filename}) + ',\n"images": [')
+        for frame_number in range(first, last + 1):
+            f.write(('\n' if frame_number == first else ',\n') + json.dumps(
+                {'id': frame_number, 'file_name': frame_filename('', image_prefix, frame_number, image_suffix),
+                 'width': width, 'height': height}))
+
+        # categories are written after the objects, so unlisted classes can be added as they are met
+        f.write('],\n"annotations": [')
+        # (lists of ints print as JSON, and faster than json.dumps)
+        records = annotation.iter_records(first, last, classes, ids)
+        for (frame_number, obj_id, class_name, _, final), contour, box, area in iter_geometry(records, 3, True):
+            count += 1
+            f.write('{0}{{"id": {1:d}, "image_id": {2:d}, "category_id": {3:d}, "segmentation": [{4}], '
+                    '"area": {5!r}, "bbox": {6}, "iscrowd": 0, "track_id": {7:d}, "final": {8}}}'.format(
+                        '\n' if count == 1 else ',\n', count, frame_number, categories[class_name],
+                        contour, area, box, obj_id, 'true' if final else 'false'))
+
+        f.write('],\n"categories": [' + ',\n'.join(json.dumps({'id': i, 'name': c})
+                                                     for c, i in sorted(categories.items(), key=lambda c: c[1])))
+        f.write(']}\n')
+
+    return count
+
+
+def export_mot(annotation, filename, first=1, last=None, classes=None, ids=None):
+    """ write objects as MOT CSV rows: frame, id, left, top, width, height, conf, class, visibility. rows are
+    grouped by object (tracks, in frame order) with a single ordered scan of the database, in constant memory.
+    conf is 1 for final objects and 0 for predictions; class is the category ID (see Categories)
+    :param annotation: Annotation to export
+    :param filename: output .txt / .csv file
+    :param first: first frame to export
+    :param last: last frame to export (None for end of video, or the last annotated frame if the video is not open)
+    :param classes: export only objects of these classes (None for all)
+    :param ids: export only these object ID's (None for all)
+    :return: number of rows written
+    """
+    last = annotation.num_frames if last is None else last
+    categories = Categories(annotation)
+    count = 0
+
+    with open(filename, 'w') as f:
+        records = annotation.iter_records(first, last, classes, ids, by_object=True)
+        for (frame_number, obj_id, class_name, _, final), _, (x, y, w, h), _ in iter_geometry(records):
+            f.write('{0:d},{1:d},{2:d},{3:d},{4:d},{5:d},{6:d},{7:d},1\n'.format(
+                frame_number, obj_id, x, y, w, h, 1 if final else 0, categories[class_name]))
+            count += 1
+
+    return count
+
+
+def label_format(filename):
+    """
+    :param filename: label file
+    :return: format of its suffix (see LABEL_SUFFIXES)
+    """
+    suffix = os.path.splitext(filename)[1].lower()
+    if suffix not in LABEL_SUFFIXES:
+        raise ValueError('unsupported label format ' + suffix)
+    return LABEL_SUFFIXES[suffix]
+
+
+def export_labels(annotation, filename, **kwargs):
+    """ write a label file in the format of its suffix (see LABEL_SUFFIXES, export_coco and export_mot)
+    :return: number of objects written
+    """
+    if label_format(filename) == 'coco':
+        return export_coco(annotation, filename, **kwargs)
+    return export_mot(annotation, filename, **kwargs)
@@ -0,0 +1,220 @@
+import threading
+import logging
+from collections import OrderedDict
+
+# project imports
+import FrameSource
+
+# default size of decoded-frame cache (in megabytes)
+CACHE_SIZE_MB = 512
+
+# default number of frames to read ahead in the direction of travel
+READ_AHEAD_FRAMES = 16
+
+
+class FrameCache(object):
+    """ thread safe LRU cache of decoded frames, bounded by total size in bytes """
+
+    def __init__(self, size_mb=CACHE_SIZE_MB):
+        """
+        :param size_mb: maximal size of cached frames in megabytes
+        :return:
+        """
+        self.max_bytes = int(size_mb * 2 ** 20)
+
+        # frame number -> image, ordered from least to most recently used
+        self._frames = OrderedDict()
+        self._bytes = 0
+
+        # guards the frames dictionary; notified whenever a frame is added
+        self._condition = threading.Condition()
+
+    def __contains__(self, frame_number):
+        with self._condition:
+            return frame_number in self._frames
+
+    def __len__(self):
+        with self._condition:
+            return len(self._frames)
+
+    def get(self, frame_number):
+        """
+        :param frame_number: frame to look up
+        :return: cached image or None if frame is not in cache
+        """
+        with self._condition:
+            frame = self._frames.get(frame_number)
+            if frame is not None:
+                # mark as most recently used
+                self._frames.move_to_end(frame_number)
+            return frame
+
+    def put(self, frame_number, frame):
+        """
+        :param frame_number: frame number of image
+        :param frame: decoded image; made read-only since it is shared between readers
+        :return:
+        """
+        frame.flags.writeable = False
+
+        with self._condition:
+            old = self._frames.pop(frame_number, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+
+            self._frames[frame_number] = frame
+            self._bytes += frame.nbytes
+
+            # evict least recently used frames (always keep the newest one)
+            while self._bytes > self.max_bytes and len(self._frames) > 1:
+                _, evicted = self._frames.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+            self._condition.notify_all()
+
+    def wait(self, frame_number, predicate, timeout):
+        """ wait for a frame to be added to the cache
+        :param frame_number: frame to wait for
+        :param predicate: callable; keep waiting only while it returns True
+        :param timeout: maximal time to wait in seconds
+        :return: image or None if not added in time
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: frame_number in self._frames or not predicate(), timeout)
+        return self.get(frame_number)
+
+    def notify(self):
+        """ wake up all waiting readers (e.g. when a frame they wait for will not arrive) """
+        with self._condition:
+            self._condition.notify_all()
+
+    def clear(self):
+        with self._condition:
+            self._frames.clear()
+            self._bytes = 0
+
+
+class ReadAhead(threading.Thread):
+    """ worker thread that sequentially decodes the frames following the requested one (in the direction
+    of travel) into a FrameCache. uses its own video capture so it never seeks the caller's capture """
+
+    def __init__(self, video_filename, num_frames, cache, depth=READ_AHEAD_FRAMES, index=None):
+        """
+        :param video_filename: video or image sequence to read (see FrameSource.open_source)
+        :param num_frames: number of frames in video
+        :param cache: FrameCache to fill
+        :param depth: number of frames to read ahead
+        :param index: FrameSource.KeyframeIndex of video or None
+        :return:
+        """
+        super(ReadAhead, self).__init__(name='ReadAhead', daemon=True)
+
+        self.video_filename = video_filename
+        self.index = index
+        self.num_frames = num_frames
+        self.cache = cache
+        self.depth = depth
+
+        # latest (frame_number, direction) request, consumed by the worker
+        self._request = None
+
+        # range of frames currently being decoded (inclusive)
+        self._reading = None
+
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def request(self, frame_number, direction):
+        """ ask the worker to read ahead of frame_number
+        :param frame_number: frame the user is currently on (1-based)
+        :param direction: 1 for forward, -1 for backward
+        :return:
+        """
+        with self._condition:
+            self._request = (frame_number, direction)
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def is_reading(self, frame_number):
+        """
+        :param frame_number: frame number
+        :return: True if frame is about to be decoded by the worker
+        """
+        reading = self._reading
+        return reading is not None and reading[0] <= frame_number <= reading[1]
+
+    def wait_for(self, frame_number, timeout=1.0):
+        """
+        :param frame_number: frame to wait for
+        :param timeout: maximal time to wait in seconds
+        :return: image if the worker decoded it in time, otherwise None
+        """
+        if not self.is_reading(frame_number):
+            return None
+        return self.cache.wait(frame_number, lambda: self.is_reading(frame_number), timeout)
+
+    def _frames_to_read(self, frame_number, direction):
+        """
+        :return: (first, last) range of frames missing from cache around the request or None
+        """
+        if direction >= 0:
+            wanted = range(frame_number + 1, min(frame_number + self.depth, self.num_frames) + 1)
+        else:
+            wanted = range(max(frame_number - self.depth, 1), frame_number)
+
+        missing = [f for f in wanted if f not in self.cache]
+        if not missing:
+            return None
+        return missing[0], missing[-1]
+
+    def _superseded(self, first, last):
+        """ check if a newer request makes the current read pointless """
+        with self._condition:
+            if self._stopped:
+                return True
+            if self._request is None:
+                return False
+            frame_number, _ = self._request
+
+        # keep reading as long as the user is still moving through the range being read
+        return not first - 1 <= frame_number <= last + 1
+
+    def run(self):
+        source = FrameSource.open_source(self.video_filename, index=self.index)
+        if not source.is_opened():
+            logging.error('ReadAhead: failed to open video ' + str(self.video_filename))
+            return
+
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopped or self._request is not None)
+                if self._stopped:
+                    break
+                frame_number, direction = self._request
+                self._request = None
+
+            frames = self._frames_to_read(frame_number, direction)
+            if frames is None:
+                continue
+            first, last = frames
+            self._reading = frames
+
+            # sequential read; the source seeks only if not already positioned at first
+            frames = source.read_range(first, last)
+            for f, frame in frames:
+                self.cache.put(f, frame)
+
+                if self._superseded(first, last):
+                    break
+            frames.close()
+
+            self._reading = None
+
+            # wake up anyone waiting on a frame that will not arrive
+            self.cache.notify()
+
+        source.release()
@@ -0,0 +1,673 @@
+import os
+import re
+import glob
+import bisect
+import logging
+import threading
+import concurrent.futures
+from collections import deque
+import numpy as np
+import cv2
+
+# maximal distance (in frames) to decode forward instead of seeking; decoding a few frames is cheaper than
+# a seek, which with most codecs rewinds to the previous keyframe and decodes forward anyway
+MAX_GRAB_FORWARD = 32
+
+# opencv's ffmpeg seek lands this many frames before the requested one and decodes forward
+OPENCV_SEEK_BACKOFF = 16
+
+# image sequence inputs: one file per frame (.npy: raw image array, read without decoding)
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.bmp', '.tiff', '.tif', '.png', '.npy']
+
+# threads decoding the images of an image sequence read as a range
+IMAGE_READ_THREADS = min(4, os.cpu_count() or 1)
+
+# .npy frames larger than this (megabytes) are read memory mapped, not copied (e.g. gigapixel stills, drawn tiled)
+MAPPED_FRAME_MB = 256
+
+# raw video container (see RawVideoSource): header, then uncompressed frames from this offset (page aligned)
+RAW_MAGIC = b'ATCFRAME'
+RAW_VERSION = 1
+RAW_HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<i4'), ('num_frames', '<i4'), ('height', '<i4'),
+                             ('width', '<i4'), ('channels', '<i4'), ('fps', '<f8')])
+RAW_HEADER_SIZE = 4096
+
+# capture properties (annoying opencv version difference)
+if int(cv2.__version__[0]) < 3:
+    CAP_PROP_POS_FRAMES = cv2.cv.CV_CAP_PROP_POS_FRAMES
+    CAP_PROP_FRAME_COUNT = cv2.cv.CV_CAP_PROP_FRAME_COUNT
+    CAP_PROP_POS_MSEC = cv2.cv.CV_CAP_PROP_POS_MSEC
+    CAP_PROP_FRAME_WIDTH = cv2.cv.CV_CAP_PROP_FRAME_WIDTH
+    CAP_PROP_FRAME_HEIGHT = cv2.cv.CV_CAP_PROP_FRAME_HEIGHT
+else:
+    CAP_PROP_POS_FRAMES = cv2.CAP_PROP_POS_FRAMES
+    CAP_PROP_FRAME_COUNT = cv2.CAP_PROP_FRAME_COUNT
+    CAP_PROP_POS_MSEC = cv2.CAP_PROP_POS_MSEC
+    CAP_PROP_FRAME_WIDTH = cv2.CAP_PROP_FRAME_WIDTH
+    CAP_PROP_FRAME_HEIGHT = cv2.CAP_PROP_FRAME_HEIGHT
+
+
+class KeyframeIndex(object):
+    """ presentation timestamps and keyframe positions of a video. built once by scanning the compressed
+    packets (no decoding) and cached in a sidecar file next to the video """
+
+    # sidecar filename suffix (appended to the video filename)
+    SUFFIX = '.keyframes.npz'
+
+    def __init__(self, video_filename):
+        """
+        :param video_filename: video to index
+        :return:
+        """
+        self.video_filename = video_filename
+
+        # timestamp (msec) of each frame; timestamps[0] is frame 1
+        self.timestamps = None
+
+        # sorted (1-based) frame numbers of keyframes
+        self.keyframes = None
+
+        # half the smallest distance between frames, for comparing timestamps
+        self.tolerance = 0
+
+        # set once the index can be used (from any thread)
+        self.ready = False
+
+        self._thread = None
+        self._stopped = False
+
+    def sidecar_filename(self):
+        return self.video_filename + KeyframeIndex.SUFFIX
+
+    def _signature(self):
+        """ identifies the indexed video version (size and modification time) """
+        stat = os.stat(self.video_filename)
+        return np.array([stat.st_size, int(stat.st_mtime)], dtype=np.int64)
+
+    def load(self):
+        """
+        :return: True if a valid sidecar index was loaded
+        """
+        try:
+            with np.load(self.sidecar_filename()) as data:
+                if not np.array_equal(data['signature'], self._signature()):
+                    logging.info('KeyframeIndex: stale sidecar for ' + self.video_filename)
+                    return False
+                self._set(data['timestamps'], data['keyframes'])
+            return True
+        except (IOError, OSError, KeyError, ValueError):
+            return False
+
+    def save(self):
+        try:
+            with open(self.sidecar_filename(), 'wb') as f:
+                np.savez(f, signature=self._signature(), timestamps=self.timestamps, keyframes=self.keyframes)
+        except (IOError, OSError) as e:
+            # e.g. read-only video folder; index is still used for this session
+            logging.warning('KeyframeIndex: could not save sidecar: ' + str(e))
+
+    def scan(self):
+        """ read all packets of the video without decoding them
+        :return: True if index was built
+        """
+        # raw stream mode: grab() only demuxes
+        if not hasattr(cv2, 'CAP_PROP_LRF_HAS_KEY_FRAME'):
+            return False
+        cap = cv2.VideoCapture(self.video_filename, cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+        if not cap.isOpened():
+            return False
+
+        timestamps = []
+        is_key = []
+        while not self._stopped and cap.grab():
+            timestamps.append(cap.get(CAP_PROP_POS_MSEC))
+            is_key.append(bool(cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME)))
+        cap.release()
+
+        if self._stopped or not timestamps or not any(is_key):
+            return False
+
+        # packets are in decoding order; frame numbers are by presentation order
+        order = np.argsort(timestamps, kind='stable')
+        timestamps = np.asarray(timestamps)[order]
+        keyframes = np.flatnonzero(np.asarray(is_key)[order]) + 1
+
+        self._set(timestamps, keyframes)
+        return True
+
+    def _set(self, timestamps, keyframes):
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.keyframes = [int(k) for k in keyframes]
+        intervals = np.diff(self.timestamps)
+        self.tolerance = intervals[intervals > 0].min() / 2 if (intervals > 0).any() else 0.5
+
+    def build(self):
+        """ load index from sidecar, or scan the video and save it """
+        if not self.load():
+            logging.info('KeyframeIndex: indexing ' + self.video_filename)
+            if not self.scan():
+                logging.info('KeyframeIndex: could not index ' + self.video_filename)
+                return
+            self.save()
+
+        self.ready = True
+        logging.info('KeyframeIndex: {0} frames, {1} keyframes'.format(len(self.timestamps), len(self.keyframes)))
+
+    def start(self):
+        """ build in background """
+        self._thread = threading.Thread(target=self.build, name='KeyframeIndex', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def num_frames(self):
+        return len(self.timestamps)
+
+    def timestamp(self, frame_number):
+        return self.timestamps[frame_number - 1]
+
+    def keyframe_before(self, frame_number):
+        """
+        :param frame_number: 1-based frame number
+        :return: last keyframe at or before frame_number
+        """
+        i = bisect.bisect_right(self.keyframes, frame_number) - 1
+        return self.keyframes[max(i, 0)]
+
+
+class FrameSource(object):
+    """ interface of frame sources: what Annotation and its background readers read frames through. a source is
+    opened by its constructor, with the filename and keyword options (options it doesn't use are ignored; check
+    is_opened()), and used by one thread at a time. frame numbers are 1-based, as in Annotation. open_source() picks
+    the source class of a file (see register_source) """
+
+    # frames are slow to get (e.g. decoded): worth caching, and reading ahead in a background thread
+    READ_AHEAD = True
+
+    # keyframe index the source seeks with, if any (see KeyframeIndex)
+    index = None
+
+    @classmethod
+    def accepts(cls, filename):
+        """
+        :param filename: file (or folder / pattern) to read frames from
+        :return: True if this class reads filename
+        """
+        return False
+
+    def is_opened(self):
+        raise NotImplementedError
+
+    def num_frames(self):
+        raise NotImplementedError
+
+    def frame_shape(self):
+        """
+        :return: (height, width) of frames
+        """
+        raise NotImplementedError
+
+    def fps(self):
+        """
+        :return: frames per second; 0 if unknown
+        """
+        return 0
+
+    def read(self, frame_number):
+        """
+        :param frame_number: frame to read (1-based)
+        :return: BGR (or grayscale) image or None on failure
+        """
+        raise NotImplementedError
+
+    def read_range(self, first, last):
+        """ read consecutive frames
+        :param first: first frame to read (1-based)
+        :param last: last frame to read (inclusive)
+        :return: generator of (frame_number, image); stops at the first frame that can't be read
+        """
+        for frame_number in range(first, last + 1):
+            frame = self.read(frame_number)
+            if frame is None:
+                return
+            yield frame_number, frame
+
+    def release(self):
+        pass
+
+
+class VideoSource(FrameSource):
+    """ video capture that keeps track of the decoder position, so that reading the next frame (or one a few
+    frames ahead) never seeks (read_range decodes sequentially, seeking at most once). with a keyframe index, random
+    access seeks to the keyframe before the requested frame and decodes forward to its exact timestamp """
+
+    @classmethod
+    def accepts(cls, filename):
+        # anything ffmpeg reads
+        return True
+
+    def __init__(self, filename, max_grab_forward=MAX_GRAB_FORWARD, index=None, **options):
+        """
+        :param filename: video (or image pattern) to open, as given to cv2.VideoCapture
+        :param max_grab_forward: maximal distance to decode forward instead of seeking
+        :param index: KeyframeIndex of video (used once ready) or None
+        :return:
+        """
+        self.filename = filename
+        self.max_grab_forward = max_grab_forward
+        self.index = index
+        self.cap = cv2.VideoCapture(filename)
+
+        # frame number returned by the next cap.read(); None if unknown (after a failure)
+        self.position = 1
+
+    def is_opened(self):
+        return self.cap.isOpened()
+
+    def num_frames(self):
+        return int(np.round(self.cap.get(CAP_PROP_FRAME_COUNT)))
+
+    def frame_shape(self):
+        """
+        :return: (height, width) of frames
+        """
+        shape = (int(self.cap.get(CAP_PROP_FRAME_HEIGHT)), int(self.cap.get(CAP_PROP_FRAME_WIDTH)))
+
+        # some backends don't report size; decode first frame
+        if 0 in shape:
+            frame = self.read(1)
+            shape = frame.shape[:2] if frame is not None else shape
+        return shape
+
+    def fps(self):
+        return self.cap.get(cv2.CAP_PROP_FPS)
+
+    def seek(self, frame_number):
+        """
+        :param frame_number: frame to position the decoder at (next read returns it)
+        :return:
+        """
+        self.cap.set(CAP_PROP_POS_FRAMES, frame_number - 1)
+        self.position = frame_number
+
+    def read(self, frame_number):
+        """
+        :param frame_number: frame to read (1-based)
+        :return: image or None on failure
+        """
+        if self.index is not None and self.index.ready and frame_number <= self.index.num_frames():
+            frame = self._read_indexed(frame_number)
+            if frame is not None:
+                return frame
+
+            # timestamps don't match what the decoder reports; don't trust index for this video
+            logging.warning('VideoSource: keyframe index mismatch, falling back to frame seeking')
+            self.index = None
+            self.position = None
+
+        distance = None if self.position is None else frame_number - self.position
+
+        # seek only when going backwards or jumping far ahead; otherwise decode forward
+        if distance is None or distance < 0 or distance > self.max_grab_forward:
+            self.seek(frame_number)
+        else:
+            for _ in range(distance):
+                if not self.cap.grab():
+                    self.position = None
+                    return None
+
+        ret, frame = self.cap.read()
+        if not ret:
+            logging.warning('VideoSource: failed to read frame {0} of {1}'.format(frame_number, self.filename))
+            self.position = None
+            return None
+
+        self.position = frame_number + 1
+        return frame
+
+    def _read_indexed(self, frame_number):
+        """ read exact frame using keyframe index: decode at most one GOP (plus opencv's seek back-off)
+        :param frame_number: frame to read (1-based)
+        :return: image or None on failure
+        """
+        target = self.index.timestamp(frame_number)
+        tolerance = self.index.tolerance
+
+        # frames decoded by a seek: opencv backs off before the target and decodes forward from the keyframe
+        restart = self.index.keyframe_before(frame_number - OPENCV_SEEK_BACKOFF)
+        seek_cost = frame_number - restart
+
+        # decode forward if that is cheaper than seeking (e.g. a jump within the current GOP)
+        position = self.position
+        if position is None or position > frame_number or frame_number - position > seek_cost:
+            self.seek(frame_number)
+
+        # decode until reaching the requested timestamp
+        while True:
+            if not self.cap.grab():
+                return None
+            timestamp = self.cap.get(CAP_PROP_POS_MSEC)
+
+            # landed after the requested frame (inexact container seek): retry from an earlier keyframe
+            if timestamp > target + tolerance:
+                if restart == 1:
+                    return None
+                restart = self.index.keyframe_before(restart - 1)
+                self.seek(restart)
+                continue
+
+            if timestamp >= target - tolerance:
+                break
+
+        ret, frame = self.cap.retrieve()
+        if not ret:
+            return None
+
+        self.position = frame_number + 1
+        return frame
+
+    def release(self):
+        self.cap.release()
+
+
+def natural_key(name):
+    """ sort key of file names by their numbers' values, e.g. img_2.png before img_10.png """
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', name)]
+
+
+def register_source(source_class):
+    """ add a frame source class; it is asked (accepts) before the classes registered earlier
+    :param source_class: FrameSource subclass, constructed with the filename
+    :return:
+    """
+    SOURCES.insert(0, source_class)
+
+
+def open_source(filename, **options):
+    """
+    :param filename: video, raw video container or image sequence
+    :param options: options of the source, e.g. index of VideoSource (options a source doesn't use are ignored)
+    :return: frame source of filename: of the first registered class that accepts it
+    """
+    for source_class in SOURCES:
+        if source_class.accepts(filename):
+            return source_class(filename, **options)
+    raise ValueError('no frame source reads ' + str(filename))
+
+
+class ImageSequenceSource(FrameSource):
+    """ frames stored one image per file. the files are listed and sorted once, so any frame is read directly
+    (no seeking); images are decoded with cv2.imdecode, .npy arrays are read from a memory map. the sequence is
+    given as
+    - a folder: all its images, sorted by name (numbers by value)
+    - a glob pattern (e.g. frames/*.png), sorted the same way
+    - a printf pattern (e.g. frames/img_%04d.png, as given to cv2.VideoCapture), sorted by frame number
+    - one image of the sequence: the files named like it but for their last number, sorted by that number """
+
+    def __init__(self, filename, threads=IMAGE_READ_THREADS, **options):
+        """
+        :param filename: image sequence (see above)
+        :param threads: number of threads decoding images read with read_range
+        :return:
+        """
+        self.filename = filename
+        self.threads = threads
+        self.files = ImageSequenceSource.list_files(filename)
+
+        # raw arrays (.npy) are copied, not decoded: reading them in parallel gains nothing
+        self.raw = bool(self.files) and os.path.splitext(self.files[0])[1].lower() == '.npy'
+
+        # decoding threads (started on first read_range)
+        self._pool = None
+
+    @classmethod
+    def accepts(cls, filename):
+        return os.path.isdir(filename) or os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS
+
+    @staticmethod
+    def list_files(filename):
+        """
+        :param filename: image sequence (see class)
+        :return: sorted list of the sequence's image files
+        """
+        if os.path.isdir(filename):
+            names = [e.name for e in os.scandir(filename)
+                     if e.is_file() and os.path.splitext(e.name)[1].lower() in IMAGE_EXTENSIONS]
+            return [os.path.join(filename, name) for name in sorted(names, key=natural_key)]
+
+        if glob.has_magic(filename):
+            return sorted(glob.glob(filename), key=lambda f: natural_key(os.path.basename(f)))
+
+        dirname, basename = os.path.split(filename)
+        if re.search(r'%0?\d*d', basename):
+            # printf pattern: the frame number is the formatted field
+            parts = re.split(r'%0?\d*d', basename, maxsplit=1)
+        else:
+            # one image: the frame number is its last number
+            parts = re.split(r'\d+(?=\D*$)', basename, maxsplit=1)
+            if len(parts) == 1:
+                return [filename] if os.path.isfile(filename) else []
+
+        pattern = re.compile(re.escape(parts[0]) + r'(\d+)' + re.escape(parts[1]) + '$')
+        numbered = []
+        try:
+            for entry in os.scandir(dirname or '.'):
+                match = pattern.match(entry.name)
+                if match:
+                    numbered.append((int(match.group(1)), entry.name))
+        except OSError:
+            return []
+        return [os.path.join(dirname, name) for _, name in sorted(numbered)]
+
+    def is_opened(self):
+        return len(self.files) > 0
+
+    def num_frames(self):
+        return len(self.files)
+
+    def frame_shape(self):
+        """
+        :return: (height, width) of frames (of the first image)
+        """
+        if self.raw:
+            return tuple(np.load(self.files[0], mmap_mode='r').shape[:2])
+        frame = self.read(1)
+        return frame.shape[:2] if frame is not None else (0, 0)
+
+    @staticmethod
+    def read_file(filename):
+        """
+        :param filename: image or .npy file
+        :return: BGR (or grayscale) image or None on failure
+        """
+        try:
+            if os.path.splitext(filename)[1].lower() == '.npy':
+                # copied out of the map: cached frames must not hold a file (descriptor) each. very large frames
+                # stay mapped, so only the parts shown are ever read
+                frame = np.load(filename, mmap_mode='r')
+                return frame if frame.nbytes > MAPPED_FRAME_MB * 2 ** 20 else np.array(frame)
+
+            # read and decode separately: cv2.imread can't open non-ascii paths on windows
+            return cv2.imdecode(np.fromfile(filename, dtype=np.uint8), cv2.IMREAD_COLOR)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning('ImageSequenceSource: failed to read {0}: {1}'.format(filename, e))
+            return None
+
+    def read(self, frame_number):
+        """
+        :param frame_number: frame to read (1-based)
+        :return: image or None on failure
+        """
+        if frame_number < 1 or frame_number > len(self.files):
+            return None
+
+        frame = ImageSequenceSource.read_file(self.files[frame_number - 1])
+        if frame is None:
+            logging.warning('ImageSequenceSource: failed to read frame {0} ({1})'.format(
+                frame_number, self.files[frame_number - 1]))
+        return frame
+
+    def read_range(self, first, last):
+        """ read consecutive frames, decoding up to 2 x threads of them ahead in parallel (decoding releases the
+        GIL; raw arrays are read one by one). frames not yet consumed when the generator is closed are cancelled
+        :param first: first frame to read (1-based)
+        :param last: last frame to read (inclusive)
+        :return: generator of (frame_number, image); stops at the first frame that can't be read
+        """
+        if self.threads <= 1 or self.raw:
+            yield from super(ImageSequenceSource, self).read_range(max(first, 1), min(last, len(self.files)))
+            return
+
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix='ImageSequence')
+
+        frame_numbers = range(max(first, 1), min(last, len(self.files)) + 1)
+        to_submit = iter(frame_numbers)
+        pending = deque()
+        try:
+            for frame_number in frame_numbers:
+                # keep the threads busy ahead of the frame returned
+                for f in to_submit:
+                    pending.append(self._pool.submit(self.read, f))
+                    if len(pending) >= 2 * self.threads:
+                        break
+
+                frame = pending.popleft().result()
+                if frame is None:
+                    return
+                yield frame_number, frame
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def release(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+class RawVideoSource(FrameSource):
+    """ video transcoded once (see transcode) into a container of uncompressed frames that is memory mapped:
+    reading a frame is a pointer offset, with neither seeking nor decoding (frames are views of the map, paged in
+    by the OS on use). meant for clips that are revisited many times; costs height x width x 3 bytes per frame """
+
+    # container filename suffix
+    SUFFIX = '.frames'
+
+    # reads cost nothing: no read-ahead (and cache) needed
+    READ_AHEAD = False
+
+    @classmethod
+    def accepts(cls, filename):
+        return os.path.splitext(filename)[1].lower() == RawVideoSource.SUFFIX
+
+    def __init__(self, filename, **options):
+        """
+        :param filename: raw video container (see transcode)
+        :return:
+        """
+        self.filename = filename
+
+        # num_frames x height x width x channels map of the frames; None if the file is missing or not a container
+        self.frames = None
+        self._fps = 0
+
+        try:
+            header = np.fromfile(filename, dtype=RAW_HEADER_DTYPE, count=1)
+            if len(header) == 1 and header['magic'][0] == RAW_MAGIC and header['version'][0] == RAW_VERSION:
+                num_frames, height, width, channels = (int(header[name][0]) for name in
+                                                       ['num_frames', 'height', 'width', 'channels'])
+                shape = (num_frames, height, width, channels) if channels > 1 else (num_frames, height, width)
+                self.frames = np.memmap(filename, dtype=np.uint8, mode='r', offset=RAW_HEADER_SIZE, shape=shape)
+                self._fps = float(header['fps'][0])
+            else:
+                logging.error('RawVideoSource: not a raw video container: ' + filename)
+        except (IOError, OSError, ValueError) as e:
+            logging.error('RawVideoSource: failed to open {0}: {1}'.format(filename, e))
+
+    def is_opened(self):
+        return self.frames is not None
+
+    def num_frames(self):
+        return len(self.frames)
+
+    def frame_shape(self):
+        return self.frames.shape[1:3]
+
+    def fps(self):
+        return self._fps
+
+    def read(self, frame_number):
+        """
+        :param frame_number: frame to read (1-based)
+        :return: read-only image (a view of the map) or None if out of range
+        """
+        if frame_number < 1 or frame_number > len(self.frames):
+            return None
+        return self.frames[frame_number - 1]
+
+    def release(self):
+        # unmapped once no frames (views) are left
+        self.frames = None
+
+
+def transcode(filename, output, progress=None):
+    """ decode a video (or image sequence) once, sequentially, into a raw video container (see RawVideoSource).
+    written to a temporary file first, so an interrupted transcode leaves no partial container
+    :param filename: video or image sequence to transcode (see open_source)
+    :param output: container filename (see RawVideoSource.SUFFIX)
+    :param progress: callable(frames done, total frames) called after each frame, or None
+    :return: number of frames written
+    """
+    source = open_source(filename)
+    if not source.is_opened():
+        raise IOError('failed to open video ' + str(filename))
+
+    total = source.num_frames()
+    header = np.zeros(1, dtype=RAW_HEADER_DTYPE)
+    header['magic'], header['version'], header['fps'] = RAW_MAGIC, RAW_VERSION, source.fps()
+
+    count = 0
+    temp_filename = output + '.tmp'
+    try:
+        with open(temp_filename, 'wb') as f:
+            f.seek(RAW_HEADER_SIZE)
+            for frame_number, frame in source.read_range(1, total):
+                if count == 0:
+                    header['height'], header['width'] = frame.shape[:2]
+                    header['channels'] = frame.shape[2] if frame.ndim == 3 else 1
+                    shape = frame.shape
+                elif frame.shape != shape:
+                    raise ValueError('frame {0} of {1} is {2}, not {3} as the first frame'.format(
+                        frame_number, filename, frame.shape, shape))
+
+                f.write(np.ascontiguousarray(frame).data)
+                count += 1
+                if progress:
+                    progress(count, total)
+
+            # frame counts reported by containers are estimates: record the frames actually decoded
+            header['num_frames'] = count
+            f.seek(0)
+            f.write(header.tobytes())
+
+        if count == 0:
+            raise IOError('no frames read from ' + str(filename))
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    finally:
+        source.release()
+
+    os.replace(temp_filename, output)
+    logging.info('transcode: {0} frames of {1} written to {2}'.format(count, filename, output))
+    return count
+
+
+# frame source classes, in the order open_source asks them (video last: it takes anything)
+SOURCES = [RawVideoSource, ImageSequenceSource, VideoSource]
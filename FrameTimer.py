@@ -0,0 +1,127 @@
+import csv
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+# default number of frame steps kept for statistics
+HISTORY_FRAMES = 500
+
+# reported percentiles
+PERCENTILES = (50, 95, 99)
+
+# name of the whole-step pseudo stage
+TOTAL = 'total'
+
+
+class FrameTimer(object):
+    """ per-stage wall clock timing of frame steps. stages are timed with stage(name) while a step is open and
+    summed per step; the last steps are kept for percentiles. not thread safe: time the GUI thread only """
+
+    def __init__(self, history=HISTORY_FRAMES):
+        """
+        :param history: number of (most recent) frame steps kept
+        :return:
+        """
+        # stage names, in order of first use
+        self.stages = []
+
+        # (frame number, {stage: seconds}) of completed steps, oldest first
+        self.steps = deque(maxlen=history)
+
+        # step being timed: start time and stage times
+        self._start = None
+        self._current = {}
+
+    def begin(self):
+        """ open a frame step (stages timed before begin are added to the next step) """
+        if self._start is None:
+            self._start = time.perf_counter()
+
+    def end(self, frame_number):
+        """ close the open frame step
+        :param frame_number: frame the step ended on
+        :return:
+        """
+        if self._start is None:
+            return
+        self._current[TOTAL] = time.perf_counter() - self._start
+        self.steps.append((frame_number, self._current))
+        self._start = None
+        self._current = {}
+
+    @contextmanager
+    def stage(self, name):
+        """ time a stage of the current frame step (opens a step if none is open)
+        :param name: stage name
+        :return:
+        """
+        self.begin()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if name not in self.stages:
+                self.stages.append(name)
+            self._current[name] = self._current.get(name, 0) + time.perf_counter() - start
+
+    def clear(self):
+        self.steps.clear()
+        self._start = None
+        self._current = {}
+
+    def percentiles(self, name=TOTAL):
+        """
+        :param name: stage name
+        :return: times (ms) at PERCENTILES over the kept steps that timed the stage; None if there are none
+        """
+        times = [stages[name] for _, stages in self.steps if name in stages]
+        if not times:
+            return None
+        return np.percentile(times, PERCENTILES) * 1000
+
+    def summary(self):
+        """
+        :return: one line per stage (and total): name, count, mean and percentiles in ms
+        """
+        lines = []
+        for name in self.stages + [TOTAL]:
+            times = [stages[name] for _, stages in self.steps if name in stages]
+            if not times:
+                continue
+            values = np.percentile(times, PERCENTILES) * 1000
+            lines.append('{0:<12} n={1:<5d} mean={2:7.2f} '.format(name, len(times), np.mean(times) * 1000) +
+                         ' '.join('p{0}={1:7.2f}'.format(p, v) for p, v in zip(PERCENTILES, values)) + ' ms')
+        return lines
+
+    def status(self):
+        """
+        :return: short text for a status bar: the last step's stage times and total percentiles
+        """
+        if not self.steps:
+            return ''
+        _, last = self.steps[-1]
+        text = ' '.join('{0} {1:.1f}'.format(name, last[name] * 1000) for name in self.stages if name in last)
+        p50, p95, p99 = self.percentiles()
+        return '{0} | total {1:.1f} ms (p50 {2:.1f} p95 {3:.1f} p99 {4:.1f})'.format(
+            text, last[TOTAL] * 1000, p50, p95, p99)
+
+    def log(self):
+        """ write the summary to the log """
+        logging.info('FrameTimer: {0} frame steps'.format(len(self.steps)))
+        for line in self.summary():
+            logging.info('FrameTimer: ' + line)
+
+    def write_csv(self, filename):
+        """ write the kept steps, one row per step: frame number and stage times in ms (empty if not timed)
+        :param filename: output .csv file
+        :return:
+        """
+        names = self.stages + [TOTAL]
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frame'] + [name + '_ms' for name in names])
+            for frame_number, stages in self.steps:
+                writer.writerow([frame_number] + ['{0:.3f}'.format(stages[name] * 1000) if name in stages else ''
+                                                  for name in names])
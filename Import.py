@@ -0,0 +1,219 @@
+import os
+import csv
+import json
+import logging
+import contextlib
+import collections
+import numpy as np
+
+# project imports
+import Annotation
+
+# supported input formats
+SUFFIXES = ['.jsonl', '.csv', '.npy', '.npz']
+
+# rows inserted (and committed) per transaction
+CHUNK_SIZE = 50000
+
+
+def box_contour(x, y, width, height):
+    """
+    :return: contour (x, y, x, y, ...) of a bounding box: its 4 corners, clockwise from top left
+    """
+    return [x, y, x + width, y, x + width, y + height, x, y + height]
+
+
+def boxes_contours(boxes):
+    """
+    :param boxes: N x 4 array of (x, y, width, height) bounding boxes
+    :return: N x 8 int32 array of box contours (see box_contour)
+    """
+    x, y, w, h = np.rint(np.asarray(boxes, dtype=np.float64)).T
+    return np.stack([x, y, x + w, y, x + w, y + h, x, y + h], axis=1).astype(Annotation.CONTOUR_DTYPE)
+
+
+def source_id(value):
+    """
+    :param value: object ID of a detection in the input (its track), if any
+    :return: integer ID, or None for untracked detections (missing, empty or negative)
+    """
+    if value is None or value == '':
+        return None
+    value = int(value)
+    return value if value >= 0 else None
+
+
+def read_jsonl(filename):
+    """ one JSON object per line: {"frame": 1, "class": "car", "contour": [x, y, x, y, ...], "object": 7}.
+    "bbox": [x, y, width, height] can be given instead of "contour"; "object" (the detector's track) is optional
+    :return: generator of (frame_number, source object ID, class name, contour)
+    """
+    with open(filename) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                d = json.loads(line)
+                contour = d['contour'] if 'contour' in d else box_contour(*d['bbox'])
+                yield int(d['frame']), source_id(d.get('object')), str(d['class']), contour
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError('{0}:{1:d}: bad detection ({2})'.format(filename, line_number, e))
+
+
+def read_csv(filename):
+    """ comma separated with a header: frame, class and either contour (space separated x y x y ...) or x, y,
+    width and height (bounding box); object (the detector's track) is optional
+    :return: generator of (frame_number, source object ID, class name, contour)
+    """
+    with open(filename, newline='') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            try:
+                if row.get('contour') is not None:
+                    contour = np.array(row['contour'].split(), dtype=Annotation.CONTOUR_DTYPE)
+                else:
+                    contour = box_contour(*(int(round(float(row[k]))) for k in ['x', 'y', 'width', 'height']))
+                yield int(row['frame']), source_id(row.get('object')), row['class'], contour
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError('{0}:{1:d}: bad detection ({2})'.format(filename, reader.line_num, e))
+
+
+def read_numpy(filename, chunk_size=CHUNK_SIZE):
+    """ .npz with arrays (or .npy structured array with fields) frame (N), class (N, names or numbers), and either
+    contour (N x 2K) or bbox (N x 4: x, y, width, height); object (N, the detector's track) is optional.
+    .npy files are memory mapped, so they are never loaded whole (.npz members are, once each)
+    :return: generator of (frame_number, source object ID, class name, contour)
+    """
+    if os.path.splitext(filename)[1] == '.npz':
+        data = np.load(filename, allow_pickle=False)
+        fields = data.files
+    else:
+        data = np.load(filename, mmap_mode='r', allow_pickle=False)
+        fields = data.dtype.names or []
+
+    for name in ['frame', 'class']:
+        if name not in fields:
+            raise ValueError('{0}: no "{1}" array'.format(filename, name))
+    if 'contour' not in fields and 'bbox' not in fields:
+        raise ValueError('{0}: no "contour" or "bbox" array'.format(filename))
+
+    # each .npz member is read (and decompressed) whole on every access: once only. fields of a .npy are views of
+    # its map
+    arrays = {name: data[name] for name in fields}
+
+    frames = arrays['frame']
+    for start in range(0, len(frames), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        if 'contour' in fields:
+            contours = np.asarray(arrays['contour'][chunk], dtype=Annotation.CONTOUR_DTYPE)
+        else:
+            contours = boxes_contours(arrays['bbox'][chunk])
+        ids = np.asarray(arrays['object'][chunk]).tolist() if 'object' in fields else [None] * len(contours)
+        classes = [str(c) for c in np.asarray(arrays['class'][chunk]).tolist()]
+
+        for frame_number, obj_id, class_name, contour in zip(np.asarray(frames[chunk]).tolist(), ids, classes,
+                                                              contours):
+            yield frame_number, (obj_id if obj_id is not None and obj_id >= 0 else None), class_name, contour
+
+
+def read_detections(filename):
+    """
+    :param filename: .jsonl, .csv, .npy or .npz detections file (see read_jsonl, read_csv, read_numpy)
+    :return: generator of (frame_number, source object ID, class name, contour)
+    """
+    suffix = os.path.splitext(filename)[1].lower()
+    if suffix == '.jsonl':
+        return read_jsonl(filename)
+    if suffix == '.csv':
+        return read_csv(filename)
+    if suffix in ['.npy', '.npz']:
+        return read_numpy(filename)
+    raise ValueError('unsupported import format ' + suffix)
+
+
+def import_detections(annotation, detections, class_map=None, add_classes=True, final=False, defer_indexes=None,
+                      chunk_size=CHUNK_SIZE):
+    """ insert detections into an annotation (as predictions, by default), streaming. each chunk of rows is
+    inserted with a single statement and committed, so a failed import keeps the chunks before it.
+    every object gets a new ID above the annotation's largest: detections with the same source ID (track) and
+    class become one object, untracked detections become an object each. an object is in a frame at most once: later
+    detections of its track in the same frame are skipped
+    :param annotation: Annotation to insert into (opened without its video, frame numbers are not checked against
+    the video's length)
+    :param detections: iterable of (frame_number, source object ID or None, class name, contour) (see
+    read_detections)
+    :param class_map: dict of input class name -> annotation class name (names not in it are kept)
+    :param add_classes: add classes missing from the annotation; if False their detections are skipped
+    :param final: insert as final objects instead of predictions
+    :param defer_indexes: build the database indexes after inserting (see Annotation.deferred_indexes) instead of
+    updating them per row. None: once the import outgrows the annotation (rebuilding is then the cheaper)
+    :param chunk_size: rows per transaction
+    :return: (rows inserted, objects created, rows skipped)
+    """
+    class_map = class_map or {}
+    classes = set(annotation.classes())
+    num_frames = annotation.num_frames
+    existing = annotation.count_records() if defer_indexes is None else 0
+
+    # (source ID, class) -> annotation ID, and the frames each (tracked) object was imported in
+    ids = {}
+    object_frames = collections.defaultdict(set)
+    inserted = skipped = objects = 0
+    chunk = []
+
+    with contextlib.ExitStack() as stack:
+        deferred = False
+
+        def insert():
+            nonlocal deferred
+            if not deferred and defer_indexes is not False and (defer_indexes or inserted + len(chunk) > existing):
+                stack.enter_context(annotation.deferred_indexes())
+                deferred = True
+
+            with annotation.transaction():
+                annotation.add_many(chunk)
+            annotation.commit()
+
+        for frame_number, obj_id, class_name, contour in detections:
+            class_name = class_map.get(class_name, class_name)
+            if frame_number < 1 or (num_frames is not None and frame_number > num_frames) or len(contour) < 2:
+                skipped += 1
+                continue
+
+            if class_name not in classes:
+                if not add_classes:
+                    skipped += 1
+                    continue
+                annotation.add_class(class_name)
+                classes.add(class_name)
+
+            if obj_id is None:
+                new_id = annotation.get_new_id()
+                objects += 1
+            else:
+                new_id = ids.get((obj_id, class_name))
+                if new_id is None:
+                    new_id = ids[(obj_id, class_name)] = annotation.get_new_id()
+                    objects += 1
+
+                # (frame, object) is unique in an annotation: keep the first detection
+                if frame_number in object_frames[new_id]:
+                    skipped += 1
+                    continue
+                object_frames[new_id].add(frame_number)
+
+            chunk.append((frame_number, new_id, class_name, contour, final))
+            if len(chunk) >= chunk_size:
+                insert()
+                inserted += len(chunk)
+                chunk = []
+
+        if chunk:
+            insert()
+            inserted += len(chunk)
+
+    if skipped:
+        logging.warning('Import: skipped {0:d} detections (frame out of range, empty contour, unknown class or '
+                        'object already in frame)'.format(skipped))
+    logging.info('Import: {0:d} detections of {1:d} objects'.format(inserted, objects))
+    return inserted, objects, skipped
@@ -0,0 +1,202 @@
+import os
+import math
+import logging
+import threading
+import numpy as np
+import cv2
+
+# project imports
+import FrameSource
+
+# thumbnail height in pixels (width follows the video's aspect ratio)
+THUMBNAIL_HEIGHT = 90
+
+# maximal number of thumbnails of a video; longer videos keep every stride-th frame. a slider is a few thousand
+# pixels wide at most, so more thumbnails could not be told apart while dragging it
+MAX_THUMBNAILS = 4096
+
+# thumbnails decoded between updates of the file's progress count (a stopped build resumes from there)
+FLUSH_INTERVAL = 64
+
+# store file layout: header, then count x height x width x 3 (BGR) thumbnails
+MAGIC = b'ATCTHUMB'
+VERSION = 1
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<i4'), ('num_frames', '<i4'), ('stride', '<i4'),
+                         ('count', '<i4'), ('height', '<i4'), ('width', '<i4'), ('done', '<i4'),
+                         ('video_size', '<i8'), ('video_mtime', '<i8')])
+HEADER_SIZE = 64
+
+
+class ThumbnailStore(object):
+    """ downscaled frames of a video in one memory-mapped file, for previewing frames while the frame slider is
+    dragged. built once by decoding the video sequentially in the background (thumbnails can be used as soon as
+    they are decoded) and kept next to the annotation, so later sessions map it without decoding anything """
+
+    # store filename suffix (appended to the annotation filename)
+    SUFFIX = '.thumbs'
+
+    def __init__(self, filename, video_filename, num_frames, frame_shape, index=None, height=THUMBNAIL_HEIGHT,
+                 max_thumbnails=MAX_THUMBNAILS):
+        """
+        :param filename: store file (see SUFFIX)
+        :param video_filename: video or image sequence to read (see FrameSource.open_source)
+        :param num_frames: number of frames in video
+        :param frame_shape: (height, width) of video frames (not empty)
+        :param index: FrameSource.KeyframeIndex of video or None (exact seeking when resuming a build)
+        :param height: thumbnail height in pixels
+        :param max_thumbnails: maximal number of thumbnails (sets the stride between thumbnail frames)
+        :return:
+        """
+        self.filename = filename
+        self.video_filename = video_filename
+        self.num_frames = num_frames
+        self.index = index
+
+        # thumbnail i shows frame i * stride + 1
+        self.stride = max(1, int(math.ceil(num_frames / float(max_thumbnails))))
+        self.count = int(math.ceil(num_frames / float(self.stride)))
+
+        # thumbnail (height, width): no upscaling of small videos
+        frame_height, frame_width = frame_shape
+        if frame_height <= 0 or frame_width <= 0:
+            raise ValueError('ThumbnailStore: empty frame shape {0}'.format(tuple(frame_shape)))
+        thumbnail_height = max(1, min(height, frame_height))
+        self.shape = (thumbnail_height, max(1, int(round(frame_width * thumbnail_height / float(frame_height)))))
+
+        # mapped file, its header and thumbnails (None until opened)
+        self._map = None
+        self.header = None
+        self.thumbnails = None
+
+        # number of thumbnails decoded (from the start); the rest are not available yet
+        self.done = 0
+
+        self._thread = None
+        self._stopped = False
+
+    def _signature(self):
+        """ identifies the video version (size and modification time); image patterns have none """
+        try:
+            stat = os.stat(self.video_filename)
+            return stat.st_size, int(stat.st_mtime)
+        except OSError:
+            return 0, 0
+
+    def _header(self):
+        """
+        :return: header describing this store (nothing decoded yet)
+        """
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header['magic'], header['version'], header['num_frames'] = MAGIC, VERSION, self.num_frames
+        header['stride'], header['count'] = self.stride, self.count
+        header['height'], header['width'] = self.shape
+        header['video_size'], header['video_mtime'] = self._signature()
+        return header
+
+    def open(self):
+        """ map the store file; a missing or stale file (other video, version or size) is recreated empty
+        :return: True if the store can be used
+        """
+        expected = self._header()
+        size = HEADER_SIZE + self.count * self.shape[0] * self.shape[1] * 3
+
+        try:
+            valid = False
+            if os.path.exists(self.filename) and os.path.getsize(self.filename) == size:
+                existing = np.fromfile(self.filename, dtype=HEADER_DTYPE, count=1)
+                valid = all(existing[name] == expected[name] for name in HEADER_DTYPE.names if name != 'done')
+
+            if valid:
+                self._map = np.memmap(self.filename, dtype=np.uint8, mode='r+', shape=(size,))
+            else:
+                logging.info('ThumbnailStore: creating ' + self.filename)
+                self._map = np.memmap(self.filename, dtype=np.uint8, mode='w+', shape=(size,))
+                self._map[:HEADER_DTYPE.itemsize] = expected.view(np.uint8)
+        except (IOError, OSError, ValueError) as e:
+            # e.g. read-only annotation folder; slider previews are then not available
+            logging.warning('ThumbnailStore: could not open {0}: {1}'.format(self.filename, e))
+            self._map = None
+            return False
+
+        self.header = self._map[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)
+        self.thumbnails = self._map[HEADER_SIZE:].reshape(self.count, self.shape[0], self.shape[1], 3)
+        self.done = int(self.header['done'][0])
+        return True
+
+    def get(self, frame_number):
+        """
+        :param frame_number: frame to preview (1-based)
+        :return: BGR thumbnail of the frame (or of the last stored frame before it), or None if not decoded yet.
+        a view of the mapped file: don't keep it after the store is closed
+        """
+        i = (frame_number - 1) // self.stride
+        if self.thumbnails is None or i < 0 or i >= self.done:
+            return None
+        return self.thumbnails[i]
+
+    def build(self):
+        """ decode thumbnails not in the store yet, sequentially (frames between thumbnails are decoded forward,
+        never seeked to) """
+        if self.done >= self.count:
+            return
+
+        logging.info('ThumbnailStore: decoding {0} thumbnails (every {1} frames) of {2}'.format(
+            self.count - self.done, self.stride, self.video_filename))
+        source = FrameSource.open_source(self.video_filename, max_grab_forward=self.stride, index=self.index)
+        if not source.is_opened():
+            logging.error('ThumbnailStore: failed to open video ' + str(self.video_filename))
+            return
+
+        height, width = self.shape
+        for i in range(self.done, self.count):
+            if self._stopped:
+                break
+
+            frame = source.read(i * self.stride + 1)
+            if frame is None:
+                break
+            # very large frames (e.g. memory mapped gigapixel stills) are sampled first: every pixel is not needed
+            step = frame.shape[0] // (height * 4)
+            if step > 1:
+                frame = np.ascontiguousarray(frame[::step, ::step])
+            if frame.ndim == 2:
+                frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+            self.thumbnails[i] = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+            # publish only once written
+            self.done = i + 1
+            if self.done % FLUSH_INTERVAL == 0:
+                self._save_progress()
+
+        source.release()
+        self._save_progress()
+        if self.done == self.count:
+            logging.info('ThumbnailStore: {0} thumbnails ready'.format(self.count))
+
+    def _save_progress(self):
+        """ record the decoded thumbnails in the file (after writing them out) """
+        self._map.flush()
+        self.header['done'] = self.done
+        self._map.flush()
+
+    def start(self):
+        """ open and build in background
+        :return:
+        """
+        if not self.open():
+            return
+        self._thread = threading.Thread(target=self.build, name='ThumbnailStore', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ stop building (progress is kept) and close the file """
+        self._stopped = True
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+        # unmapped once no views of it are left
+        self.done = 0
+        if self._map is not None:
+            self._map.flush()
+        self._map = self.header = self.thumbnails = None
@@ -1,10 +1,313 @@
+import logging
+import numpy as np
+import cv2
+
+# default tracking backend (see BACKENDS)
+BACKEND = 'optical_flow'
+
+# number of prepared frames kept by a tracker (predictions are made from a frame to the next one)
+FRAME_CACHE_FRAMES = 4
+
+
+def contour_to_points(contour):
+    """
+    :param contour: sequence of integers in format (x, y, x, y, ...)
+    :return: N x 2 float32 array of (x, y) points
+    """
+    return np.asarray(contour, dtype=np.float32).reshape(-1, 2)
+
+
+def points_to_contour(points, shape):
+    """
+    :param points: N x 2 array of (x, y) points
+    :param shape: (height, width) of image to clip the points to
+    :return: int32 array in format (x, y, x, y, ...)
+    """
+    points = np.rint(points)
+    points[:, 0] = np.clip(points[:, 0], 0, shape[1] - 1)
+    points[:, 1] = np.clip(points[:, 1], 0, shape[0] - 1)
+    return points.astype(np.int32).ravel()
+
+
+class Backend(object):
+    """ tracking backend interface """
+
+    def prepare(self, image):
+        """ per-frame preprocessing, shared by all objects tracked from / to the frame
+        :param image: grayscale image
+        :return: frame data passed to predict
+        """
+        return image
+
+    def predict(self, prev_frame, next_frame, points):
+        """
+        :param prev_frame: prepared frame the points are in
+        :param next_frame: prepared frame to predict the points in
+        :param points: N x 2 float32 contour points
+        :return: N x 2 predicted points or None if the object was lost
+        """
+        raise NotImplementedError
+
+
+class IdentityBackend(Backend):
+    """ no tracking: the object stays where it is """
+
+    def predict(self, prev_frame, next_frame, points):
+        return points
+
+
+class OpticalFlowBackend(Backend):
+    """ pyramidal Lucas-Kanade optical flow of the contour points. points that don't track back to where they
+    started are dropped, and a rotation + scale + translation fitted to the rest moves the whole contour (so it
+    keeps its shape). flow is computed on a region around the object only, so the cost depends on the object's
+    size rather than the frame's """
+
+    def __init__(self, window=21, levels=3, max_error=1.0, max_points=32):
+        """
+        :param window: optical flow window size (pixels)
+        :param levels: number of pyramid levels (motion of up to about window * 2 ** levels pixels)
+        :param max_error: maximal forward-backward error (pixels) of a point to be used
+        :param max_points: maximal number of (evenly spaced) contour points to compute flow for
+        :return:
+        """
+        self.lk_params = dict(winSize=(window, window), maxLevel=levels,
+                              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+        self.max_error = max_error
+        self.max_points = max_points
+
+        # region margin around the object: the motion range of the coarsest pyramid level
+        self.margin = window * 2 ** levels // 2
+
+    def predict(self, prev_frame, next_frame, points):
+        # region around object (same in both frames)
+        height, width = prev_frame.shape[:2]
+        x, y, w, h = cv2.boundingRect(np.rint(points).astype(np.int32))
+        x0, y0 = max(x - self.margin, 0), max(y - self.margin, 0)
+        x1, y1 = min(x + w + self.margin, width), min(y + h + self.margin, height)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        offset = np.array([x0, y0], dtype=np.float32)
+        prev_region = prev_frame[y0:y1, x0:x1]
+        next_region = next_frame[y0:y1, x0:x1]
+
+        # forward and backward flow (in region coordinates) of a subset of the points; the fitted motion
+        # moves them all
+        pts = (points - offset).reshape(-1, 1, 2)
+        step = -(-len(pts) // self.max_points)
+        samples = np.ascontiguousarray(pts[::step])
+        forward, status_f, _ = cv2.calcOpticalFlowPyrLK(prev_region, next_region, samples, None, **self.lk_params)
+        backward, status_b, _ = cv2.calcOpticalFlowPyrLK(next_region, prev_region, forward, None,
+                                                         **self.lk_params)
+
+        error = np.linalg.norm((samples - backward).reshape(-1, 2), axis=1)
+        good = (status_f.ravel() == 1) & (status_b.ravel() == 1) & (error < self.max_error)
+        if not good.any():
+            return None
+
+        src = samples[good].reshape(-1, 2)
+        dst = forward[good].reshape(-1, 2)
+
+        # too few points for a transform: move by median displacement
+        if len(src) < 3:
+            return points + np.median(dst - src, axis=0)
+
+        transform, _ = cv2.estimateAffinePartial2D(src, dst, method=cv2.RANSAC, ransacReprojThreshold=2.0)
+        if transform is None:
+            return points + np.median(dst - src, axis=0)
+
+        return cv2.transform(pts, transform).reshape(-1, 2) + offset
+
+
+class TemplateBackend(Backend):
+    """ normalized cross-correlation of the object's bounding box in a search window around it; translation
+    only """
+
+    def __init__(self, margin=0.5, min_margin=16, min_score=0.5):
+        """
+        :param margin: search window margin as a fraction of the bounding box size
+        :param min_margin: minimal search window margin (pixels)
+        :param min_score: minimal correlation of a match (lower is considered lost)
+        :return:
+        """
+        self.margin = margin
+        self.min_margin = min_margin
+        self.min_score = min_score
+
+    def predict(self, prev_frame, next_frame, points):
+        # prepared frames are the grayscale images
+        prev_image, next_image = prev_frame, next_frame
+        height, width = prev_image.shape[:2]
+
+        # bounding box of object, clipped to image
+        x, y, w, h = cv2.boundingRect(np.rint(points).astype(np.int32))
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, width), min(y + h, height)
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            return None
+        template = prev_image[y0:y1, x0:x1]
+
+        # search window around bounding box
+        mx = max(int(self.margin * (x1 - x0)), self.min_margin)
+        my = max(int(self.margin * (y1 - y0)), self.min_margin)
+        sx0, sy0 = max(x0 - mx, 0), max(y0 - my, 0)
+        sx1, sy1 = min(x1 + mx, width), min(y1 + my, height)
+        window = next_image[sy0:sy1, sx0:sx1]
+
+        scores = cv2.matchTemplate(window, template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (bx, by) = cv2.minMaxLoc(scores)
+        if score < self.min_score:
+            return None
+
+        return points + np.array([sx0 + bx - x0, sy0 + by - y0], dtype=np.float32)
+
+
+# available backends by name
+BACKENDS = {'none': IdentityBackend, 'optical_flow': OpticalFlowBackend, 'template': TemplateBackend}
+
+
 class Tracker:
 
-    def __init__(self, db):
+    def __init__(self, db, backend=BACKEND):
+        """
+        :param db: Annotation to read video frames from
+        :param backend: name of tracking backend (see BACKENDS)
+        :return:
+        """
         #   database
         self.db = db
 
+        # frame number -> frame prepared by backend (most recent last)
+        self._frames = {}
+
+        self.backend_name = None
+        self.backend = None
+        self.set_backend(backend)
+
+    def set_backend(self, backend):
+        """
+        :param backend: name of tracking backend (see BACKENDS)
+        :return:
+        """
+        if backend not in BACKENDS:
+            raise ValueError('unknown tracker backend ' + str(backend))
+        self.backend_name = backend
+        self.backend = BACKENDS[backend]()
+        self._frames = {}
+
+    def frame(self, frame_number):
+        """
+        :param frame_number: video frame
+        :return: (shape, frame prepared by backend), prepared once per frame, or None if it can't be read
+        """
+        prepared = self._frames.get(frame_number)
+        if prepared is not None:
+            return prepared
+
+        image = self.db.read_frame(frame_number)
+        if image is None:
+            return None
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        prepared = self._frames[frame_number] = image.shape, self.backend.prepare(image)
+        while len(self._frames) > FRAME_CACHE_FRAMES:
+            self._frames.pop(next(iter(self._frames)))
+        return prepared
+
+    def step(self, frame_number):
+        """ prepare tracking from frame_number to the next frame. reads the video, so call it from the thread that
+        owns the annotation; the result can be passed to predict on any thread
+        :param frame_number: frame the contours are in
+        :return: (backend, frame_number, prepared frame, prepared next frame) or None if frames can't be read
+        """
+        prev_frame = self.frame(frame_number)
+        next_frame = self.frame(frame_number + 1)
+        if prev_frame is None or next_frame is None:
+            return None
+        return self.backend, frame_number, prev_frame, next_frame
+
     @staticmethod
-    def track(points, frame_number, obj_id):
-        # TODO: add 'real' tracking
-        return points
+    def predict(step, points, obj_id):
+        """ thread safe (doesn't touch the tracker or the annotation)
+        :param step: as returned by Tracker.step()
+        :param points: contour in step's frame, format (x, y, x, y, ...)
+        :param obj_id: tracked object
+        :return: predicted contour in the next frame (int32 array); the contour itself if it can't be tracked
+        """
+        backend, frame_number, prev_frame, next_frame = step
+        if len(points) == 0:
+            return points
+
+        prediction = backend.predict(prev_frame[1], next_frame[1], contour_to_points(points))
+        if prediction is None:
+            logging.info('Tracker: lost object {0} in frame {1}'.format(obj_id, frame_number + 1))
+            return points
+
+        return points_to_contour(prediction, next_frame[0])
+
+    def track(self, points, frame_number, obj_id):
+        """ predict object contour in the next frame
+        :param points: contour in frame_number, format (x, y, x, y, ...)
+        :param frame_number: frame the contour is in
+        :param obj_id: tracked object
+        :return: predicted contour in frame_number + 1 (same format); the contour itself if it can't be tracked
+        """
+        if len(points) == 0 or isinstance(self.backend, IdentityBackend):
+            return points
+
+        step = self.step(frame_number)
+        if step is None:
+            return points
+
+        return Tracker.predict(step, points, obj_id)
+
+
+def propagate(source, frame_number, objects, last_frame, backend=BACKEND, stop_frames=None, cancelled=None):
+    """ track objects forward over many frames, decoding the video once, sequentially
+    :param source: frame source to read frames from (see FrameSource.open_source; owned by the calling thread)
+    :param frame_number: frame the objects are in
+    :param objects: dict of obj_id -> contour in frame_number, format (x, y, x, y, ...)
+    :param last_frame: last frame to predict objects in
+    :param backend: name of tracking backend (see BACKENDS)
+    :param stop_frames: dict of obj_id -> frame in which the object is final (tracking the object stops before)
+    :param cancelled: callable; propagation stops once it returns True
+    :return: generator of (frame_number, [(obj_id, contour), ...]) of predictions in each following frame
+    """
+    backend = BACKENDS[backend]()
+    stop_frames = stop_frames or {}
+    contours = {obj_id: contour_to_points(contour) for obj_id, contour in objects.items() if len(contour) > 0}
+
+    def prepare(f):
+        image = source.read(f)
+        if image is None:
+            return None
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image.shape, backend.prepare(image)
+
+    prev_frame = prepare(frame_number)
+    for f in range(frame_number + 1, last_frame + 1):
+        # objects that are final in this frame are left alone from here on
+        for obj_id in [o for o in contours if stop_frames.get(o) == f]:
+            del contours[obj_id]
+
+        if not contours or prev_frame is None or (cancelled and cancelled()):
+            return
+
+        next_frame = prepare(f)
+        if next_frame is None:
+            logging.warning('Tracker: failed to read frame {0}; propagation stopped'.format(f))
+            return
+
+        predictions = []
+        for obj_id, points in list(contours.items()):
+            prediction = backend.predict(prev_frame[1], next_frame[1], points)
+            if prediction is None:
+                logging.info('Tracker: lost object {0} in frame {1}'.format(obj_id, f))
+                del contours[obj_id]
+                continue
+            contours[obj_id] = prediction.astype(np.float32)
+            predictions.append((obj_id, points_to_contour(prediction, next_frame[0])))
+
+        yield f, predictions
+        prev_frame = next_frame
@@ -0,0 +1,239 @@
+""" interactive hot paths of the GUI, driven headless (QT_QPA_PLATFORM=offscreen) on a synthetic video and
+annotation: frame stepping (AnnotationTool.update, rendered), seeking, AnnotationScene.load / add_contour, the
+undo commands (draw-commit latency) and export throughput. results are printed and written as JSON (--output)
+
+usage (from repository root):
+    python -m benchmarks.bench_gui [--frames 200] [--objects 50] [--points 32] [--output gui.json]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+
+# no display needed
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+import AnnotationTool
+import AnnotationToolGS
+import Export
+from benchmarks import synthetic
+from benchmarks.bench_storage import summarize, revision
+
+
+def process_events(tool):
+    """ deliver pending events (e.g. finished track jobs) and paint the view now """
+    QtWidgets.QApplication.processEvents()
+    tool.graphicsView.viewport().repaint()
+
+
+def bench_step(tool, key, steps):
+    """ step through frames with the arrow keys, as the user does (right arrow also tracks objects forward)
+    :return: list of durations (seconds) from key press to painted frame
+    """
+    times = []
+    event = QtGui.QKeyEvent(QtCore.QEvent.KeyPress, key, QtCore.Qt.NoModifier)
+    for _ in range(steps):
+        start = time.perf_counter()
+        tool.keyPressEvent(event)
+        process_events(tool)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_seek(tool, frames):
+    """ jump to frames (as the frame edit box / slider do)
+    :return: list of durations (seconds) to painted frame
+    """
+    times = []
+    for frame_number in frames:
+        start = time.perf_counter()
+        tool.annotation.set_frame(frame_number)
+        tool.update()
+        process_events(tool)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_load(scene, annotation, frames):
+    """
+    :return: (durations of scene.load of consecutive frames (items reused), durations on an empty scene)
+    """
+    warm, cold = [], []
+    for frame_number in frames:
+        records = annotation.get(frame_number)
+        start = time.perf_counter()
+        scene.load(frame_number, records)
+        warm.append(time.perf_counter() - start)
+
+    for frame_number in frames:
+        records = annotation.get(frame_number)
+        for obj_id in list(scene.obj2contour):
+            scene.remove_contour(obj_id)
+        start = time.perf_counter()
+        scene.load(frame_number, records)
+        cold.append(time.perf_counter() - start)
+    return warm, cold
+
+
+def bench_add_contour(scene, annotation, count, contour):
+    """
+    :return: list of durations (seconds) of add_contour of new objects (removed afterwards)
+    """
+    times = []
+    ids = [annotation.max_id + 1 + i for i in range(count)]
+    for obj_id in ids:
+        start = time.perf_counter()
+        scene.add_contour(contour, obj_id, 'car', True)
+        times.append(time.perf_counter() - start)
+    for obj_id in ids:
+        scene.remove_contour(obj_id)
+    return times
+
+
+def bench_commands(tool, repeat, contour):
+    """ push (draw-commit), undo and redo of each command, painted, on the current frame
+    :return: dict of name -> list of durations (seconds)
+    """
+    scene, annotation = tool.scene, tool.annotation
+    rng = random.Random(0)
+    results = {}
+
+    def timed(name, function):
+        start = time.perf_counter()
+        function()
+        process_events(tool)
+        results.setdefault(name, []).append(time.perf_counter() - start)
+
+    def moved(obj_id, dx):
+        item = scene.obj2contour[obj_id]
+        polygon = QtGui.QPolygonF([p + QtCore.QPointF(dx, dx) for p in item.polygon()])
+        return AnnotationToolGS.AnnotationObject(polygon, item.pen(), item.color, item.final)
+
+    for _ in range(repeat):
+        obj_id = annotation.get_new_id()
+        timed('AddCommand', lambda: scene.command_stack.push(
+            AnnotationToolGS.AddCommand(scene, scene.frame_number, obj_id, 'car', contour)))
+
+        existing = rng.choice(sorted(scene.obj2contour))
+        timed('ModifyCommand', lambda: scene.command_stack.push(
+            AnnotationToolGS.ModifyCommand(scene, scene.frame_number, existing, 'car', contour + 5)))
+        timed('MoveCommand', lambda: scene.command_stack.push(
+            AnnotationToolGS.MoveCommand(scene, scene.frame_number, existing, 'car', moved(existing, 3))))
+        timed('DeleteCommand', lambda: scene.command_stack.push(
+            AnnotationToolGS.DeleteCommand(scene, scene.frame_number, existing, 'car')))
+
+        for _ in range(4):
+            timed('undo', scene.command_stack.undo)
+        for _ in range(4):
+            timed('redo', scene.command_stack.redo)
+        for _ in range(4):
+            timed('undo', scene.command_stack.undo)
+    return results
+
+
+def bench_export(tool, dirname, workers):
+    """ export all frames as the Export menu does (.tiff ID images, with the progress dialog)
+    :return: (frames written, seconds)
+    """
+    start = time.perf_counter()
+    job = Export.ExportJob(tool.annotation, dirname, 'frame', '.tiff', workers=workers)
+    count = sum(1 for _ in AnnotationTool.progress(job, 'Export Progress', 'Abort'))
+    return count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=200, help='video / annotated frames')
+    parser.add_argument('--objects', type=int, default=50, help='objects per frame')
+    parser.add_argument('--points', type=int, default=32, help='points per contour')
+    parser.add_argument('--size', type=int, nargs=2, default=[1280, 720], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--repeat', type=int, default=20, help='calls of each command / seek')
+    parser.add_argument('--workers', type=int, default=None, help='export worker processes (default: CPUs)')
+    parser.add_argument('--output', default=None, help='JSON results file')
+    args = parser.parse_args()
+
+    width, height = args.size
+    workdir = tempfile.mkdtemp()
+
+    # the tool remembers the last annotation; keep the user's session file out of it
+    AnnotationTool.CURRENT_ANNOTATION_FILENAME = os.path.join(workdir, '.current.p')
+
+    app = QtWidgets.QApplication(sys.argv[:1])
+    try:
+        video = synthetic.make_video(os.path.join(workdir, 'synthetic.avi'), args.frames, width, height,
+                                     fourcc='MJPG')
+        filename = synthetic.make_annotation(os.path.join(workdir, 'synthetic.atc'), video, args.frames,
+                                             args.objects, args.points, binary=True)
+
+        tool = AnnotationTool.AnnotationTool()
+        tool.resize(width, height + 100)
+        tool.show()
+        tool.open_file('annotation', filename)
+        tool.annotation.set_frame(1)
+        tool.update()
+        process_events(tool)
+
+        scene, annotation = tool.scene, tool.annotation
+        angles = np.linspace(0, 2 * np.pi, args.points, endpoint=False)
+        contour = (np.stack([np.cos(angles), np.sin(angles)], axis=1) * 20 + [width // 2, height // 2]) \
+            .astype(np.int32).ravel()
+        rng = random.Random(0)
+        steps = args.frames - 1
+        times = {}
+
+        times['step forward'] = bench_step(tool, QtCore.Qt.Key_Right, steps)
+        scene.stop_jobs()
+        times['step back'] = bench_step(tool, QtCore.Qt.Key_Left, steps)
+        times['seek'] = bench_seek(tool, [rng.randint(1, args.frames) for _ in range(args.repeat)])
+        times['scene.load'], times['scene.load (empty scene)'] = bench_load(scene, annotation,
+                                                                            range(1, min(args.frames, 100) + 1))
+        tool.update()
+        times['add_contour'] = bench_add_contour(scene, annotation, args.repeat * 10, contour)
+        times.update(bench_commands(tool, args.repeat, contour))
+        scene.stop_jobs()
+
+        os.makedirs(os.path.join(workdir, 'export'))
+        exported, export_time = bench_export(tool, os.path.join(workdir, 'export'), args.workers)
+
+        annotation.close()
+        tool.annotation = None
+    finally:
+        del app
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    operations = {name: summarize(t) for name, t in times.items()}
+    step = operations['step forward']
+    report = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'revision': revision(),
+                       'python': sys.version.split()[0], 'qt': QtCore.QT_VERSION_STR,
+                       'platform': os.environ['QT_QPA_PLATFORM'], 'frames': args.frames, 'objects': args.objects,
+                       'points': args.points, 'size': [width, height]},
+              'step_fps': {name: 1000 / operations[name]['mean_ms'] for name in ['step forward', 'step back']},
+              'export_fps': exported / export_time,
+              'operations': operations}
+
+    print('{0}x{1}, {2} frames x {3} objects x {4} points'.format(width, height, args.frames, args.objects,
+                                                                  args.points))
+    print('{0:>26} {1:>6} {2:>10} {3:>10} {4:>10} {5:>10}'.format('operation', 'n', 'mean (ms)', 'p50 (ms)',
+                                                                 'p95 (ms)', 'max (ms)'))
+    for name, s in operations.items():
+        print('{0:>26} {1:>6d} {2:>10.3f} {3:>10.3f} {4:>10.3f} {5:>10.3f}'.format(
+            name, s['n'], s['mean_ms'], s['p50_ms'], s['p95_ms'], s['max_ms']))
+    print('stepping: {0:.1f} frames/s forward, {1:.1f} frames/s back (p95 {2:.1f} ms)'.format(
+        report['step_fps']['step forward'], report['step_fps']['step back'], step['p95_ms']))
+    print('export: {0:d} frames in {1:.2f} s ({2:.1f} frames/s)'.format(exported, export_time, report['export_fps']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
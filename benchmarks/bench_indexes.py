@@ -0,0 +1,81 @@
+""" per-query latency of Annotation with and without the frames table indexes (schema version 1)
+
+usage (from repository root): python -m benchmarks.bench_indexes [--rows 10000 100000 1000000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import Annotation
+from benchmarks import synthetic
+
+# objects in each synthetic frame
+OBJECTS_PER_FRAME = 20
+
+
+def time_query(function, args_list):
+    """
+    :return: mean latency in milliseconds
+    """
+    start = time.perf_counter()
+    for args in args_list:
+        function(*args)
+    return (time.perf_counter() - start) / len(args_list) * 1000
+
+
+def run_queries(annotation, num_frames, max_id, repeat):
+    """ time read and update queries that filter on frame and/or object
+    :return: dict of query name -> latency (ms)
+    """
+    rng = random.Random(0)
+    frames = [(rng.randint(1, num_frames),) for _ in range(repeat)]
+    ids = [(rng.randint(1, max_id),) for _ in range(repeat)]
+    frame_ids = [(f, (f - 1) // 50 * OBJECTS_PER_FRAME + 1) for (f,) in frames]
+
+    return {
+        'get(frame)': time_query(annotation.get, frames),
+        'get(frame, obj_id)': time_query(annotation.get, frame_ids),
+        'get_annotations_of_id': time_query(annotation.get_annotations_of_id, ids),
+        'get_frames_indexes_of_id': time_query(annotation.get_frames_indexes_of_id, ids),
+        'finalize_object': time_query(lambda f, o: annotation.finalize_object(o, f), frame_ids),
+        'change_class': time_query(lambda o: annotation.change_class(o, 'car'), ids),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=20, help='queries of each kind')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        video = synthetic.make_video(os.path.join(tmp, 'synthetic.avi'), 2, 64, 48, fourcc='MJPG')
+
+        for rows in args.rows:
+            num_frames = rows // OBJECTS_PER_FRAME
+            filename = synthetic.make_annotation(os.path.join(tmp, 'bench{0}.atc'.format(rows)), video, num_frames,
+                                                 OBJECTS_PER_FRAME)
+
+            # loading migrates the file (creates indexes)
+            start = time.perf_counter()
+            annotation = Annotation.Annotation(filename)
+            migration = time.perf_counter() - start
+
+            indexed = run_queries(annotation, num_frames, annotation.max_id, args.repeat)
+
+            # drop indexes to compare with the original schema
+            annotation.cursor.execute('DROP INDEX frames_frame_object')
+            annotation.cursor.execute('DROP INDEX frames_object_frame')
+            plain = run_queries(annotation, num_frames, annotation.max_id, args.repeat)
+            annotation.close()
+
+            print('\n{0} rows (migration took {1:.2f} s)'.format(rows, migration))
+            print('{0:>26} {1:>16} {2:>16}'.format('query', 'no index (ms)', 'indexed (ms)'))
+            for name in indexed:
+                print('{0:>26} {1:>16.3f} {2:>16.3f}'.format(name, plain[name], indexed[name]))
+
+
+if __name__ == '__main__':
+    main()
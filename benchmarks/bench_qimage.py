@@ -0,0 +1,64 @@
+""" per-frame cost of turning a decoded (BGR) frame into the scene's background pixmap: the original
+tostring() + rgbSwapped() path against AnnotationToolGS.frame_to_qimage. runs offscreen (no display needed)
+
+usage (from repository root): python -m benchmarks.bench_qimage [--repeat 20]
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+# no display needed
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5 import QtGui, QtWidgets
+
+import AnnotationToolGS
+
+# frame sizes (width, height)
+SIZES = {'720p': (1280, 720), '1080p': (1920, 1080), '4K': (3840, 2160)}
+
+
+def copy_swap(frame):
+    """ original path: byte copy, then a second (swapped) copy """
+    return QtGui.QImage(frame.tobytes(), frame.shape[1], frame.shape[0], QtGui.QImage.Format_RGB888).rgbSwapped()
+
+
+def time_ms(function, frame, repeat):
+    """
+    :return: median time of function(frame) in milliseconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(frame)
+        times.append(time.perf_counter() - start)
+    return np.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication(sys.argv[:1])
+
+    print('native BGRA (Format_RGB32, shared by the pixmap): {0}'.format(AnnotationToolGS.NATIVE_BGRA))
+    print('{0:>8} {1:>20} {2:>20} {3:>20} {4:>20}'.format('frame', 'copy+swap (ms)', 'frame_to_qimage (ms)',
+                                                           '+ pixmap, old (ms)', '+ pixmap, new (ms)'))
+    for name, (width, height) in SIZES.items():
+        frame = np.random.RandomState(0).randint(0, 256, (height, width, 3)).astype(np.uint8)
+
+        old = time_ms(copy_swap, frame, args.repeat)
+        new = time_ms(AnnotationToolGS.frame_to_qimage, frame, args.repeat)
+        old_pixmap = time_ms(lambda f: QtGui.QPixmap.fromImage(copy_swap(f)), frame, args.repeat)
+        new_pixmap = time_ms(lambda f: QtGui.QPixmap.fromImage(AnnotationToolGS.frame_to_qimage(f)), frame,
+                             args.repeat)
+        print('{0:>8} {1:>20.2f} {2:>20.3f} {3:>20.2f} {4:>20.2f}'.format(name, old, new, old_pixmap, new_pixmap))
+
+    del app
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+""" compare reading frames with a seek per frame (old get_frame_image) against the sequential fast path
+of FrameSource.VideoSource, and random jumps with and without a keyframe index, and from the video transcoded
+into a raw video container (FrameSource.RawVideoSource)
+
+usage (from repository root): python -m benchmarks.bench_seek [--frames N] [--step K]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import numpy as np
+
+import FrameSource
+from benchmarks import synthetic
+
+
+def seek_every_frame(filename, frames):
+    """ old path: always set position before reading """
+    source = FrameSource.VideoSource(filename)
+    start = time.perf_counter()
+    for f in frames:
+        source.seek(f)
+        source.read(f)
+    elapsed = time.perf_counter() - start
+    source.release()
+    return elapsed
+
+
+def sequential_fast_path(filename, frames):
+    """ new path: seek only if the requested frame is behind or far ahead of the decoder """
+    source = FrameSource.VideoSource(filename)
+    start = time.perf_counter()
+    for f in frames:
+        source.read(f)
+    elapsed = time.perf_counter() - start
+    source.release()
+    return elapsed
+
+
+def random_jumps(filename, frames, index=None, copy=False):
+    """ random access, optionally through a keyframe index (or from a raw video container)
+    :param copy: copy each frame (raw video frames are views of a memory map, only paged in when used)
+    """
+    source = FrameSource.open_source(filename, index=index)
+    start = time.perf_counter()
+    for f in frames:
+        frame = source.read(f)
+        if copy:
+            np.array(frame)
+    elapsed = time.perf_counter() - start
+    source.release()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=300, help='number of frames in synthetic video')
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--gop', type=int, default=250, help='keyframe interval of synthetic video')
+    parser.add_argument('--video', help='use an existing video instead of a synthetic one')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = args.video or synthetic.make_video(os.path.join(tmp, 'synthetic.mp4'), args.frames,
+                                                      args.width, args.height, key_interval=args.gop)
+        num_frames = FrameSource.VideoSource(filename).num_frames()
+
+        print('{0:>10} {1:>18} {2:>18} {3:>8}'.format('step', 'seek (ms/frame)', 'fast (ms/frame)', 'speedup'))
+        for step in (1, 2, 5, 10):
+            frames = list(range(1, num_frames + 1, step))
+            old = seek_every_frame(filename, frames) / len(frames) * 1000
+            new = sequential_fast_path(filename, frames) / len(frames) * 1000
+            print('{0:>10} {1:>18.2f} {2:>18.2f} {3:>7.1f}x'.format(step, old, new, old / new))
+
+        index = FrameSource.KeyframeIndex(filename)
+        start = time.perf_counter()
+        index.build()
+        print('\nkeyframe index: {0} keyframes, built in {1:.1f} ms'.format(
+            len(index.keyframes) if index.ready else 0, (time.perf_counter() - start) * 1000))
+
+        random.seed(0)
+        frames = [random.randint(1, num_frames) for _ in range(100)]
+        old = random_jumps(filename, frames) / len(frames) * 1000
+        new = random_jumps(filename, frames, index) / len(frames) * 1000
+        print('random jumps: {0:.2f} ms/frame seeking by frame number, {1:.2f} ms/frame with keyframe index'.format(
+            old, new))
+
+        container = os.path.join(tmp, 'transcoded' + FrameSource.RawVideoSource.SUFFIX)
+        start = time.perf_counter()
+        FrameSource.transcode(filename, container)
+        transcode_time = time.perf_counter() - start
+        raw = random_jumps(container, frames, copy=True) / len(frames) * 1000
+        print('raw container: transcoded in {0:.1f} s ({1:.1f} MB), random jumps {2:.2f} ms/frame '
+              '(frame copied)'.format(transcode_time, os.path.getsize(container) / 2 ** 20, raw))
+
+
+if __name__ == '__main__':
+    main()
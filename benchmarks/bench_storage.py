@@ -0,0 +1,183 @@
+""" latency of Annotation storage operations on synthetic annotations of N frames x M objects x K contour points.
+results are printed and written as JSON (--output) to compare across releases. headless; no Qt needed
+
+usage (from repository root):
+    python -m benchmarks.bench_storage [--frames 1000 10000] [--objects 20] [--points 16] [--output storage.json]
+    python -m benchmarks.bench_storage --frames 500000 --objects 20 --workdir /data/bench   # 10M rows, kept
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+import Annotation
+from benchmarks import synthetic
+
+# frames each synthetic object exists in (objects of consecutive generations never share a frame)
+TRACK_LENGTH = 50
+
+
+def summarize(times):
+    """
+    :param times: durations in seconds
+    :return: dict of count and mean / p50 / p95 / max in milliseconds
+    """
+    times = np.asarray(times) * 1000
+    return {'n': len(times), 'mean_ms': float(times.mean()), 'p50_ms': float(np.percentile(times, 50)),
+            'p95_ms': float(np.percentile(times, 95)), 'max_ms': float(times.max())}
+
+
+def time_calls(function, args_list):
+    """
+    :return: list of durations (seconds) of function(*args) for each args
+    """
+    times = []
+    for args in args_list:
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_operations(annotation, num_frames, objects_per_frame, points_per_contour, repeat, seed=0):
+    """ time read queries first, then mutations (each on its own objects, so they don't interfere)
+    :return: dict of operation name -> list of durations (seconds)
+    """
+    rng = random.Random(seed)
+    max_id = annotation.max_id
+    generations = max_id // objects_per_frame
+    frames = [(rng.randint(1, num_frames),) for _ in range(repeat)]
+    ids = [(rng.randint(1, max_id),) for _ in range(repeat)]
+    contour = np.arange(2 * points_per_contour, dtype=np.int32)
+    results = {}
+
+    # reads
+    results['get'] = time_calls(annotation.get, frames)
+    results['get(obj_id)'] = time_calls(annotation.get, [(f, (f - 1) // TRACK_LENGTH * objects_per_frame + 1)
+                                                         for (f,) in frames])
+    results['get_annotations_of_id'] = time_calls(annotation.get_annotations_of_id, ids)
+    results['get_frames_indexes_of_id'] = time_calls(annotation.get_frames_indexes_of_id, ids)
+    results['_fetch_max_id'] = time_calls(annotation._fetch_max_id, [()] * repeat)
+
+    # single object inserts and removals (of the inserted objects)
+    added = [(f, annotation.get_new_id(), 'car', contour, False) for (f,) in frames]
+    results['add'] = time_calls(annotation.add, added)
+    results['remove(obj_id, frame)'] = time_calls(annotation.remove, [(o, f) for f, o, _, _, _ in added])
+
+    results['change_class'] = time_calls(annotation.change_class, [(o, 'truck') for (o,) in ids])
+    results['finalize_frame'] = time_calls(annotation.finalize_frame, frames)
+
+    # combine an object of an even generation into the same object of the next generation (no common frames)
+    pairs = [(2 * g * objects_per_frame + j + 1, (2 * g + 1) * objects_per_frame + j + 1)
+             for g, j in itertools.product(range(generations // 2), range(objects_per_frame))]
+    pairs = rng.sample(pairs, min(repeat, len(pairs)))
+    if pairs:
+        results['combine_objects'] = time_calls(annotation.combine_objects, pairs)
+
+    # whole-object removal, of objects not combined
+    combined = set(itertools.chain.from_iterable(pairs))
+    remaining = [o for o in range(1, max_id + 1) if o not in combined]
+    results['remove(obj_id)'] = time_calls(annotation.remove, [(o,) for o in rng.sample(remaining,
+                                                                                         min(repeat, len(remaining)))])
+
+    # commit of everything left pending by the write-behind
+    results['commit'] = time_calls(annotation.commit, [()])
+    return results
+
+
+def revision():
+    """
+    :return: git revision of the tree, if available
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, nargs='+', default=[1000, 10000], help='annotated frames (N)')
+    parser.add_argument('--objects', type=int, nargs='+', default=[20], help='objects per frame (M)')
+    parser.add_argument('--points', type=int, nargs='+', default=[16], help='points per contour (K)')
+    parser.add_argument('--repeat', type=int, default=50, help='calls of each operation')
+    parser.add_argument('--commit-interval', type=float, default=Annotation.Annotation.COMMIT_INTERVAL,
+                        help='write-behind interval of the annotation (seconds; 0 commits every change)')
+    parser.add_argument('--workdir', default=None,
+                        help='keep generated annotations here and reuse them in later runs (default: temporary)')
+    parser.add_argument('--output', default=None, help='JSON results file')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp()
+    os.makedirs(workdir, exist_ok=True)
+    video = os.path.join(workdir, 'synthetic.avi')
+    if not os.path.exists(video):
+        synthetic.make_video(video, 2, 64, 48, fourcc='MJPG')
+
+    report = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'revision': revision(),
+                       'python': sys.version.split()[0], 'sqlite': sqlite3.sqlite_version,
+                       'numpy': np.__version__, 'platform': platform.platform(), 'repeat': args.repeat,
+                       'commit_interval': args.commit_interval},
+              'results': []}
+
+    try:
+        for num_frames, objects, points in itertools.product(args.frames, args.objects, args.points):
+            result = {'frames': num_frames, 'objects': objects, 'points': points, 'rows': num_frames * objects}
+
+            # pristine file (generated once per size), benchmarked on a copy since the mutations change it
+            pristine = os.path.join(workdir, 'storage_{0}x{1}x{2}.atc'.format(num_frames, objects, points))
+            if not os.path.exists(pristine):
+                start = time.perf_counter()
+                synthetic.make_annotation(pristine + '.tmp', video, num_frames, objects, points, TRACK_LENGTH,
+                                          binary=True)
+                os.replace(pristine + '.tmp', pristine)
+                result['generate_s'] = time.perf_counter() - start
+            result['file_mb'] = os.path.getsize(pristine) / 2 ** 20
+
+            filename = os.path.join(workdir, 'run.atc')
+            shutil.copyfile(pristine, filename)
+
+            start = time.perf_counter()
+            annotation = Annotation.Annotation(filename, commit_interval=args.commit_interval,
+                                               background_readers=False)
+            result['open_s'] = time.perf_counter() - start
+            try:
+                times = run_operations(annotation, num_frames, objects, points, args.repeat)
+            finally:
+                annotation.close()
+            for f in [filename, filename + '-wal', filename + '-shm']:
+                if os.path.exists(f):
+                    os.remove(f)
+
+            result['operations'] = {name: summarize(t) for name, t in times.items()}
+            report['results'].append(result)
+
+            print('\n{0} frames x {1} objects x {2} points = {3} rows ({4:.1f} MB, open {5:.3f} s)'.format(
+                num_frames, objects, points, result['rows'], result['file_mb'], result['open_s']))
+            print('{0:>26} {1:>6} {2:>10} {3:>10} {4:>10} {5:>10}'.format('operation', 'n', 'mean (ms)',
+                                                                         'p50 (ms)', 'p95 (ms)', 'max (ms)'))
+            for name, s in result['operations'].items():
+                print('{0:>26} {1:>6d} {2:>10.3f} {3:>10.3f} {4:>10.3f} {5:>10.3f}'.format(
+                    name, s['n'], s['mean_ms'], s['p50_ms'], s['p95_ms'], s['max_ms']))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('\nresults written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+""" per-object latency (and accuracy) of the Tracker backends on synthetic frames with moving textured objects
+
+usage (from repository root): python -m benchmarks.bench_tracker [--objects 20] [--points 16 64 256]
+"""
+import argparse
+import time
+import numpy as np
+import cv2
+
+import Tracker
+
+# frame time budget for tracking all objects of a frame while stepping through the video (ms)
+INTERACTIVE_BUDGET_MS = 50
+
+
+class SyntheticFrames(object):
+    """ textured background with textured discs moving at known constant velocities; stands in for the
+    Annotation the tracker reads frames from """
+
+    def __init__(self, num_frames, num_objects, width=1280, height=720, radius=30, seed=0):
+        num_frames = min(num_frames, 2 * radius)
+        rng = np.random.RandomState(seed)
+        self.num_frames = num_frames
+        self.radius = radius
+
+        # smooth random texture (trackable at all pyramid levels)
+        def texture(h, w):
+            t = rng.randint(0, 256, size=(h // 8 + 1, w // 8 + 1)).astype(np.uint8)
+            return cv2.resize(t, (w, h), interpolation=cv2.INTER_CUBIC)
+
+        self.background = texture(height, width)
+        self.patches = [texture(2 * radius, 2 * radius) for _ in range(num_objects)]
+        # objects stay inside the frame for 2 * radius frames
+        self.start = rng.uniform(4 * radius, [width - 4 * radius, height - 4 * radius], size=(num_objects, 2))
+        self.velocity = rng.uniform(-3, 3, size=(num_objects, 2))
+        mask = np.zeros((2 * radius, 2 * radius), dtype=np.uint8)
+        cv2.circle(mask, (radius, radius), radius - 1, 1, -1)
+        self.mask = mask.astype(bool)
+
+    def center(self, obj, frame_number):
+        return self.start[obj] + self.velocity[obj] * (frame_number - 1)
+
+    def read_frame(self, frame_number):
+        frame = self.background.copy()
+        for obj, patch in enumerate(self.patches):
+            x, y = np.rint(self.center(obj, frame_number) - self.radius).astype(int)
+            region = frame[y:y + 2 * self.radius, x:x + 2 * self.radius]
+            region[self.mask] = patch[self.mask]
+        return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+    def contour(self, obj, frame_number, num_points):
+        angles = np.linspace(0, 2 * np.pi, num_points, endpoint=False)
+        circle = np.stack([np.cos(angles), np.sin(angles)], axis=1) * (self.radius - 1)
+        return np.rint(self.center(obj, frame_number) + circle).astype(np.int32).ravel()
+
+
+def bench_backend(frames, backend, num_points, num_frames):
+    """
+    :return: (mean ms per frame, mean ms per object, mean error in pixels, fraction of objects lost)
+    """
+    tracker = Tracker.Tracker(frames, backend)
+    num_objects = len(frames.patches)
+    elapsed = errors = lost = 0
+
+    # per-frame preparation (grayscale conversion, pyramid), shared by all objects; synthesis is not timed
+    images = [frames.read_frame(f) for f in range(1, num_frames + 1)]
+    start = time.perf_counter()
+    for image in images:
+        tracker.backend.prepare(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+    per_frame = (time.perf_counter() - start) / num_frames * 1000
+
+    for f in range(1, num_frames):
+        tracker.frame(f)
+        tracker.frame(f + 1)
+
+        for obj in range(num_objects):
+            contour = frames.contour(obj, f, num_points)
+            start = time.perf_counter()
+            prediction = tracker.track(contour, f, obj + 1)
+            elapsed += time.perf_counter() - start
+
+            true_shift = frames.center(obj, f + 1) - frames.center(obj, f)
+            shift = (np.asarray(prediction).reshape(-1, 2) - contour.reshape(-1, 2)).mean(axis=0)
+            errors += np.linalg.norm(shift - true_shift)
+            lost += np.array_equal(prediction, contour) and np.linalg.norm(true_shift) >= 1
+
+    count = (num_frames - 1) * num_objects
+    return per_frame, elapsed / count * 1000, errors / count, lost / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--objects', type=int, default=20, help='objects per frame')
+    parser.add_argument('--points', type=int, nargs='+', default=[16, 64, 256], help='points per contour')
+    parser.add_argument('--frames', type=int, default=20)
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+    frames = SyntheticFrames(args.frames, args.objects)
+
+    print('1280x720 frames, {0} objects; objects / budget: objects tracked within {1} ms per frame'.format(
+        args.objects, INTERACTIVE_BUDGET_MS))
+    print('{0:>14} {1:>8} {2:>12} {3:>14} {4:>18} {5:>12} {6:>8}'.format(
+        'backend', 'points', 'ms / frame', 'ms / object', 'objects / budget', 'error (px)', 'lost'))
+    for backend in sorted(Tracker.BACKENDS):
+        for num_points in args.points:
+            per_frame, latency, error, lost = bench_backend(frames, backend, num_points, args.frames)
+
+            # the current and next frames are prepared once per frame step
+            budget = INTERACTIVE_BUDGET_MS - 2 * per_frame
+            per_budget = int(budget / latency) if latency > 0 else 'unlimited'
+            print('{0:>14} {1:>8d} {2:>12.2f} {3:>14.3f} {4:>18} {5:>12.2f} {6:>7.0%}'.format(
+                backend, num_points, per_frame, latency, per_budget, error, lost))
+
+
+if __name__ == '__main__':
+    main()
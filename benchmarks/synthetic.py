@@ -0,0 +1,113 @@
+""" synthetic inputs for benchmarks """
+import itertools
+import sqlite3
+import numpy as np
+import cv2
+
+import Annotation
+
+
+def make_video(filename, num_frames=300, width=640, height=480, fps=25, fourcc='mp4v', key_interval=250):
+    """ write a synthetic video: a moving gradient with a few moving boxes, so that the codec has real work to do
+    :param filename: output video filename
+    :param num_frames: number of frames
+    :param width: frame width
+    :param height: frame height
+    :param fps: frames per second
+    :param fourcc: codec four character code
+    :param key_interval: distance between keyframes (GOP size), if supported by the backend
+    :return: filename
+    """
+    params = [cv2.VIDEOWRITER_PROP_KEY_INTERVAL, key_interval] if hasattr(cv2, 'VIDEOWRITER_PROP_KEY_INTERVAL') else []
+    writer = cv2.VideoWriter(filename, cv2.CAP_FFMPEG, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height), params)
+    if not writer.isOpened():
+        # fall back to default backend and GOP
+        writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+
+    x = np.arange(width, dtype=np.uint16)
+    y = np.arange(height, dtype=np.uint16)[:, None]
+    rng = np.random.RandomState(0)
+    noise = rng.randint(0, 32, size=(height, width, 3)).astype(np.uint8)
+
+    for i in range(num_frames):
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[..., 0] = (x + 2 * i) % 256
+        frame[..., 1] = (y + i) % 256
+        frame[..., 2] = (x + y + 3 * i) % 256
+        frame += noise
+
+        # a few moving boxes
+        for k in range(4):
+            cx = (50 + 40 * k + 3 * i * (k + 1)) % (width - 40)
+            cy = (30 + 60 * k + 2 * i) % (height - 40)
+            cv2.rectangle(frame, (cx, cy), (cx + 40, cy + 40), (255, 255, 255), -1)
+
+        # frame number, so that correctness can be checked by eye
+        cv2.putText(frame, str(i + 1), (10, height - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+        writer.write(frame)
+
+    writer.release()
+    return filename
+
+
+def synthetic_records(num_frames, objects_per_frame=20, points_per_contour=16, track_length=50, seed=0):
+    """ generate rows (frame, object, class, contour, final) of synthetic annotations, in frame order.
+    objects live for track_length frames and are then replaced by new ones
+    :param num_frames: number of annotated frames
+    :param objects_per_frame: objects in each frame
+    :param points_per_contour: (x, y) points in each contour
+    :param track_length: number of frames each object exists in
+    :param seed: random seed
+    :return: generator of rows
+    """
+    rng = np.random.RandomState(seed)
+    angles = np.linspace(0, 2 * np.pi, points_per_contour, endpoint=False)
+    unit = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+    classes = ['car', 'person', 'truck', 'bicycle']
+
+    for frame in range(1, num_frames + 1):
+        generation = (frame - 1) // track_length
+        centers = rng.randint(20, 600, size=(objects_per_frame, 2))
+        for j in range(objects_per_frame):
+            obj_id = generation * objects_per_frame + j + 1
+            contour = (centers[j] + 15 * unit).astype(np.int32).ravel()
+            yield frame, obj_id, classes[obj_id % len(classes)], contour, (frame + j) % 3 == 0
+
+
+def make_annotation(filename, video_filename, num_frames, objects_per_frame=20, points_per_contour=16,
+                    track_length=50, chunk_size=100000, binary=False):
+    """ write a synthetic .atc file with num_frames * objects_per_frame rows. by default the file has the original
+    (version 0) schema, and Annotation migrates it when it is loaded
+    :param filename: .atc filename
+    :param video_filename: video referenced by the annotation
+    :param binary: write the current schema instead (BLOB contours, indexes), so that loading doesn't migrate
+    :return: filename
+    """
+    connection = sqlite3.connect(filename)
+    cursor = connection.cursor()
+    cursor.execute('CREATE TABLE frames (frame integer, object integer, class text, contour {0}, final integer)'
+                   .format('blob' if binary else 'text'))
+    cursor.execute('CREATE TABLE classes (class_name text unique)')
+    cursor.execute('CREATE TABLE session (video_file text, current_frame integer)')
+    cursor.execute('INSERT INTO session VALUES(?, ?)', (video_filename, 1))
+    cursor.executemany('INSERT INTO classes VALUES (?)', [('car',), ('person',), ('truck',), ('bicycle',)])
+
+    encode = Annotation.encode_contour if binary else lambda contour: ' '.join(str(x) for x in contour)
+    rows = ((f, o, c, encode(contour), int(final))
+            for f, o, c, contour, final in synthetic_records(num_frames, objects_per_frame, points_per_contour,
+                                                            track_length))
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        cursor.executemany('INSERT INTO frames VALUES(?, ?, ?, ?, ?)', chunk)
+
+    # indexes are built once, after the rows are in (as Annotation.migrate does)
+    if binary:
+        cursor.execute('CREATE INDEX frames_frame_object ON frames (frame, object)')
+        cursor.execute('CREATE INDEX frames_object_frame ON frames (object, frame)')
+        cursor.execute('PRAGMA user_version = {0:d}'.format(Annotation.Annotation.SCHEMA_VERSION))
+
+    connection.commit()
+    connection.close()
+    return filename
@@ -0,0 +1,37 @@
+""" Import.import_detections on a small synthetic annotation
+
+usage (from repository root):
+    python -m pytest tests
+"""
+import Annotation
+import Import
+from benchmarks import synthetic
+
+
+def box(x):
+    return Import.box_contour(x, 10, 20, 20)
+
+
+def test_duplicate_track_detection_in_frame_is_skipped(tmp_path):
+    video = synthetic.make_video(str(tmp_path / 'video.avi'), 4, 64, 48, fourcc='MJPG')
+    filename = synthetic.make_annotation(str(tmp_path / 'annotation.atc'), video, 4, 1, 4, binary=True)
+
+    annotation = Annotation.Annotation(filename, background_readers=False, video=False)
+    try:
+        max_id = annotation.max_id
+        detections = [(1, 7, 'car', box(0)), (1, 7, 'car', box(30)), (2, 7, 'car', box(0)),
+                      (1, 8, 'car', box(0)), (1, None, 'car', box(0)), (1, None, 'car', box(0))]
+        inserted, objects, skipped = Import.import_detections(annotation, detections)
+
+        assert (inserted, objects, skipped) == (5, 4, 1)
+
+        # the track's first detection in frame 1 is kept
+        records = [r for r in annotation.get(1) if r[1] == max_id + 1]
+        assert len(records) == 1
+        assert list(Annotation.decode_contour(records[0][3])) == box(0)
+
+        # (frame, object) pairs are unique
+        rows = list(annotation.iter_records())
+        assert len(rows) == len({(r[0], r[1]) for r in rows})
+    finally:
+        annotation.close()